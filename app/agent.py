@@ -10,16 +10,63 @@ El agente:
 3. Estructura la información en formato FHIR-like
 """
 
+import asyncio
+import contextlib
+import hashlib
 import logging
+import os
+import random
+import re
+import threading
 import whisper
-from typing import Optional
-from openai import OpenAI
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Tuple
+from pydantic import ValidationError
 
 from app.models import ClinicalSummary, Symptom
 from app.config import settings
+from app.cache import (
+    create_llm_result_cache,
+    create_transcription_cache,
+    make_cache_key,
+    normalize_text
+)
+from app.queue import redis_client, async_redis_client
+from app.limiter import AdaptiveConcurrencyLimiter, is_overload_error
+from app.llm import create_llm_backend
+from app.transcription import transcribe_in_worker, transcribe_segmented, SAMPLE_RATE
+from app.jsonstream import IncrementalJSONObjectParser, find_json_object, loads, repair_truncated_json
+from app.chunking import chunk_conversation, merge_summaries
+from app.tokens import count_tokens
+from app.output_schema import decode_output, get_output_schema, schema_id
+from app.packing import JobPacker
 
 logger = logging.getLogger(__name__)
 
+# Versión del prompt de extracción
+# Cambiarla (al modificar _build_clinical_prompt) invalida la caché de resultados
+PROMPT_VERSION = "1"
+
+# Parámetros de la llamada al LLM
+LLM_TEMPERATURE = 0.3  # Baja temperatura para respuestas más consistentes
+LLM_MAX_TOKENS = 2000  # Límite de tokens en la respuesta (llamada combinada)
+
+SYSTEM_PROMPT = "Eres un asistente médico experto que extrae información estructurada de conversaciones clínicas."
+NARRATIVE_SYSTEM_PROMPT = "Eres un asistente médico experto que redacta resúmenes clínicos de conversaciones."
+
+# Cómo se genera narrative_summary (LLM_NARRATIVE_MODE):
+# - combined: en la misma llamada que los campos estructurados
+# - concurrent: en una segunda llamada, a la vez que la estructurada
+# - lazy: sólo cuando se pide (GET /result/{id}/narrative)
+NARRATIVE_MODES = ("combined", "concurrent", "lazy")
+
+# Encabezado de cada conversación en una llamada agrupada (ver app/packing.py)
+PACKED_CONVERSATION_HEADER = "=== CONVERSACIÓN"
+
+# Protege los contadores de uso cuando varios fragmentos terminan a la vez
+_usage_lock = threading.Lock()
+
 
 class ClinicalAgent:
     """
@@ -31,35 +78,64 @@ class ClinicalAgent:
     - Estructuración de datos (FHIR-like)
     """
     
-    def __init__(self):
+    def __init__(self, load_whisper: bool = True):
         """
         Inicializa el agente cargando los modelos necesarios.
         
         Esta inicialización es costosa (carga modelos grandes),
         por eso se hace una sola vez cuando se crea el agente,
         no por cada trabajo.
+        
+        Args:
+            load_whisper: Si es False, Whisper se carga al transcribir el
+                          primer audio (workers que casi sólo reciben texto)
         """
         logger.info("Inicializando modelos...")
         
         # Inicializar Whisper para transcripción
         # whisper.load_model() carga el modelo en memoria
         # Esto puede tardar varios segundos y usar varios GB de RAM
-        self.whisper_model = whisper.load_model(settings.whisper_model)
-        logger.info(f"Modelo Whisper '{settings.whisper_model}' cargado")
+        self.whisper_model = None
+        if load_whisper:
+            self._load_whisper()
+        
+        # Opciones de decodificación de Whisper (forman parte de la clave de caché)
+        self.whisper_options: Dict[str, Any] = {}
+        if settings.whisper_language:
+            self.whisper_options["language"] = settings.whisper_language
         
-        # Inicializar cliente de OpenAI para el LLM
-        # OpenAI() crea un cliente que se conecta a la API de OpenAI
-        if not settings.openai_api_key:
-            raise ValueError("OPENAI_API_KEY no configurada")
-        self.openai_client = OpenAI(api_key=settings.openai_api_key)
-        logger.info("Cliente OpenAI inicializado")
+        # Caché de transcripciones en disco (None si está desactivada)
+        self.transcription_cache = create_transcription_cache()
+        
+        # Inicializar el cliente del LLM
+        # El backend (LLM_BACKEND) decide a qué servidor hablamos: la API de
+        # OpenAI, un servidor compatible o el stub local (ver app/llm.py)
+        self.llm_backend = create_llm_backend()
+        self.openai_client = self.llm_backend.client
+        # Cliente asíncrono para el worker asyncio. Sin reintentos internos:
+        # los 429 los gestionan el limitador adaptativo y _acall_llm
+        self.async_openai_client = self.llm_backend.async_client
+        logger.info("Cliente LLM inicializado")
+        
+        # Caché de resultados del LLM (None si LLM_CACHE_ENABLED=false)
+        self.result_cache = create_llm_result_cache(redis_client, async_redis_client)
+    
+    def _load_whisper(self):
+        """
+        Carga el modelo Whisper (una sola vez).
+        """
+        if self.whisper_model is None:
+            self.whisper_model = whisper.load_model(settings.whisper_model)
+            logger.info(f"Modelo Whisper '{settings.whisper_model}' cargado")
+        return self.whisper_model
     
-    def transcribe_audio(self, audio_path: str) -> str:
+    def transcribe_audio(self, audio_path: str, audio_sha256: Optional[str] = None) -> str:
         """
         Transcribe audio a texto usando Whisper.
         
         Args:
             audio_path: Ruta al archivo de audio
+            audio_sha256: Hash del contenido, si ya se conoce (evita recalcularlo)
         
         Returns:
             Texto transcrito
@@ -70,20 +146,109 @@ class ClinicalAgent:
             Esta operación puede tardar varios segundos dependiendo
             de la duración del audio y el tamaño del modelo.
         """
+        return self.transcribe_audio_detailed(audio_path, audio_sha256)["text"]
+    
+    def transcribe_audio_detailed(self, audio_path: str, audio_sha256: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Transcribe audio y devuelve texto, segmentos e idioma detectado.
+        
+        El resultado se guarda en la caché de transcripciones con una clave
+        formada por el hash del audio, el modelo Whisper y las opciones de
+        decodificación y de segmentación. Reprocesar el mismo audio no vuelve a ejecutar Whisper.
+        """
+        cache_key = None
+        if self.transcription_cache is not None:
+            audio_sha256 = audio_sha256 or _file_sha256(audio_path)
+            cache_key = make_cache_key(audio_sha256, settings.whisper_model, self._transcription_cache_options())
+            cached = self.transcription_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Transcripción obtenida de la caché: {audio_path}")
+                return cached
+        
         logger.info(f"Transcribiendo audio: {audio_path}")
         
         # Transcribir audio
         # transcribe() ejecuta inference - procesa el audio frame por frame
         # y genera texto. Esto es CPU/GPU intensivo.
-        result = self.whisper_model.transcribe(audio_path)
+        result = self._run_whisper(audio_path)
+        
+        # Guardamos sólo lo necesario de cada segmento (no los tokens)
+        transcription = {
+            "text": result["text"],
+            "segments": [
+                {
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "text": segment["text"]
+                }
+                for segment in result.get("segments", [])
+            ],
+            "language": result.get("language")
+        }
+        logger.info(f"Transcripción completada: {len(transcription['text'])} caracteres")
         
-        # Extraer texto de la transcripción
-        text = result["text"]
-        logger.info(f"Transcripción completada: {len(text)} caracteres")
+        if cache_key is not None:
+            self.transcription_cache.put(cache_key, transcription)
+        
+        return transcription
+    
+    def _transcription_cache_options(self) -> Dict[str, Any]:
+        """
+        Opciones que cambian el texto transcrito (parte de la clave de caché).
         
-        return text
+        Con TRANSCRIPTION_WORKERS > 1 un audio largo se transcribe por
+        ventanas unidas (ver _run_whisper), y el texto no es igual al de la
+        transcripción secuencial: los parámetros de la segmentación también
+        entran en la clave. Con un solo proceso la clave no cambia.
+        """
+        options = dict(self.whisper_options)
+        if settings.transcription_workers > 1:
+            options["segmentation"] = {
+                "workers": settings.transcription_workers,
+                "min_seconds": settings.transcription_segment_min_seconds,
+                "window_seconds": settings.transcription_window_seconds,
+                "overlap_seconds": settings.transcription_overlap_seconds,
+                "search_seconds": settings.transcription_split_search_seconds
+            }
+        return options
     
-    def process_clinical_text(self, text: str) -> ClinicalSummary:
+    def _run_whisper(self, audio_path: str) -> Dict[str, Any]:
+        """
+        Ejecuta Whisper, en paralelo por ventanas si el audio es largo.
+        
+        Con TRANSCRIPTION_WORKERS > 1, los audios de más de
+        TRANSCRIPTION_SEGMENT_MIN_SECONDS se dividen en ventanas cortadas
+        en silencios y se transcriben en un pool de procesos
+        (ver app/transcription.py). Los audios cortos se transcriben enteros,
+        también en un proceso hijo: el padre no ejecuta el modelo antes de
+        un fork.
+        """
+        self._load_whisper()
+        if settings.transcription_workers <= 1:
+            return self.whisper_model.transcribe(audio_path, **self.whisper_options)
+        
+        # whisper.load_audio decodifica con ffmpeg a mono 16 kHz
+        audio = whisper.load_audio(audio_path)
+        if len(audio) < settings.transcription_segment_min_seconds * SAMPLE_RATE:
+            return transcribe_in_worker(self.whisper_model, audio, self.whisper_options)
+        
+        return transcribe_segmented(
+            self.whisper_model,
+            audio,
+            self.whisper_options,
+            workers=settings.transcription_workers,
+            window_seconds=settings.transcription_window_seconds,
+            overlap_seconds=settings.transcription_overlap_seconds,
+            search_seconds=settings.transcription_split_search_seconds
+        )
+    
+    def process_clinical_text(
+        self,
+        text: str,
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        usage: Optional[Dict[str, int]] = None,
+        on_structured: Optional[Callable[[ClinicalSummary], None]] = None
+    ) -> ClinicalSummary:
         """
         Procesa texto clínico usando LLM para extraer información estructurada.
         
@@ -97,9 +262,18 @@ class ClinicalAgent:
         
         Args:
             text: Texto de la conversación clínica
+            on_partial: Función opcional que recibe los campos ya extraídos
+                        mientras el LLM sigue generando (modo streaming)
+            usage: Diccionario opcional donde se acumulan las llamadas y los
+                   tokens de entrada/salida del LLM (ver _record_usage).
+                   Si el resultado sale de la caché, no se modifica
+            on_structured: Función opcional que recibe el ClinicalSummary en
+                           cuanto están los campos estructurados, sin esperar
+                           a la narrativa (en modo combined, el resumen completo)
         
         Returns:
-            ClinicalSummary con información estructurada
+            ClinicalSummary con información estructurada. En modo lazy,
+            narrative_summary va vacío (ver generate_narrative)
         
         Explicación del flujo:
             1. Construimos un prompt detallado para el LLM
@@ -107,36 +281,565 @@ class ClinicalAgent:
             3. El LLM procesa el texto (inference) - esto puede tardar varios segundos
             4. Parseamos la respuesta del LLM
             5. Construimos el objeto ClinicalSummary estructurado
+        
+            Antes de llamar al LLM consultamos la caché de resultados: un texto
+            ya procesado con el mismo modelo, prompt y temperatura se devuelve
+            sin volver a llamar al LLM.
+        
+        La prosa del resumen narrativo es lo más lento de generar, y el
+        triaje sólo necesita los campos estructurados. Con
+        LLM_NARRATIVE_MODE=concurrent (por defecto) hacemos dos llamadas a la
+        vez, cada una con su límite de tokens (LLM_STRUCTURED_MAX_TOKENS y
+        LLM_NARRATIVE_MAX_TOKENS): on_structured recibe los campos en cuanto
+        termina la primera. Con lazy la narrativa no se genera aquí, y con
+        combined se vuelve a la llamada única.
+        """
+        mode = self._narrative_mode()
+        if mode == "combined":
+            summary = self._cached_summary(
+                text, "combined", lambda: self._extract_clinical_summary(text, on_partial, usage)
+            )
+            if on_structured is not None:
+                on_structured(summary)
+            return summary
+        
+        # La narrativa arranca antes que la extracción estructurada, en su
+        # propio hilo y con su propio acumulador de uso (se suma al terminar)
+        executor = None
+        narrative_future = None
+        narrative_usage: Dict[str, int] = {}
+        if mode == "concurrent":
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-narrative")
+            narrative_future = executor.submit(
+                self.generate_narrative, text, narrative_usage if usage is not None else None
+            )
+        try:
+            structured = self._cached_summary(
+                text, "structured", lambda: self._extract_clinical_summary(text, on_partial, usage, narrative=False)
+            )
+            if on_structured is not None:
+                on_structured(structured)
+            if narrative_future is None:
+                return structured
+            return structured.model_copy(update={"narrative_summary": narrative_future.result()})
+        finally:
+            if narrative_future is not None:
+                # Si la extracción estructurada falló, la narrativa no puede
+                # quedar huérfana (seguiría facturando y escribiendo en usage
+                # después de guardar las métricas): la cancelamos si aún no
+                # empezó o la esperamos
+                if not narrative_future.cancel():
+                    with contextlib.suppress(Exception):
+                        narrative_future.result()
+                executor.shutdown(wait=True)
+                self._merge_usage(usage, narrative_usage)
+    
+    def generate_narrative(self, text: str, usage: Optional[Dict[str, int]] = None) -> str:
+        """
+        Genera sólo el resumen narrativo de una conversación (con caché).
+        
+        Es la segunda llamada del modo concurrent y la que ejecuta el
+        trabajo de narrativa del modo lazy (process_narrative_job).
+        """
+        if self.result_cache is None:
+            return self._generate_narrative(text, usage)
+        data = self.result_cache.get_or_compute(
+            self._result_cache_key(text, "narrative"),
+            lambda: {"narrative_summary": self._generate_narrative(text, usage)}
+        )
+        return data["narrative_summary"]
+    
+    def _narrative_mode(self) -> str:
+        """
+        LLM_NARRATIVE_MODE validado.
+        """
+        if settings.llm_narrative_mode not in NARRATIVE_MODES:
+            raise ValueError(
+                f"LLM_NARRATIVE_MODE desconocido: {settings.llm_narrative_mode} "
+                f"(opciones: {', '.join(NARRATIVE_MODES)})"
+            )
+        return settings.llm_narrative_mode
+    
+    def _cached_summary(self, text: str, part: str, compute: Callable[[], ClinicalSummary]) -> ClinicalSummary:
+        """
+        Resumen de la caché de resultados o, si no está, calculado con compute.
+        """
+        if self.result_cache is None:
+            return compute()
+        # created_at se excluye: cada resumen devuelto lleva su propia fecha
+        data = self.result_cache.get_or_compute(
+            self._result_cache_key(text, part),
+            lambda: compute().model_dump(mode="json", exclude={"created_at"})
+        )
+        return ClinicalSummary(**data)
+    
+    def _result_cache_key(self, text: str, part: str = "combined") -> str:
+        """
+        Clave de la caché de resultados para un texto.
+        
+        part distingue la llamada única ("combined") de las desacopladas
+        ("structured" y "narrative"): son prompts distintos.
+        """
+        return make_cache_key(
+            normalize_text(text),
+            part,
+            self.llm_backend.identity,
+            settings.openai_model,
+            PROMPT_VERSION,
+            LLM_TEMPERATURE,
+            # Dividir en otros fragmentos da otro resultado
+            settings.llm_chunk_max_tokens,
+            settings.llm_chunk_overlap_tokens,
+            # Otro esquema de salida es otro prompt
+            schema_id(settings.llm_output_schema)
+        )
+    
+    async def aprocess_clinical_text(
+        self,
+        text: str,
+        on_partial: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        usage: Optional[Dict[str, int]] = None,
+        on_structured: Optional[Callable[[ClinicalSummary], Awaitable[None]]] = None
+    ) -> ClinicalSummary:
+        """
+        Versión asíncrona de process_clinical_text (worker asyncio).
+        
+        Mientras esperamos la respuesta del LLM el event loop atiende otros
+        trabajos, así un proceso mantiene decenas de llamadas en vuelo.
+        
+        Args:
+            text: Texto de la conversación clínica
+            on_partial: Corrutina opcional que recibe los campos ya extraídos
+            limiter: Limitador de concurrencia compartido por los trabajos del proceso
+            usage: Acumulador de llamadas y tokens (como en process_clinical_text)
+            on_structured: Corrutina opcional que recibe los campos estructurados
+                           en cuanto están (como en process_clinical_text)
+        """
+        mode = self._narrative_mode()
+        if mode == "combined":
+            summary = await self._acached_summary(
+                text, "combined", lambda: self._aextract_clinical_summary(text, on_partial, limiter, usage)
+            )
+            if on_structured is not None:
+                await on_structured(summary)
+            return summary
+        
+        # Como en process_clinical_text, la narrativa acumula su uso aparte
+        narrative_task = None
+        narrative_usage: Dict[str, int] = {}
+        if mode == "concurrent":
+            narrative_task = asyncio.create_task(
+                self.agenerate_narrative(text, limiter, narrative_usage if usage is not None else None)
+            )
+        try:
+            structured = await self._acached_summary(
+                text,
+                "structured",
+                lambda: self._aextract_clinical_summary(text, on_partial, limiter, usage, narrative=False)
+            )
+            if on_structured is not None:
+                await on_structured(structured)
+        except BaseException:
+            if narrative_task is not None:
+                # Cancelamos la narrativa y esperamos a que termine: no puede
+                # seguir escribiendo en usage después de guardar las métricas
+                narrative_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await narrative_task
+                self._merge_usage(usage, narrative_usage)
+            raise
+        if narrative_task is None:
+            return structured
+        try:
+            return structured.model_copy(update={"narrative_summary": await narrative_task})
+        finally:
+            self._merge_usage(usage, narrative_usage)
+    
+    async def agenerate_narrative(
+        self,
+        text: str,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        usage: Optional[Dict[str, int]] = None
+    ) -> str:
+        """
+        Versión asíncrona de generate_narrative.
+        """
+        if self.result_cache is None:
+            return await self._agenerate_narrative(text, limiter, usage)
+        
+        async def compute():
+            return {"narrative_summary": await self._agenerate_narrative(text, limiter, usage)}
+        
+        data = await self.result_cache.aget_or_compute(self._result_cache_key(text, "narrative"), compute)
+        return data["narrative_summary"]
+    
+    async def _acached_summary(
+        self,
+        text: str,
+        part: str,
+        compute: Callable[[], Awaitable[ClinicalSummary]]
+    ) -> ClinicalSummary:
+        """
+        Versión asíncrona de _cached_summary.
+        """
+        if self.result_cache is None:
+            return await compute()
+        
+        async def compute_data():
+            summary = await compute()
+            return summary.model_dump(mode="json", exclude={"created_at"})
+        
+        data = await self.result_cache.aget_or_compute(self._result_cache_key(text, part), compute_data)
+        return ClinicalSummary(**data)
+    
+    async def aprocess_packed_text(
+        self,
+        text: str,
+        packer: JobPacker,
+        usage: Optional[Dict[str, int]] = None
+    ) -> ClinicalSummary:
+        """
+        Como aprocess_clinical_text (llamada combinada), pero compartiendo la
+        llamada al LLM con otros trabajos cortos (worker asyncio con
+        LLM_PACK_MAX_JOBS > 1).
+        
+        La caché se consulta antes de entrar en el grupo: un texto ya
+        procesado no ocupa sitio en la petición.
+        """
+        return await self._acached_summary(text, "combined", lambda: packer.submit((text, usage)))
+    
+    async def aextract_packed(
+        self,
+        items: List[Tuple[str, Optional[Dict[str, int]]]],
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None
+    ) -> List[ClinicalSummary]:
+        """
+        Extrae varias conversaciones cortas con una sola llamada al LLM.
+        
+        Args:
+            items: Pares (texto, acumulador de uso) de cada trabajo del grupo
+            limiter: Limitador de concurrencia del worker
+        
+        Returns:
+            Un ClinicalSummary por conversación, en el mismo orden
+        
+        Explicación:
+            1. Un prompt con todas las conversaciones numeradas y una sola
+               copia de las instrucciones; la respuesta es una lista JSON
+               con el "id" (número) de cada conversación
+            2. El uso de la llamada se reparte a partes iguales entre los
+               trabajos (marcado como estimado)
+            3. Las conversaciones que faltan en la respuesta, o toda la
+               respuesta si no es una lista JSON válida, se extraen con una
+               llamada individual cada una
+        """
+        texts = [text for text, _ in items]
+        if len(items) == 1:
+            text, usage = items[0]
+            return [await self._aextract_clinical_summary(text, None, limiter, usage)]
+        
+        pack_usage: Dict[str, int] = {}
+        try:
+            llm_response = await self._acall_llm(
+                [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": self._build_packed_prompt(texts)}],
+                None,
+                limiter,
+                pack_usage,
+                max_tokens=settings.llm_pack_output_tokens_per_job * len(texts)
+            )
+            results = self._parse_packed_response(llm_response, len(texts))
+        except Exception as e:
+            logger.warning(f"Llamada agrupada de {len(texts)} trabajos fallida ({str(e)}), extracción individual")
+            results = [None] * len(texts)
+        self._split_usage(pack_usage, [usage for _, usage in items], len(texts))
+        
+        missing = [index for index, summary in enumerate(results) if summary is None]
+        if missing:
+            logger.warning(f"Respuesta agrupada incompleta: {len(missing)} de {len(texts)} trabajos con llamada individual")
+            fallbacks = await asyncio.gather(*(
+                self._aextract_clinical_summary(items[index][0], None, limiter, items[index][1]) for index in missing
+            ))
+            for index, summary in zip(missing, fallbacks):
+                results[index] = summary
+        return results
+    
+    def _parse_packed_response(self, llm_response: str, count: int) -> List[Optional[ClinicalSummary]]:
+        """
+        Resúmenes de una respuesta agrupada, por número de conversación.
+        
+        Devuelve None para las conversaciones que no vienen (o no se pueden
+        leer). Si la respuesta se cortó en max_tokens, reparamos la lista y
+        descartamos su último objeto: es el que se estaba escribiendo.
+        """
+        results: List[Optional[ClinicalSummary]] = [None] * count
+        begin = llm_response.find("[")
+        end = llm_response.rfind("]") + 1
+        if begin < 0:
+            return results
+        data = None
+        if begin < end:
+            try:
+                data = loads(llm_response[begin:end])
+            except ValueError:
+                data = None
+        if not isinstance(data, list):
+            repaired = repair_truncated_json(llm_response[begin:])
+            try:
+                data = loads(repaired)[:-1] if repaired else None
+            except ValueError:
+                data = None
+            if not isinstance(data, list):
+                return results
+            logger.warning(f"Respuesta agrupada cortada ({len(llm_response)} caracteres), lista reparada")
+        
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            item = dict(item)
+            try:
+                index = int(item.pop("id")) - 1
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= index < count and results[index] is None:
+                results[index] = self._validate_summary(item)
+        return results
+    
+    def _split_usage(self, pack_usage: Dict[str, int], usages: List[Optional[Dict[str, int]]], count: int):
+        """
+        Reparte el uso de una llamada agrupada entre sus trabajos.
+        
+        Cada trabajo cuenta la llamada y su parte de los tokens; llm_pack_size
+        indica con cuántos trabajos la compartió.
+        """
+        if not pack_usage:
+            return
+        with _usage_lock:
+            for usage in usages:
+                if usage is None:
+                    continue
+                usage["llm_calls"] = usage.get("llm_calls", 0) + 1
+                usage["llm_prompt_tokens"] = usage.get("llm_prompt_tokens", 0) + pack_usage.get("llm_prompt_tokens", 0) // count
+                usage["llm_completion_tokens"] = usage.get("llm_completion_tokens", 0) + pack_usage.get("llm_completion_tokens", 0) // count
+                usage["llm_usage_estimated"] = 1
+                usage["llm_pack_size"] = count
+    
+    def build_batch_requests(self, text: str) -> List[Dict[str, Any]]:
+        """
+        Cuerpos de chat.completions de un trabajo diferido (Batch API).
+        
+        Un cuerpo por fragmento (map-reduce si la conversación es larga),
+        con la llamada combinada: en un lote no hay prisa por los campos
+        estructurados, así que la narrativa va en la misma petición.
+        """
+        chunks = self._chunk_conversation(text)
+        return [
+            {
+                "model": settings.openai_model,
+                "messages": self._build_messages(chunk, part=(index + 1, len(chunks)) if len(chunks) > 1 else None),
+                "temperature": LLM_TEMPERATURE,
+                "max_tokens": LLM_MAX_TOKENS
+            }
+            for index, chunk in enumerate(chunks)
+        ]
+    
+    def parse_batch_responses(
+        self,
+        text: str,
+        bodies: List[Dict[str, Any]],
+        usage: Optional[Dict[str, int]] = None
+    ) -> ClinicalSummary:
+        """
+        ClinicalSummary de un trabajo diferido a partir de las respuestas
+        del lote (una por cuerpo de build_batch_requests, en el mismo orden).
+        
+        El resultado (el que acaba de pagar el trabajo) se guarda en la caché
+        de resultados como el de una llamada combinada, sustituyendo al que
+        hubiera: un reenvío interactivo del mismo texto lo reutiliza.
+        """
+        chunks = self._chunk_conversation(text)
+        if len(bodies) != len(chunks):
+            raise ValueError(f"Se esperaban {len(chunks)} respuestas del lote y llegaron {len(bodies)}")
+        summaries = []
+        for index, (chunk, body) in enumerate(zip(chunks, bodies)):
+            content = body["choices"][0]["message"]["content"]
+            response_usage = body.get("usage")
+            self._record_usage(
+                usage,
+                self._build_messages(chunk, part=(index + 1, len(chunks)) if len(chunks) > 1 else None),
+                content,
+                SimpleNamespace(**response_usage) if response_usage else None
+            )
+            summaries.append(self._parse_llm_response(chunk, content))
+        summary = merge_summaries(summaries)
+        if self.result_cache is not None:
+            self.result_cache.set(
+                self._result_cache_key(text, "combined"),
+                summary.model_dump(mode="json", exclude={"created_at"})
+            )
+        return summary
+    
+    async def _aextract_clinical_summary(
+        self,
+        text: str,
+        on_partial: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        usage: Optional[Dict[str, int]] = None,
+        narrative: bool = True
+    ) -> ClinicalSummary:
+        """
+        Versión asíncrona de _extract_clinical_summary (sin caché).
+        """
+        logger.info(f"Procesando texto clínico: {len(text)} caracteres")
+        chunks = self._chunk_conversation(text)
+        if len(chunks) > 1:
+            return await self._aextract_chunked(chunks, on_partial, limiter, usage, narrative)
+        messages = self._build_messages(text, narrative=narrative)
+        llm_response = await self._acall_llm(
+            messages, on_partial, limiter, usage, max_tokens=self._extraction_max_tokens(narrative)
+        )
+        logger.info(f"Respuesta del LLM recibida: {len(llm_response)} caracteres")
+        return self._parse_llm_response(text, llm_response)
+    
+    async def _aextract_chunked(
+        self,
+        chunks: List[str],
+        on_partial: Optional[Callable[[Dict[str, Any]], Awaitable[None]]],
+        limiter: Optional[AdaptiveConcurrencyLimiter],
+        usage: Optional[Dict[str, int]] = None,
+        narrative: bool = True
+    ) -> ClinicalSummary:
+        """
+        Versión asíncrona de _extract_chunked: los fragmentos se lanzan a la
+        vez y el limitador decide cuántos están realmente en vuelo.
+        """
+        results: Dict[int, ClinicalSummary] = {}
+        
+        async def extract(index: int, chunk: str):
+            messages = self._build_messages(chunk, part=(index + 1, len(chunks)), narrative=narrative)
+            llm_response = await self._acall_llm(
+                messages, None, limiter, usage, max_tokens=self._extraction_max_tokens(narrative)
+            )
+            results[index] = self._parse_llm_response(chunk, llm_response)
+            if on_partial is not None:
+                try:
+                    await on_partial(self._merged_partial(results))
+                except Exception as e:
+                    logger.warning(f"No se pudo publicar el resultado parcial: {str(e)}")
+        
+        await asyncio.gather(*(extract(index, chunk) for index, chunk in enumerate(chunks)))
+        return merge_summaries([results[index] for index in range(len(chunks))])
+    
+    async def _acall_llm(
+        self,
+        messages: List[Dict[str, str]],
+        on_partial: Optional[Callable[[Dict[str, Any]], Awaitable[None]]],
+        limiter: Optional[AdaptiveConcurrencyLimiter],
+        usage: Optional[Dict[str, int]] = None,
+        max_tokens: int = LLM_MAX_TOKENS
+    ) -> str:
+        """
+        Llama al LLM con el cliente asíncrono, dentro del limitador.
+        
+        Explicación:
+            1. Cada llamada ocupa un hueco del limitador mientras dura
+               (incluida la lectura del stream)
+            2. Si el proveedor responde 429/503, el limitador reduce la
+               concurrencia y reintentamos con espera exponencial (con jitter,
+               para que los trabajos rechazados no vuelvan todos a la vez)
+        """
+        for attempt in range(settings.llm_max_retries + 1):
+            slot = limiter.slot() if limiter is not None else contextlib.nullcontext()
+            try:
+                async with slot:
+                    if on_partial is not None and settings.llm_streaming:
+                        content = await self._astream_completion(messages, on_partial, max_tokens)
+                        self._record_usage(usage, messages, content)
+                        return content
+                    response = await self.async_openai_client.chat.completions.create(
+                        model=settings.openai_model,
+                        messages=messages,
+                        temperature=LLM_TEMPERATURE,
+                        max_tokens=max_tokens
+                    )
+                    content = response.choices[0].message.content
+                    self._record_usage(usage, messages, content, response.usage)
+                    return content
+            except Exception as e:
+                if not is_overload_error(e) or attempt == settings.llm_max_retries:
+                    raise
+                delay = settings.llm_retry_base_seconds * (2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"LLM saturado ({str(e)}), reintento {attempt + 1} en {delay:.1f} s")
+                await asyncio.sleep(delay)
+    
+    async def _astream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        on_partial: Callable[[Dict[str, Any]], Awaitable[None]],
+        max_tokens: int = LLM_MAX_TOKENS
+    ) -> str:
+        """
+        Versión asíncrona de _stream_completion.
+        """
+        stream = await self.async_openai_client.chat.completions.create(
+            model=settings.openai_model,
+            messages=messages,
+            temperature=LLM_TEMPERATURE,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        parser = IncrementalJSONObjectParser()
+        parts = []
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if parser.feed(delta):
+                    try:
+                        await on_partial(decode_output(dict(parser.fields)))
+                    except Exception as e:
+                        logger.warning(f"No se pudo publicar el resultado parcial: {str(e)}")
+                if parser.done:
+                    break
+        finally:
+            await stream.response.aclose()
+        
+        return "".join(parts)
+    
+    def _extract_clinical_summary(
+        self,
+        text: str,
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        usage: Optional[Dict[str, int]] = None,
+        narrative: bool = True
+    ) -> ClinicalSummary:
+        """
+        Llama al LLM y construye el ClinicalSummary (sin caché).
+        
+        Con narrative=False se piden sólo los campos estructurados
+        (narrative_summary queda vacío).
         """
         logger.info(f"Procesando texto clínico: {len(text)} caracteres")
         
+        # Conversaciones más largas que LLM_CHUNK_MAX_TOKENS: map-reduce
+        chunks = self._chunk_conversation(text)
+        if len(chunks) > 1:
+            return self._extract_chunked(chunks, on_partial, usage, narrative)
+        
         # Construir prompt para el LLM
         # El prompt es crítico - le dice al LLM qué hacer y cómo estructurar la respuesta
-        prompt = self._build_clinical_prompt(text)
+        messages = self._build_messages(text, narrative=narrative)
         
         # Llamar a la API de OpenAI
         # Esta es la llamada de inference - el LLM procesa el prompt
         # y genera una respuesta. Esto puede tardar 5-30 segundos dependiendo
         # de la complejidad del texto y el modelo usado.
         logger.info("Enviando prompt a LLM...")
-        response = self.openai_client.chat.completions.create(
-            model=settings.openai_model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Eres un asistente médico experto que extrae información estructurada de conversaciones clínicas."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.3,  # Baja temperatura para respuestas más consistentes
-            max_tokens=2000  # Límite de tokens en la respuesta
-        )
-        
-        # Extraer texto de la respuesta
-        llm_response = response.choices[0].message.content
+        llm_response = self._call_llm(messages, on_partial, usage, self._extraction_max_tokens(narrative))
         logger.info(f"Respuesta del LLM recibida: {len(llm_response)} caracteres")
         
         # Parsear respuesta y construir ClinicalSummary
@@ -145,21 +848,326 @@ class ClinicalAgent:
         
         return clinical_summary
     
-    def _build_clinical_prompt(self, text: str) -> str:
+    def _call_llm(
+        self,
+        messages: List[Dict[str, str]],
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        usage: Optional[Dict[str, int]] = None,
+        max_tokens: int = LLM_MAX_TOKENS
+    ) -> str:
+        """
+        Llama al LLM con el cliente síncrono y devuelve el texto de la respuesta.
+        """
+        if on_partial is not None and settings.llm_streaming:
+            content = self._stream_completion(messages, on_partial, max_tokens)
+            self._record_usage(usage, messages, content)
+            return content
+        response = self.openai_client.chat.completions.create(
+            model=settings.openai_model,
+            messages=messages,
+            temperature=LLM_TEMPERATURE,
+            max_tokens=max_tokens
+        )
+        # Extraer texto de la respuesta
+        content = response.choices[0].message.content
+        self._record_usage(usage, messages, content, response.usage)
+        return content
+    
+    def _record_usage(
+        self,
+        usage: Optional[Dict[str, int]],
+        messages: List[Dict[str, str]],
+        content: str,
+        response_usage: Any = None
+    ):
+        """
+        Suma una llamada al LLM al acumulador de uso.
+        
+        Con respuesta completa usamos response.usage (lo que factura el
+        proveedor). En streaming la API no envía usage (y además cortamos el
+        stream al cerrarse el JSON), así que contamos localmente con
+        app/tokens.py y marcamos el uso como estimado.
+        
+        Claves: llm_calls, llm_prompt_tokens, llm_completion_tokens y
+        llm_usage_estimated (1 si alguna llamada se contó localmente).
+        """
+        if usage is None:
+            return
+        if response_usage is not None:
+            prompt_tokens = response_usage.prompt_tokens or 0
+            completion_tokens = response_usage.completion_tokens or 0
+            estimated = False
+        else:
+            prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+            completion_tokens = count_tokens(content or "")
+            estimated = True
+        with _usage_lock:
+            usage["llm_calls"] = usage.get("llm_calls", 0) + 1
+            usage["llm_prompt_tokens"] = usage.get("llm_prompt_tokens", 0) + prompt_tokens
+            usage["llm_completion_tokens"] = usage.get("llm_completion_tokens", 0) + completion_tokens
+            if estimated:
+                usage["llm_usage_estimated"] = 1
+    
+    def _merge_usage(self, usage: Optional[Dict[str, int]], other: Dict[str, int]):
+        """
+        Suma al acumulador de uso el de otra llamada (con su propio acumulador).
+        """
+        if usage is None or not other:
+            return
+        with _usage_lock:
+            for name, value in other.items():
+                if name == "llm_usage_estimated":
+                    usage[name] = max(usage.get(name, 0), value)
+                else:
+                    usage[name] = usage.get(name, 0) + value
+    
+    def _chunk_conversation(self, text: str) -> List[str]:
+        """
+        Fragmentos de la conversación ([text] si cabe en una sola llamada).
+        """
+        chunks = chunk_conversation(
+            text,
+            max_tokens=settings.llm_chunk_max_tokens,
+            overlap_tokens=settings.llm_chunk_overlap_tokens
+        )
+        if len(chunks) > 1:
+            logger.info(f"Conversación larga: extracción map-reduce en {len(chunks)} fragmentos")
+        return chunks
+    
+    def _extraction_max_tokens(self, narrative: bool) -> int:
+        """
+        Límite de tokens de la respuesta: la llamada combinada conserva
+        LLM_MAX_TOKENS; la estructurada tiene el suyo.
+        """
+        return LLM_MAX_TOKENS if narrative else settings.llm_structured_max_tokens
+    
+    def _generate_narrative(self, text: str, usage: Optional[Dict[str, int]] = None) -> str:
+        """
+        Llama al LLM para obtener sólo el resumen narrativo (sin caché).
+        
+        Una conversación larga se narra por fragmentos (en paralelo, como
+        en _extract_chunked) y los textos se unen en orden.
+        """
+        chunks = self._chunk_conversation(text)
+        
+        def narrate(index: int, chunk: str) -> str:
+            part = (index + 1, len(chunks)) if len(chunks) > 1 else None
+            messages = self._build_narrative_messages(chunk, part)
+            llm_response = self._call_llm(messages, usage=usage, max_tokens=settings.llm_narrative_max_tokens)
+            return self._parse_narrative_response(llm_response)
+        
+        if len(chunks) == 1:
+            return narrate(0, text)
+        workers = max(1, min(settings.llm_chunk_concurrency, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-narrative-chunk") as executor:
+            narratives = list(executor.map(narrate, range(len(chunks)), chunks))
+        return " ".join(narrative for narrative in narratives if narrative)
+    
+    async def _agenerate_narrative(
+        self,
+        text: str,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        usage: Optional[Dict[str, int]] = None
+    ) -> str:
+        """
+        Versión asíncrona de _generate_narrative.
+        """
+        chunks = self._chunk_conversation(text)
+        
+        async def narrate(index: int, chunk: str) -> str:
+            part = (index + 1, len(chunks)) if len(chunks) > 1 else None
+            messages = self._build_narrative_messages(chunk, part)
+            llm_response = await self._acall_llm(
+                messages, None, limiter, usage, max_tokens=settings.llm_narrative_max_tokens
+            )
+            return self._parse_narrative_response(llm_response)
+        
+        narratives = await asyncio.gather(*(narrate(index, chunk) for index, chunk in enumerate(chunks)))
+        return " ".join(narrative for narrative in narratives if narrative)
+    
+    def _extract_chunked(
+        self,
+        chunks: List[str],
+        on_partial: Optional[Callable[[Dict[str, Any]], None]] = None,
+        usage: Optional[Dict[str, int]] = None,
+        narrative: bool = True
+    ) -> ClinicalSummary:
+        """
+        Extrae cada fragmento por separado y combina los resultados (map-reduce).
+        
+        Explicación:
+            1. Cada fragmento es una llamada independiente al LLM; las lanzamos
+               en un pool de LLM_CHUNK_CONCURRENCY hilos (casi todo es espera de red)
+            2. Cada vez que termina un fragmento publicamos como resultado
+               parcial la combinación de los que ya terminaron
+            3. merge_summaries combina los resúmenes en el orden de los
+               fragmentos, no en el de llegada: el resultado es determinista
+        """
+        results: Dict[int, ClinicalSummary] = {}
+        
+        def extract(index: int, chunk: str) -> ClinicalSummary:
+            messages = self._build_messages(chunk, part=(index + 1, len(chunks)), narrative=narrative)
+            llm_response = self._call_llm(messages, usage=usage, max_tokens=self._extraction_max_tokens(narrative))
+            return self._parse_llm_response(chunk, llm_response)
+        
+        workers = max(1, min(settings.llm_chunk_concurrency, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-chunk") as executor:
+            futures = {executor.submit(extract, index, chunk): index for index, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if on_partial is not None:
+                    try:
+                        on_partial(self._merged_partial(results))
+                    except Exception as e:
+                        logger.warning(f"No se pudo publicar el resultado parcial: {str(e)}")
+        
+        return merge_summaries([results[index] for index in range(len(chunks))])
+    
+    def _merged_partial(self, results: Dict[int, ClinicalSummary]) -> Dict[str, Any]:
+        """
+        Resultado parcial de un map-reduce: la combinación de los fragmentos terminados.
+        """
+        merged = merge_summaries([results[index] for index in sorted(results)])
+        return merged.model_dump(mode="json", exclude={"created_at"})
+    
+    def _stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        on_partial: Callable[[Dict[str, Any]], None],
+        max_tokens: int = LLM_MAX_TOKENS
+    ) -> str:
+        """
+        Llama al LLM en modo streaming y publica los campos según llegan.
+        
+        Explicación:
+            1. Con stream=True recibimos la respuesta en fragmentos de tokens
+            2. El parser incremental detecta cada campo de primer nivel completo
+               (patient_age, symptoms, ...) y llamamos a on_partial con los
+               campos acumulados
+            3. En cuanto el objeto JSON se cierra dejamos de leer y cerramos
+               la conexión, sin esperar texto adicional del modelo
+        
+        Returns:
+            El texto recibido (para el parseo final con _parse_llm_response)
+        """
+        stream = self.openai_client.chat.completions.create(
+            model=settings.openai_model,
+            messages=messages,
+            temperature=LLM_TEMPERATURE,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        parser = IncrementalJSONObjectParser()
+        parts = []
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if parser.feed(delta):
+                    try:
+                        on_partial(decode_output(dict(parser.fields)))
+                    except Exception as e:
+                        # Un fallo al publicar parciales no debe detener la extracción
+                        logger.warning(f"No se pudo publicar el resultado parcial: {str(e)}")
+                if parser.done:
+                    break
+        finally:
+            stream.response.close()
+        
+        return "".join(parts)
+    
+    def _build_messages(
+        self,
+        text: str,
+        part: Optional[Tuple[int, int]] = None,
+        narrative: bool = True
+    ) -> List[Dict[str, str]]:
+        """
+        Mensajes (system + user) que se envían al LLM para un texto.
+        
+        part = (i, n) indica que el texto es el fragmento i de n de una
+        conversación más larga (extracción map-reduce). Con narrative=False
+        el prompt no pide el resumen narrativo.
+        """
+        return [
+            {
+                "role": "system",
+                "content": SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": self._build_clinical_prompt(text, part, narrative)
+            }
+        ]
+    
+    def _build_narrative_messages(self, text: str, part: Optional[Tuple[int, int]] = None) -> List[Dict[str, str]]:
+        """
+        Mensajes de la llamada que sólo genera el resumen narrativo.
+        """
+        return [
+            {
+                "role": "system",
+                "content": NARRATIVE_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": self._build_narrative_prompt(text, part)
+            }
+        ]
+    
+    def _fragment_note(self, part: Optional[Tuple[int, int]]) -> str:
+        """
+        Aviso de que el texto es un fragmento de una consulta más larga.
+        """
+        if part is None:
+            return ""
+        return (
+            f"\nEste texto es el fragmento {part[0]} de {part[1]} de una consulta más larga. "
+            "Extrae sólo la información que aparece en este fragmento.\n"
+        )
+    
+    def _build_clinical_prompt(
+        self,
+        text: str,
+        part: Optional[Tuple[int, int]] = None,
+        narrative: bool = True
+    ) -> str:
         """
         Construye el prompt para el LLM.
         
         Un buen prompt es esencial para obtener resultados útiles del LLM.
         Le decimos explícitamente qué información extraer y cómo estructurarla.
         """
+        fragment_note = self._fragment_note(part)
+        # Formato de la respuesta (LLM_OUTPUT_SCHEMA, ver app/output_schema.py)
+        schema = get_output_schema(settings.llm_output_schema)
+        output_template = schema["template"] if narrative else schema["structured_template"]
         prompt = f"""
 Analiza la siguiente conversación clínica y extrae información estructurada.
-
+{fragment_note}
 CONVERSACIÓN:
 {text}
 
 Por favor, extrae y estructura la siguiente información:
-
+{self._extraction_instructions(narrative)}
+{output_template}"""
+        return prompt
+    
+    def _extraction_instructions(self, narrative: bool = True) -> str:
+        """
+        Lista de campos a extraer (la comparten el prompt individual y el agrupado).
+        """
+        narrative_section = ""
+        if narrative:
+            narrative_section = """
+5. RESUMEN NARRATIVO:
+   Un resumen claro y conciso de la conversación en lenguaje médico profesional.
+"""
+        return f"""
 1. INFORMACIÓN DEL PACIENTE:
    - Edad (si está disponible)
    - Género (si está disponible)
@@ -176,28 +1184,47 @@ Por favor, extrae y estructura la siguiente información:
 
 4. CONDICIONES RELEVANTES:
    Lista de condiciones médicas mencionadas o sugeridas
+{narrative_section}"""
+    
+    def _build_packed_prompt(self, texts: List[str]) -> str:
+        """
+        Prompt de una llamada agrupada: varias conversaciones cortas, cada
+        una con su número, y una única copia de las instrucciones.
+        
+        Numeramos las conversaciones (1..N) en lugar de usar los job_id:
+        un UUID son ~20 tokens que el modelo tendría que copiar en la respuesta.
+        """
+        output_template = get_output_schema(settings.llm_output_schema)["template"]
+        conversations = "\n\n".join(
+            f"{PACKED_CONVERSATION_HEADER} {number} ===\n{text}" for number, text in enumerate(texts, 1)
+        )
+        return f"""
+Analiza las siguientes {len(texts)} conversaciones clínicas, independientes entre sí, y extrae información estructurada de cada una.
 
-5. RESUMEN NARRATIVO:
-   Un resumen claro y conciso de la conversación en lenguaje médico profesional.
+{conversations}
 
-Responde en formato JSON con la siguiente estructura:
-{{
-    "patient_age": <número o null>,
-    "patient_gender": "<texto o null>",
-    "symptoms": [
-        {{
-            "name": "<nombre del síntoma>",
-            "duration": "<duración>",
-            "severity": "<severidad>",
-            "description": "<descripción>"
-        }}
-    ],
-    "risk_factors": ["<factor1>", "<factor2>"],
-    "relevant_conditions": ["<condición1>", "<condición2>"],
-    "narrative_summary": "<resumen narrativo>"
-}}
+Por favor, extrae y estructura de CADA conversación la siguiente información:
+{self._extraction_instructions()}
+Responde con una lista JSON con un objeto por conversación, en el mismo orden. Cada objeto lleva la clave "id" con el número de su conversación y los campos de esta estructura:
+{output_template}"""
+    
+    def _build_narrative_prompt(self, text: str, part: Optional[Tuple[int, int]] = None) -> str:
+        """
+        Prompt de la llamada que sólo redacta el resumen narrativo.
+        
+        Pedimos texto plano: sin JSON no hay claves ni comillas que generar.
+        """
+        return f"""
+Redacta un resumen narrativo de la siguiente conversación clínica.
+{self._fragment_note(part)}
+CONVERSACIÓN:
+{text}
+
+Por favor, redacta un resumen claro y conciso de la conversación en lenguaje médico profesional:
+edad y género si constan, motivo de consulta, síntomas con su duración y severidad, y antecedentes.
+
+Responde sólo con el texto del resumen, sin JSON ni encabezados.
 """
-        return prompt
     
     def _parse_llm_response(self, original_text: str, llm_response: str) -> ClinicalSummary:
         """
@@ -205,42 +1232,137 @@ Responde en formato JSON con la siguiente estructura:
         
         En producción, podríamos usar JSON mode de OpenAI para obtener
         JSON directamente, pero por ahora parseamos el texto.
+        
+        Explicación:
+            1. Ruta rápida (el caso habitual): el objeto va de la primera "{"
+               a la última "}". Lo decodificamos (orjson si está instalado) y
+               lo validamos con ClinicalSummary.model_validate
+            2. Si eso falla, find_json_object localiza el objeto siguiendo las
+               llaves (texto con llaves sueltas antes o después del JSON)
+            3. Si la respuesta se cortó en max_tokens, repair_truncated_json
+               cierra el objeto: conservamos los campos que sí llegaron en
+               lugar de perder toda la extracción
+            4. Si el JSON no cumple el esquema (null en una lista, un síntoma
+               sin nombre...), lo normalizamos campo a campo
+        
+        La respuesta puede venir en cualquier esquema de salida ("full" o
+        "compact"): _validate_summary la decodifica.
         """
-        import json
-        import re
+        begin = llm_response.find("{")
+        end = llm_response.rfind("}") + 1
+        if 0 <= begin < end:
+            try:
+                data = loads(llm_response[begin:end])
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                return self._validate_summary(data)
         
-        # Intentar extraer JSON de la respuesta
-        # El LLM puede devolver texto con JSON embebido
-        json_match = re.search(r'\{.*\}', llm_response, re.DOTALL)
-        if json_match:
+        start, end, complete = find_json_object(llm_response)
+        while start is not None:
+            candidate = llm_response[start:end]
+            if not complete:
+                candidate = repair_truncated_json(candidate)
+                if candidate is None:
+                    break
+                logger.warning(f"Respuesta del LLM cortada ({len(llm_response)} caracteres), JSON reparado")
             try:
-                data = json.loads(json_match.group())
-            except json.JSONDecodeError:
-                logger.warning("No se pudo parsear JSON, usando valores por defecto")
-                data = {}
-        else:
-            logger.warning("No se encontró JSON en la respuesta, usando valores por defecto")
-            data = {}
+                data = loads(candidate)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                return self._validate_summary(data)
+            # Una "{" suelta antes del JSON real: probamos con la siguiente
+            start, end, complete = find_json_object(llm_response, start + 1)
+        
+        logger.warning("No se encontró JSON válido en la respuesta, usando valores por defecto")
+        return ClinicalSummary(narrative_summary=llm_response)  # Fallback al texto completo
+    
+    def _parse_narrative_response(self, llm_response: str) -> str:
+        """
+        Texto del resumen narrativo (sin espacios ni comillas alrededor).
+        """
+        return (llm_response or "").strip().strip('"').strip()
+    
+    def _validate_summary(self, data: Dict[str, Any]) -> ClinicalSummary:
+        """
+        Valida el JSON del LLM de una vez; si no cumple el esquema, lo normaliza.
+        
+        Antes traducimos el esquema de salida compacto (claves de una letra,
+        síntomas como listas) a los campos de ClinicalSummary.
+        """
+        data = decode_output(data)
+        # La llamada estructurada no pide narrativa: no es un error de esquema
+        data.setdefault("narrative_summary", "")
+        try:
+            return ClinicalSummary.model_validate(data)
+        except ValidationError:
+            return self._summary_from_data(data)
+    
+    def _summary_from_data(self, data: Dict[str, Any]) -> ClinicalSummary:
+        """
+        Construye el ClinicalSummary desde un JSON que no cumple el esquema
+        exacto, tolerando nulls, síntomas sin nombre, edades como texto y
+        valores de otro tipo (una severidad 3 pasa a "3"): es el último
+        recurso antes de dar el trabajo por fallido.
+        """
+        def text(value: Any) -> Optional[str]:
+            return None if value is None else str(value)
+        
+        def text_list(value: Any) -> List[str]:
+            if value is None:
+                return []
+            if not isinstance(value, list):
+                value = [value]
+            return [str(item) for item in value if item is not None]
         
         # Construir lista de síntomas
         symptoms = []
-        for symptom_data in data.get("symptoms", []):
+        symptoms_data = data.get("symptoms")
+        for symptom_data in symptoms_data if isinstance(symptoms_data, list) else []:
+            if not isinstance(symptom_data, dict):
+                continue
             symptoms.append(Symptom(
-                name=symptom_data.get("name", ""),
-                duration=symptom_data.get("duration"),
-                severity=symptom_data.get("severity"),
-                description=symptom_data.get("description")
+                name=str(symptom_data.get("name") or ""),
+                duration=text(symptom_data.get("duration")),
+                severity=text(symptom_data.get("severity")),
+                description=text(symptom_data.get("description"))
             ))
         
+        # "45", "45 años" -> 45; cualquier otra cosa -> None
+        patient_age = data.get("patient_age")
+        if isinstance(patient_age, bool):
+            patient_age = None
+        elif patient_age is not None and not isinstance(patient_age, int):
+            digits = re.match(r"\s*(\d+)", str(patient_age))
+            patient_age = int(digits.group(1)) if digits else None
+        
         # Construir ClinicalSummary
         summary = ClinicalSummary(
-            patient_age=data.get("patient_age"),
-            patient_gender=data.get("patient_gender"),
+            patient_age=patient_age,
+            patient_gender=text(data.get("patient_gender")),
             symptoms=symptoms,
-            risk_factors=data.get("risk_factors", []),
-            relevant_conditions=data.get("relevant_conditions", []),
-            narrative_summary=data.get("narrative_summary", llm_response)  # Fallback al texto completo
+            risk_factors=text_list(data.get("risk_factors")),
+            relevant_conditions=text_list(data.get("relevant_conditions")),
+            narrative_summary=text(data.get("narrative_summary")) or ""
         )
         
         return summary
 
+
+
+def _file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Hash SHA-256 de un archivo, leído por bloques.
+    
+    Los audios del almacén compartido ya se llaman como su hash,
+    así que en ese caso no hace falta leerlos.
+    """
+    name = os.path.basename(path)
+    if len(name) == 64 and all(c in "0123456789abcdef" for c in name):
+        return name
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,361 @@
+"""
+Worker asyncio: muchos trabajos de LLM en vuelo por proceso.
+
+El worker RQ (app/worker.py) procesa un trabajo por proceso y se queda
+bloqueado en el cliente síncrono de OpenAI durante toda la llamada al LLM.
+Un trabajo de sólo texto es casi todo espera de red: el proceso pasa
+5-30 segundos sin hacer nada.
+
+Este worker consume las mismas colas RQ, pero con asyncio:
+- AsyncOpenAI y redis.asyncio: mientras una llamada espera al LLM, el
+  event loop avanza con las demás
+- Un semáforo acotado (ASYNC_WORKER_MAX_JOBS) limita cuántos trabajos
+  sacamos de la cola a la vez; el resto sigue en Redis para otros workers
+- Un limitador adaptativo (AIMD, ver app/limiter.py) decide cuántas
+  llamadas al LLM hay en vuelo, y retrocede ante 429 o picos de latencia
+
+Normalmente escucha sólo extraction_jobs (los audios llegan ya transcritos
+desde transcription_jobs). Si recibe un audio sin transcribir, la
+transcripción (trabajo de CPU) se ejecuta en un único hilo aparte para no
+bloquear el event loop; Whisper se carga con el primer audio.
+
+Con LLM_PACK_MAX_JOBS > 1 (o --pack-size), las transcripciones cortas que
+llegan a la vez comparten una llamada al LLM (ver app/packing.py).
+
+Un trabajo sacado de la cola pasa a una lista "en vuelo" del worker hasta
+que termina (ver pop_rq_job_id_async). El worker anota un latido cada
+HEARTBEAT_INTERVAL segundos y, al arrancar y con cada latido, devuelve a
+su cola los trabajos de los workers sin latido reciente (muertos o
+matados por falta de memoria).
+
+Uso:
+    python -m app.async_worker extraction_jobs
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set
+
+from app.agent import ClinicalAgent
+from app.compaction import prepare_transcript
+from app.output_schema import schema_id
+from app.config import settings
+from app.limiter import AdaptiveConcurrencyLimiter
+from app.models import ClinicalSummary
+from app.packing import JobPacker
+from app.queue import (
+    EXTRACTION_QUEUE,
+    NARRATIVE_STATUS_ON_COMPLETE,
+    ack_rq_job_async,
+    get_job_status_async,
+    job_id_from_rq_id,
+    mark_rq_job_async,
+    pop_rq_job_id_async,
+    recover_processing_lists_async,
+    release_processing_lists_async,
+    stage_from_rq_id,
+    touch_processing_lists_async,
+    update_job_narrative_async,
+    update_job_partial_async,
+    update_job_status_async
+)
+from app.storage import resolve_audio_path
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Segundos de espera de BLMOVE antes de volver a comprobar si hay que parar
+POP_TIMEOUT = 5
+
+# Segundos entre latidos del worker (ver touch_processing_lists_async)
+HEARTBEAT_INTERVAL = 10
+
+
+class AsyncWorker:
+    """
+    Consume trabajos de las colas RQ y los procesa concurrentemente.
+    """
+
+    def __init__(self, queue_names: List[str], max_jobs: Optional[int] = None, pack_size: Optional[int] = None):
+        self.queue_names = queue_names
+        # Identifica las listas de trabajos en vuelo de este proceso
+        self.worker_id = uuid.uuid4().hex
+        self.max_jobs = max_jobs or settings.async_worker_max_jobs
+        self.agent = ClinicalAgent(load_whisper=False)
+        self.limiter = AdaptiveConcurrencyLimiter(
+            max_limit=self.max_jobs,
+            min_limit=settings.async_worker_min_concurrency,
+            initial_limit=min(settings.async_worker_initial_concurrency, self.max_jobs),
+            latency_spike_factor=settings.async_worker_latency_spike_factor
+        )
+        # Whisper no admite transcripciones simultáneas sobre el mismo modelo
+        self._transcription_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+        self._stopping = False
+        self._tasks: Set[asyncio.Task] = set()
+        # Agrupación de trabajos cortos en una sola llamada al LLM
+        pack_size = pack_size or settings.llm_pack_max_jobs
+        self.packer: Optional[JobPacker] = None
+        if pack_size > 1:
+            self.packer = JobPacker(
+                lambda items: self.agent.aextract_packed(items, self.limiter),
+                max_jobs=pack_size,
+                max_wait_seconds=settings.llm_pack_max_wait_ms / 1000
+            )
+
+    def stop(self):
+        """
+        Deja de sacar trabajos; los que están en vuelo terminan normalmente.
+        """
+        if not self._stopping:
+            logger.info("Parando: esperando a los trabajos en vuelo...")
+        self._stopping = True
+
+    async def run(self, burst: bool = False):
+        """
+        Bucle principal: saca un trabajo cada vez que hay un hueco libre.
+
+        Args:
+            burst: Si es True, termina cuando la cola queda vacía
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        slots = asyncio.BoundedSemaphore(self.max_jobs)
+        await touch_processing_lists_async(self.worker_id, self.queue_names)
+        await self._recover_dead_workers()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        logger.info(
+            f"Worker asyncio {self.worker_id} iniciado ({self.max_jobs} trabajos en vuelo como máximo). "
+            f"Escuchando colas: {', '.join(self.queue_names)}..."
+        )
+        try:
+            while not self._stopping:
+                # Esperamos un hueco ANTES de sacar el trabajo de Redis
+                await slots.acquire()
+                try:
+                    item = await pop_rq_job_id_async(self.queue_names, timeout=POP_TIMEOUT, worker_id=self.worker_id)
+                except Exception as e:
+                    slots.release()
+                    logger.error(f"Error leyendo la cola: {str(e)}")
+                    await asyncio.sleep(1)
+                    continue
+                if item is None:
+                    slots.release()
+                    if burst and not self._tasks:
+                        break
+                    continue
+
+                task = asyncio.create_task(self._run_job(*item))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await release_processing_lists_async(self.worker_id, self.queue_names)
+        finally:
+            heartbeat.cancel()
+            self._transcription_executor.shutdown(wait=False)
+            packs = f", grupos: {self.packer.stats}" if self.packer is not None else ""
+            logger.info(f"Worker asyncio detenido. Limitador: {self.limiter.stats}{packs}")
+
+    async def _recover_dead_workers(self):
+        recovered = await recover_processing_lists_async(settings.async_worker_heartbeat_timeout_seconds)
+        if recovered:
+            logger.warning(f"{recovered} trabajos de workers caídos devueltos a la cola")
+
+    async def _heartbeat(self):
+        """
+        Renueva el latido de las listas en vuelo mientras el worker vive, y
+        recupera los trabajos de los workers que dejaron de latir.
+        """
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await touch_processing_lists_async(self.worker_id, self.queue_names)
+                await self._recover_dead_workers()
+            except Exception as e:
+                logger.error(f"No se pudo renovar el latido del worker: {str(e)}")
+
+    async def _run_job(self, queue_name: str, rq_job_id: str):
+        """
+        Procesa un trabajo sacado de queue_name y lo quita de la lista en vuelo.
+        """
+        try:
+            # Los trabajos "{job_id}_narrative" (modo lazy) sólo generan la narrativa
+            if stage_from_rq_id(rq_job_id) == "narrative":
+                await self.process_narrative_job(rq_job_id)
+            else:
+                await self.process_job(rq_job_id)
+        finally:
+            try:
+                await ack_rq_job_async(self.worker_id, queue_name, rq_job_id)
+            except Exception as e:
+                logger.error(f"No se pudo quitar {rq_job_id} de la lista en vuelo: {str(e)}")
+
+    async def process_job(self, rq_job_id: str):
+        """
+        Procesa un trabajo (mismo flujo que process_clinical_job en app/worker.py).
+        """
+        job_id = job_id_from_rq_id(rq_job_id)
+        try:
+            logger.info(f"Iniciando procesamiento del trabajo {job_id}")
+            await mark_rq_job_async(rq_job_id, "started")
+
+            job_data = await get_job_status_async(job_id)
+            if not job_data:
+                raise ValueError(f"Trabajo {job_id} no encontrado")
+
+            await update_job_status_async(job_id, "processing")
+
+            text = job_data.get("text")
+            audio_sha256 = job_data.get("audio_sha256")
+
+            # La transcripción es CPU: va al hilo de Whisper, no al event loop
+            if audio_sha256 and not text:
+                audio_path = resolve_audio_path(audio_sha256)
+                logger.info(f"Transcribiendo audio: {job_data.get('audio_filename')} ({audio_path})")
+                text = await asyncio.get_running_loop().run_in_executor(
+                    self._transcription_executor,
+                    lambda: self.agent.transcribe_audio(audio_path, audio_sha256=audio_sha256)
+                )
+
+            if not text:
+                raise ValueError("No se proporcionó texto ni audio válido")
+
+            # Compactar es CPU (regex): en un hilo, para no frenar el event loop
+            prepared = await asyncio.to_thread(prepare_transcript, text)
+            metrics = {
+                "input_tokens_raw": prepared["input_tokens_raw"],
+                "input_tokens": prepared["input_tokens"],
+                "llm_calls": 0,
+                "llm_prompt_tokens": 0,
+                "llm_completion_tokens": 0
+            }
+
+            narrative_mode = settings.llm_narrative_mode
+            completed = []
+
+            async def complete_structured(summary: ClinicalSummary, narrative_status: Optional[str] = None):
+                # Completado con los campos estructurados (ver process_clinical_job)
+                await update_job_status_async(
+                    job_id,
+                    "completed",
+                    result=summary.model_dump(mode="json"),
+                    metrics={
+                        **metrics,
+                        "output_schema": schema_id(settings.llm_output_schema),
+                        "narrative_status": narrative_status or NARRATIVE_STATUS_ON_COMPLETE[narrative_mode]
+                    }
+                )
+                await mark_rq_job_async(rq_job_id, "finished")
+                completed.append(True)
+                logger.info(
+                    f"Trabajo {job_id} completado "
+                    f"(concurrencia LLM {self.limiter.in_flight}/{self.limiter.current_limit})"
+                )
+
+            # Transcripción corta: comparte la llamada (combinada, con la
+            # narrativa) con otros trabajos cortos
+            if self.packer is not None and prepared["input_tokens"] <= settings.llm_pack_max_input_tokens:
+                clinical_summary = await self.agent.aprocess_packed_text(prepared["text"], self.packer, usage=metrics)
+                await complete_structured(clinical_summary, narrative_status="completed")
+                return
+
+            try:
+                clinical_summary = await self.agent.aprocess_clinical_text(
+                    prepared["text"],
+                    on_partial=lambda fields: update_job_partial_async(job_id, fields),
+                    limiter=self.limiter,
+                    usage=metrics,
+                    on_structured=complete_structured
+                )
+            except Exception as e:
+                if not completed:
+                    raise
+                # Sólo falló la narrativa: el trabajo sigue completado
+                error_message = f"Error generando la narrativa: {str(e)}\n{traceback.format_exc()}"
+                logger.error(f"Error en la narrativa del trabajo {job_id}: {error_message}")
+                await update_job_narrative_async(job_id, "failed", error=error_message, metrics=metrics)
+                return
+
+            if narrative_mode == "concurrent":
+                await update_job_narrative_async(
+                    job_id, "completed", narrative=clinical_summary.narrative_summary, metrics=metrics
+                )
+
+        except Exception as e:
+            error_message = f"Error procesando trabajo: {str(e)}\n{traceback.format_exc()}"
+            logger.error(f"Error en trabajo {job_id}: {error_message}")
+            try:
+                await update_job_status_async(job_id, "failed", error=error_message)
+                await mark_rq_job_async(rq_job_id, "failed")
+            except Exception as redis_error:
+                logger.error(f"No se pudo marcar el trabajo {job_id} como fallido: {str(redis_error)}")
+
+    async def process_narrative_job(self, rq_job_id: str):
+        """
+        Genera la narrativa de un trabajo completado (mismo flujo que
+        process_narrative_job en app/worker.py).
+        """
+        job_id = job_id_from_rq_id(rq_job_id)
+        try:
+            logger.info(f"Generando narrativa del trabajo {job_id}")
+            await mark_rq_job_async(rq_job_id, "started")
+            job_data = await get_job_status_async(job_id)
+            if not job_data or not job_data.get("text"):
+                raise ValueError(f"Trabajo {job_id} no encontrado o sin texto")
+            await update_job_narrative_async(job_id, "processing")
+
+            prepared = await asyncio.to_thread(prepare_transcript, job_data["text"])
+            metrics = {
+                name: int(job_data.get(name) or 0)
+                for name in ("llm_calls", "llm_prompt_tokens", "llm_completion_tokens")
+            }
+            narrative = await self.agent.agenerate_narrative(prepared["text"], self.limiter, metrics)
+
+            await update_job_narrative_async(job_id, "completed", narrative=narrative, metrics=metrics)
+            await mark_rq_job_async(rq_job_id, "finished")
+            logger.info(f"Narrativa del trabajo {job_id} completada")
+
+        except Exception as e:
+            error_message = f"Error generando la narrativa: {str(e)}\n{traceback.format_exc()}"
+            logger.error(f"Error en la narrativa del trabajo {job_id}: {error_message}")
+            try:
+                await update_job_narrative_async(job_id, "failed", error=error_message)
+                await mark_rq_job_async(rq_job_id, "failed")
+            except Exception as redis_error:
+                logger.error(f"No se pudo marcar la narrativa {job_id} como fallida: {str(redis_error)}")
+
+
+def start_async_worker(
+    queue_names: Optional[List[str]] = None,
+    max_jobs: Optional[int] = None,
+    burst: bool = False,
+    pack_size: Optional[int] = None
+):
+    """
+    Crea el worker asyncio y ejecuta su bucle hasta recibir SIGTERM/SIGINT.
+    """
+    worker = AsyncWorker(queue_names or [EXTRACTION_QUEUE], max_jobs=max_jobs, pack_size=pack_size)
+    asyncio.run(worker.run(burst=burst))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker asyncio del Clinical Summarizer Agent")
+    parser.add_argument("queues", nargs="*", default=[EXTRACTION_QUEUE], help="Colas a escuchar")
+    parser.add_argument("--max-jobs", type=int, default=None, help="Trabajos en vuelo como máximo")
+    parser.add_argument("--burst", action="store_true", help="Terminar cuando la cola esté vacía")
+    parser.add_argument("--pack-size", type=int, default=None, help="Trabajos cortos por llamada al LLM (LLM_PACK_MAX_JOBS)")
+    args = parser.parse_args()
+
+    start_async_worker(args.queues, max_jobs=args.max_jobs, burst=args.burst, pack_size=args.pack_size)
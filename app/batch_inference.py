@@ -0,0 +1,582 @@
+"""
+Inferencia diferida en lotes (Batch API) para trabajos sin prisa.
+
+Un reprocesado nocturno no necesita la latencia interactiva, pero hasta
+ahora cada trabajo hacía su propia llamada a chat.completions: paga el
+precio normal y ocupa el mismo límite de peticiones que los trabajos de
+los clientes que esperan.
+
+Los trabajos diferidos (POST /submit/batch?deferred=true) no pasan por RQ:
+esperan en la lista "deferred_jobs" de Redis y este proceso los agrupa en
+lotes de la Batch API de OpenAI, que se resuelven en horas a mitad de
+precio y con un límite de peticiones propio.
+
+Flujo:
+    1. submit_pending: reserva hasta BATCH_MAX_REQUESTS peticiones de la
+       lista y escribe el archivo de entrada en formato JSONL de la Batch API
+       (una línea por petición, con custom_id "{job_id}:{fragmento}"):
+
+           {"custom_id": "...:0", "method": "POST", "url": "/v1/chat/completions",
+            "body": {"model": "...", "messages": [...], "max_tokens": 2000}}
+
+    2. El backend de lotes lo envía; el lote queda en "batch:{id}" y en el
+       conjunto "deferred_batches" mientras no termina
+    3. poll_batches consulta cada lote; al terminar descarga los archivos de
+       salida y de errores y vuelve a reunir las respuestas de cada trabajo
+       (ClinicalAgent.parse_batch_responses) para completarlo o marcarlo
+       como fallido. Los trabajos sin respuesta de un lote expirado vuelven
+       a la lista para el siguiente lote
+
+Backends (BATCH_BACKEND, ampliables con register_batch_backend):
+- "openai": la Batch API (files + /v1/batches)
+- "local": un sustituto basado en archivos que ejecuta cada petición contra
+  el LLM_BACKEND configurado (p. ej. el stub) y escribe la salida con el
+  mismo formato. Sirve para probar el flujo completo sin la Batch API
+
+Uso:
+    python -m app.batch_inference
+    python -m app.batch_inference --burst   # termina cuando no queda nada pendiente
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import time
+import traceback
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.agent import ClinicalAgent
+from app.compaction import prepare_transcript
+from app.config import settings
+from app.llm import LLMBackend
+from app.output_schema import schema_id
+from app.queue import (
+    DEFERRED_JOB_TTL,
+    DEFERRED_QUEUE_KEY,
+    JOB_TTL,
+    _write_job_status,
+    claim_deferred_jobs,
+    get_job_status,
+    push_deferred_jobs,
+    recover_deferred_claims,
+    redis_client,
+    release_deferred_claim,
+    requeue_deferred_jobs
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Endpoint al que van todas las peticiones de un lote
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Lotes enviados que aún no se han procesado
+ACTIVE_BATCHES_KEY = "deferred_batches"
+
+# Estados finales de un lote en la Batch API
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_key(batch_id: str) -> str:
+    """
+    Hash de Redis con los trabajos y el estado de un lote.
+    """
+    return f"batch:{batch_id}"
+
+
+def make_custom_id(job_id: str, index: int) -> str:
+    """
+    custom_id de la petición index de un trabajo ("{job_id}:{index}").
+    """
+    return f"{job_id}:{index}"
+
+
+def parse_custom_id(custom_id: str) -> Tuple[str, int]:
+    """
+    (job_id, índice) de un custom_id creado con make_custom_id.
+    """
+    job_id, _, index = custom_id.rpartition(":")
+    return job_id, int(index)
+
+
+class BatchBackend:
+    """
+    Un servicio de lotes con la interfaz de la Batch API de OpenAI.
+
+    Los lotes que devuelve retrieve son diccionarios como los de la API:
+    id, status (validating, in_progress, finalizing, completed, failed,
+    expired, cancelled), output_file_id, error_file_id y request_counts.
+    """
+
+    name = "base"
+
+    def submit(self, input_path: str) -> str:
+        """
+        Envía un archivo JSONL de peticiones y devuelve el id del lote.
+        """
+        raise NotImplementedError
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        """
+        Estado actual de un lote.
+        """
+        raise NotImplementedError
+
+    def download(self, file_id: str, path: str):
+        """
+        Guarda en path un archivo de resultados (salida o errores) del lote.
+        """
+        raise NotImplementedError
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """
+    Batch API de OpenAI.
+
+    openai==1.3.7 no trae client.batches: usamos las peticiones genéricas
+    del cliente (post/get) contra /v1/batches, con la misma autenticación,
+    reintentos y timeout que el resto de llamadas.
+    """
+
+    name = "openai"
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.post(
+            "/batches",
+            body={
+                "input_file_id": input_file.id,
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": settings.batch_completion_window
+            },
+            cast_to=Dict[str, Any]
+        )
+        return batch["id"]
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self.client.get(f"/batches/{batch_id}", cast_to=Dict[str, Any])
+
+    def download(self, file_id: str, path: str):
+        self.client.files.content(file_id).stream_to_file(path)
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    Sustituto local de la Batch API basado en archivos.
+
+    Cada lote es un directorio con su entrada, su estado (batch.json) y
+    sus archivos de salida. El lote se ejecuta la primera vez que se
+    consulta: cada petición va, una tras otra, al cliente del LLM_BACKEND
+    configurado, y cada respuesta se escribe con el formato de salida de la
+    Batch API. Los "file_id" son las rutas de esos archivos.
+    """
+
+    name = "local"
+
+    def __init__(self, client, directory: str):
+        self.client = client
+        self.directory = directory
+
+    def _path(self, batch_id: str, filename: str) -> str:
+        return os.path.join(self.directory, batch_id, filename)
+
+    def _save(self, batch: Dict[str, Any]):
+        with open(self._path(batch["id"], "batch.json"), "w", encoding="utf-8") as f:
+            json.dump(batch, f)
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.directory, batch_id), exist_ok=True)
+        shutil.copyfile(input_path, self._path(batch_id, "input.jsonl"))
+        self._save({
+            "id": batch_id,
+            "status": "validating",
+            "endpoint": BATCH_ENDPOINT,
+            "completion_window": settings.batch_completion_window,
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None
+        })
+        return batch_id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        with open(self._path(batch_id, "batch.json"), encoding="utf-8") as f:
+            batch = json.load(f)
+        if batch["status"] not in BATCH_FINAL_STATUSES:
+            batch = self._run(batch)
+        return batch
+
+    def download(self, file_id: str, path: str):
+        shutil.copyfile(file_id, path)
+
+    def _run(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ejecuta todas las peticiones del lote y lo marca como completado.
+        """
+        output_path = self._path(batch["id"], "output.jsonl")
+        error_path = self._path(batch["id"], "errors.jsonl")
+        completed = failed = 0
+        with open(self._path(batch["id"], "input.jsonl"), encoding="utf-8") as requests_file, \
+                open(output_path, "w", encoding="utf-8") as output, \
+                open(error_path, "w", encoding="utf-8") as errors:
+            for number, line in enumerate(requests_file):
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                record = {"id": f"batch_req_{number}", "custom_id": request["custom_id"]}
+                try:
+                    response = self.client.chat.completions.create(**request["body"])
+                except Exception as e:
+                    record.update(response=None, error={"code": type(e).__name__, "message": str(e)})
+                    errors.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    failed += 1
+                    continue
+                record.update(
+                    response={"status_code": 200, "request_id": response.id, "body": response.model_dump()},
+                    error=None
+                )
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                completed += 1
+
+        batch.update(
+            status="completed",
+            completed_at=int(time.time()),
+            output_file_id=output_path if completed else None,
+            error_file_id=error_path if failed else None,
+            request_counts={"total": completed + failed, "completed": completed, "failed": failed}
+        )
+        self._save(batch)
+        return batch
+
+
+# Registro de backends de lotes: nombre -> función que lo construye a
+# partir del backend de LLM del agente (su cliente y su servidor)
+BATCH_BACKENDS: Dict[str, Callable[[LLMBackend], BatchBackend]] = {
+    "openai": lambda llm_backend: OpenAIBatchBackend(llm_backend.client),
+    "local": lambda llm_backend: LocalBatchBackend(llm_backend.client, os.path.join(settings.batch_dir, "local")),
+}
+
+
+def register_batch_backend(name: str, factory: Callable[[LLMBackend], BatchBackend]):
+    """
+    Registra un backend de lotes adicional (seleccionable con BATCH_BACKEND=name).
+    """
+    BATCH_BACKENDS[name] = factory
+
+
+def create_batch_backend(llm_backend: LLMBackend, name: Optional[str] = None) -> BatchBackend:
+    """
+    Crea el backend de lotes configurado en BATCH_BACKEND (o el indicado).
+    """
+    name = name or settings.batch_backend
+    if name not in BATCH_BACKENDS:
+        raise ValueError(f"BATCH_BACKEND desconocido: {name} (opciones: {', '.join(BATCH_BACKENDS)})")
+    return BATCH_BACKENDS[name](llm_backend)
+
+
+def _read_jsonl(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _line_error(record: Dict[str, Any]) -> Optional[str]:
+    """
+    Error de una línea de salida del lote, o None si la petición fue bien.
+    """
+    if record.get("error"):
+        error = record["error"]
+        return f"{error.get('code')}: {error.get('message')}" if isinstance(error, dict) else str(error)
+    response = record.get("response") or {}
+    if response.get("status_code") != 200:
+        body = response.get("body") or {}
+        message = (body.get("error") or {}).get("message") if isinstance(body, dict) else None
+        return f"HTTP {response.get('status_code')}: {message or 'sin respuesta'}"
+    return None
+
+
+class BatchRunner:
+    """
+    Envía los trabajos diferidos en lotes y recoge sus resultados.
+    """
+
+    def __init__(self, agent: Optional[ClinicalAgent] = None, backend: Optional[BatchBackend] = None):
+        self.agent = agent or ClinicalAgent(load_whisper=False)
+        self.backend = backend or create_batch_backend(self.agent.llm_backend)
+
+    def submit_pending(self) -> Optional[str]:
+        """
+        Envía un lote con los trabajos diferidos pendientes.
+
+        Returns:
+            Id del lote enviado, o None si no había trabajos
+
+        Explicación:
+            1. Reservamos hasta BATCH_MAX_REQUESTS trabajos: pasan de la lista
+               a una reserva en Redis, no desaparecen. Antes, devolvemos a la
+               lista las reservas abandonadas por un procesador caído
+            2. Cada trabajo se compacta como en los workers y se convierte en
+               una petición por fragmento (ClinicalAgent.build_batch_requests).
+               Un trabajo que no se puede preparar falla él solo; los que no
+               caben (un trabajo largo son varias peticiones) vuelven a la lista
+            3. Si algo más falla antes de registrar el lote (Redis, el envío),
+               todos los trabajos reservados vuelven a la lista
+            4. Guardamos el lote, pasamos sus trabajos a "processing" y
+               cerramos la reserva en un único MULTI/EXEC
+        """
+        recovered = recover_deferred_claims(settings.batch_claim_timeout_seconds)
+        if recovered:
+            logger.warning(f"{recovered} trabajos diferidos de reservas abandonadas devueltos a la lista")
+
+        claim_id = str(uuid.uuid4())
+        job_ids = claim_deferred_jobs(claim_id, settings.batch_max_requests)
+        if not job_ids:
+            return None
+
+        try:
+            directory = os.path.join(settings.batch_dir, claim_id)
+            os.makedirs(directory, exist_ok=True)
+            input_path = os.path.join(directory, "input.jsonl")
+            jobs, failed, leftover = self._write_batch_input(job_ids, input_path)
+            batch_id = self.backend.submit(input_path) if jobs else None
+        except Exception as e:
+            logger.error(f"No se pudo preparar o enviar el lote de {len(job_ids)} trabajos, vuelven a la lista: {str(e)}")
+            requeue_deferred_jobs(job_ids, claim_id)
+            raise
+
+        pipe = redis_client.pipeline(transaction=True)
+        if batch_id is not None:
+            pipe.hset(batch_key(batch_id), mapping={
+                "batch_id": batch_id,
+                "backend": self.backend.name,
+                "status": "submitted",
+                "created_at": datetime.now().isoformat(),
+                "directory": directory,
+                "jobs": json.dumps(jobs),
+                "requests": sum(jobs.values())
+            })
+            pipe.expire(batch_key(batch_id), DEFERRED_JOB_TTL)
+            pipe.sadd(ACTIVE_BATCHES_KEY, batch_id)
+            for job_id in jobs:
+                _write_job_status(pipe, job_id, "processing", metrics={"batch_id": batch_id})
+        for job_id, error in failed.items():
+            _write_job_status(pipe, job_id, "failed", error=error)
+            pipe.expire(f"job:{job_id}", JOB_TTL)
+        push_deferred_jobs(pipe, leftover)
+        release_deferred_claim(pipe, claim_id)
+        pipe.execute()
+        if batch_id is not None:
+            logger.info(
+                f"Lote {batch_id} enviado: {len(jobs)} trabajos, {sum(jobs.values())} peticiones ({self.backend.name})"
+            )
+        return batch_id
+
+    def _write_batch_input(
+        self,
+        job_ids: List[str],
+        input_path: str
+    ) -> Tuple[Dict[str, int], Dict[str, str], List[str]]:
+        """
+        Escribe el archivo de entrada del lote con las peticiones de cada trabajo.
+
+        Returns:
+            (peticiones por trabajo incluido, error por trabajo fallido,
+            trabajos que no caben en este lote)
+        """
+        jobs: Dict[str, int] = {}
+        failed: Dict[str, str] = {}
+        requests = 0
+        with open(input_path, "w", encoding="utf-8") as f:
+            for position, job_id in enumerate(job_ids):
+                job_data = get_job_status(job_id)
+                if not job_data:
+                    logger.warning(f"Trabajo diferido {job_id} no encontrado (expirado), se descarta")
+                    continue
+                if not job_data.get("text"):
+                    failed[job_id] = "Los trabajos diferidos necesitan texto"
+                    continue
+                try:
+                    bodies = self.agent.build_batch_requests(prepare_transcript(job_data["text"])["text"])
+                except Exception as e:
+                    logger.error(f"No se pudo preparar el trabajo diferido {job_id}: {str(e)}")
+                    failed[job_id] = f"Error preparando el trabajo para el lote: {str(e)}\n{traceback.format_exc()}"
+                    continue
+                if requests and requests + len(bodies) > settings.batch_max_requests:
+                    return jobs, failed, job_ids[position:]
+                for index, body in enumerate(bodies):
+                    line = {"custom_id": make_custom_id(job_id, index), "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+                jobs[job_id] = len(bodies)
+                requests += len(bodies)
+        return jobs, failed, []
+
+    def poll_batches(self) -> int:
+        """
+        Consulta los lotes activos y procesa los que han terminado.
+
+        Returns:
+            Lotes que siguen activos
+        """
+        active = 0
+        for batch_id in redis_client.smembers(ACTIVE_BATCHES_KEY):
+            try:
+                if not self.poll_batch(batch_id):
+                    active += 1
+            except Exception as e:
+                logger.error(f"Error consultando el lote {batch_id}: {str(e)}\n{traceback.format_exc()}")
+                active += 1
+        return active
+
+    def poll_batch(self, batch_id: str) -> bool:
+        """
+        Consulta un lote y, si ha terminado, completa sus trabajos.
+
+        Returns:
+            True si el lote ha terminado (y ya no está activo)
+
+        Explicación:
+            1. Descargamos la salida y los errores y agrupamos las respuestas
+               por trabajo (custom_id = "{job_id}:{fragmento}")
+            2. Un trabajo con todas sus respuestas se completa; uno con
+               alguna petición fallida se marca como fallido
+            3. Si el lote expiró o se canceló, los trabajos sin respuesta
+               vuelven a la lista de diferidos; si falló entero, fallan
+        """
+        info = redis_client.hgetall(batch_key(batch_id))
+        if not info:
+            logger.warning(f"Lote {batch_id} sin datos (expirado), se descarta")
+            redis_client.srem(ACTIVE_BATCHES_KEY, batch_id)
+            return True
+        batch = self.backend.retrieve(batch_id)
+        status = batch["status"]
+        if status not in BATCH_FINAL_STATUSES:
+            redis_client.hset(batch_key(batch_id), "status", status)
+            return False
+
+        responses: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        errors: Dict[str, str] = {}
+        for file_field, filename in (("output_file_id", "output.jsonl"), ("error_file_id", "errors.jsonl")):
+            if not batch.get(file_field):
+                continue
+            path = os.path.join(info["directory"], filename)
+            self.backend.download(batch[file_field], path)
+            for record in _read_jsonl(path):
+                job_id, index = parse_custom_id(record["custom_id"])
+                error = _line_error(record)
+                if error:
+                    errors.setdefault(job_id, error)
+                else:
+                    responses.setdefault(job_id, {})[index] = record["response"]["body"]
+
+        writes = []
+        requeue: List[str] = []
+        for job_id, count in json.loads(info["jobs"]).items():
+            bodies = responses.get(job_id, {})
+            if job_id in errors:
+                writes.append((job_id, "failed", None, f"Error en el lote {batch_id}: {errors[job_id]}", None))
+            elif len(bodies) == count:
+                writes.append(self._complete_job(job_id, batch_id, [bodies[index] for index in range(count)]))
+            elif status in ("expired", "cancelled"):
+                requeue.append(job_id)
+            else:
+                writes.append((job_id, "failed", None, f"Lote {batch_id} terminado ({status}) sin respuesta del trabajo", None))
+        self._finish_jobs([write for write in writes if write is not None])
+        requeue_deferred_jobs(requeue)
+
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(batch_key(batch_id), mapping={
+            "status": status,
+            "completed_at": datetime.now().isoformat(),
+            "completed_jobs": sum(1 for write in writes if write and write[1] == "completed"),
+            "failed_jobs": sum(1 for write in writes if write and write[1] == "failed"),
+            "requeued_jobs": len(requeue)
+        })
+        pipe.srem(ACTIVE_BATCHES_KEY, batch_id)
+        pipe.execute()
+        logger.info(f"Lote {batch_id} {status}: {len(writes)} trabajos procesados, {len(requeue)} devueltos a la lista")
+        return True
+
+    def _complete_job(self, job_id: str, batch_id: str, bodies: List[Dict[str, Any]]) -> Optional[tuple]:
+        """
+        Resultado de un trabajo a partir de sus respuestas del lote.
+
+        La transcripción se vuelve a compactar: prepare_transcript es
+        determinista, así que los fragmentos son los mismos que se enviaron.
+        """
+        job_data = get_job_status(job_id)
+        if not job_data:
+            logger.warning(f"Trabajo diferido {job_id} expirado antes de terminar su lote")
+            return None
+        try:
+            prepared = prepare_transcript(job_data["text"])
+            metrics = {
+                "input_tokens_raw": prepared["input_tokens_raw"],
+                "input_tokens": prepared["input_tokens"],
+                "llm_calls": 0,
+                "llm_prompt_tokens": 0,
+                "llm_completion_tokens": 0
+            }
+            summary = self.agent.parse_batch_responses(prepared["text"], bodies, usage=metrics)
+        except Exception as e:
+            return (job_id, "failed", None, f"Error procesando la respuesta del lote: {str(e)}\n{traceback.format_exc()}", None)
+        metrics.update(
+            output_schema=schema_id(settings.llm_output_schema),
+            narrative_status="completed",
+            batch_id=batch_id
+        )
+        return (job_id, "completed", summary.model_dump(mode="json"), None, metrics)
+
+    def _finish_jobs(self, writes: List[tuple]):
+        """
+        Guarda el estado final de varios trabajos, por bloques de
+        BATCH_ENQUEUE_SIZE en un pipeline cada uno.
+
+        El hash del trabajo vuelve a durar JOB_TTL desde que termina, como
+        su resultado (un trabajo diferido se creó con DEFERRED_JOB_TTL).
+        """
+        for start in range(0, len(writes), settings.batch_enqueue_size):
+            pipe = redis_client.pipeline(transaction=True)
+            for job_id, status, result, error, metrics in writes[start:start + settings.batch_enqueue_size]:
+                _write_job_status(pipe, job_id, status, result=result, error=error, metrics=metrics)
+                pipe.expire(f"job:{job_id}", JOB_TTL)
+            pipe.execute()
+
+    def run(self, burst: bool = False):
+        """
+        Bucle: envía lo pendiente y consulta los lotes cada BATCH_POLL_INTERVAL_SECONDS.
+
+        Args:
+            burst: Si es True, termina cuando no quedan trabajos diferidos
+                   ni lotes activos
+        """
+        logger.info(f"Procesador de lotes iniciado (backend {self.backend.name})")
+        while True:
+            try:
+                self.submit_pending()
+            except Exception as e:
+                logger.error(f"Error enviando lote: {str(e)}")
+            active = self.poll_batches()
+            if burst and not active and not redis_client.llen(DEFERRED_QUEUE_KEY):
+                break
+            time.sleep(settings.batch_poll_interval_seconds)
+        logger.info("Procesador de lotes detenido")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inferencia diferida en lotes (Batch API)")
+    parser.add_argument("--backend", default=None, help="Backend de lotes (BATCH_BACKEND: openai, local)")
+    parser.add_argument("--burst", action="store_true", help="Terminar cuando no quede nada pendiente")
+    args = parser.parse_args()
+
+    agent = ClinicalAgent(load_whisper=False)
+    BatchRunner(agent, create_batch_backend(agent.llm_backend, args.backend)).run(burst=args.burst)
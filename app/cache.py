@@ -0,0 +1,477 @@
+"""
+Caché de resultados del LLM.
+
+Las conversaciones reenviadas (reintentos de integraciones EHR, reprocesos
+tras errores de UI) son frecuentes. Sin caché, cada una paga una llamada
+completa al LLM. Esta caché guarda el resultado por una clave derivada de:
+
+    hash(texto normalizado, backend LLM, modelo, versión del prompt, temperatura)
+
+Tiene dos niveles:
+1. LRU en memoria del proceso (instantáneo, pocas entradas)
+2. Redis con TTL (compartido entre todos los workers)
+
+Además fusiona peticiones concurrentes idénticas: si dos trabajos piden
+la misma clave a la vez, sólo uno llama al LLM y el otro espera su resultado.
+
+También incluye la caché de transcripciones (TranscriptionCache): el
+resultado de Whisper guardado en disco por hash del audio, para que
+reprocesar un corpus con un prompt nuevo no vuelva a transcribir.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Hash de Redis con los contadores agregados de todos los procesos (/cache/stats)
+CACHE_STATS_KEY = "llm_cache:stats"
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza el texto para que diferencias triviales no cambien la clave.
+
+    Unifica la representación Unicode (NFC) y colapsa espacios en blanco.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Clave estable (SHA-256) a partir de una lista de componentes.
+    """
+    payload = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResultCache:
+    """
+    Caché de dos niveles (memoria + Redis) con fusión de peticiones concurrentes.
+
+    Los valores deben ser diccionarios serializables a JSON.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        namespace: str = "llm_cache",
+        ttl_seconds: int = 7 * 24 * 3600,
+        max_memory_entries: int = 256,
+        lock_seconds: int = 120,
+        async_redis_client=None
+    ):
+        self.redis_client = redis_client
+        # Cliente redis.asyncio para aget_or_compute (worker asyncio)
+        self.async_redis_client = async_redis_client
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.lock_seconds = lock_seconds
+
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Cálculos en curso en este proceso: clave -> evento que se activa al terminar
+        self._inflight: Dict[str, threading.Event] = {}
+        # Lo mismo para las corrutinas del worker asyncio: clave -> future
+        self._async_inflight: Dict[str, "asyncio.Future"] = {}
+
+        # Contadores de este proceso (los agregados están en Redis)
+        self.stats = {"memory_hits": 0, "redis_hits": 0, "misses": 0, "coalesced": 0}
+
+    def get_or_compute(self, key: str, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Devuelve el valor en caché o lo calcula (una sola vez) con compute().
+
+        Explicación:
+            1. Buscamos en la LRU en memoria
+            2. Si otro hilo de este proceso ya está calculando la clave, esperamos
+            3. Buscamos en Redis
+            4. Tomamos un lock en Redis (SET NX) para que otros procesos esperen
+               en lugar de llamar también al LLM
+            5. Calculamos, guardamos en ambos niveles y liberamos el lock
+        """
+        while True:
+            with self._lock:
+                value = self._memory_get(key)
+                event = self._inflight.get(key) if value is None else None
+                owner = value is None and event is None
+                if owner:
+                    event = threading.Event()
+                    self._inflight[key] = event
+            if value is not None:
+                self._count("memory_hits")
+                return value
+            if owner:
+                break
+            # Otro hilo está calculando esta clave: esperar y volver a mirar
+            self._count("coalesced")
+            event.wait(self.lock_seconds)
+
+        try:
+            value = self._redis_get(key)
+            if value is not None:
+                self._count("redis_hits")
+            else:
+                value = self._compute_with_lock(key, compute)
+            with self._lock:
+                self._memory_set(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def set(self, key: str, value: Dict[str, Any]):
+        """
+        Guarda un valor ya calculado en ambos niveles, sustituyendo el que hubiera.
+
+        Para resultados obtenidos fuera de get_or_compute (p. ej. los de un
+        lote de la Batch API). Un fallo de Redis no debe romper el trabajo.
+        """
+        with self._lock:
+            self._memory_set(key, value)
+        try:
+            self.redis_client.setex(
+                f"{self.namespace}:{key}",
+                self.ttl_seconds,
+                json.dumps(value, ensure_ascii=False)
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo guardar en la caché de Redis: {str(e)}")
+
+    def _compute_with_lock(self, key: str, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Calcula el valor coordinándose con otros procesos a través de Redis.
+        """
+        lock_key = f"{self.namespace}:lock:{key}"
+        token = str(uuid.uuid4())
+
+        try:
+            acquired = self.redis_client.set(lock_key, token, nx=True, ex=self.lock_seconds)
+        except Exception as e:
+            # Sin Redis no podemos coordinarnos: calculamos directamente
+            logger.warning(f"No se pudo tomar el lock de caché: {str(e)}")
+            self._count("misses")
+            return compute()
+
+        if not acquired:
+            # Otro proceso está llamando al LLM con esta misma clave
+            deadline = time.monotonic() + self.lock_seconds
+            while time.monotonic() < deadline:
+                time.sleep(0.1)
+                value = self._redis_get(key)
+                if value is not None:
+                    self._count("coalesced")
+                    return value
+                if not self.redis_client.exists(lock_key):
+                    break  # El otro proceso falló: calculamos nosotros
+            logger.warning(f"Espera de caché agotada para {key[:12]}, calculando")
+
+        self._count("misses")
+        try:
+            value = compute()
+            self.redis_client.setex(
+                f"{self.namespace}:{key}",
+                self.ttl_seconds,
+                json.dumps(value, ensure_ascii=False)
+            )
+            return value
+        finally:
+            # Liberar el lock sólo si sigue siendo nuestro
+            try:
+                if self.redis_client.get(lock_key) == token:
+                    self.redis_client.delete(lock_key)
+            except Exception:
+                pass  # El lock expira solo tras lock_seconds
+
+    async def aget_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Versión asíncrona de get_or_compute para el worker asyncio.
+        
+        Sigue los mismos pasos, pero sin bloquear el event loop: las
+        corrutinas que piden una clave en curso esperan su future, y
+        Redis se consulta con el cliente asíncrono.
+        """
+        while True:
+            value = self._memory_get(key)
+            if value is not None:
+                await self._acount("memory_hits")
+                return value
+            future = self._async_inflight.get(key)
+            if future is None:
+                break
+            # Otra corrutina está calculando esta clave: esperar y volver a mirar
+            await self._acount("coalesced")
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Si el future sigue vivo, a quien cancelaron es a nosotros
+                if not future.cancelled():
+                    raise
+                continue  # Cancelaron a la otra corrutina: lo intentamos nosotros
+            except Exception:
+                continue  # Falló el cálculo de la otra corrutina: lo intentamos nosotros
+        
+        future = asyncio.get_running_loop().create_future()
+        self._async_inflight[key] = future
+        try:
+            value = await self._aredis_get(key)
+            if value is not None:
+                await self._acount("redis_hits")
+            else:
+                value = await self._acompute_with_lock(key, compute)
+            self._memory_set(key, value)
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Evita el aviso "exception was never retrieved"
+            raise
+        except BaseException:
+            # Cancelación (u otra salida) de ESTA corrutina: no es un fallo del
+            # cálculo, así que no se propaga a las que esperan la misma clave
+            future.cancel()
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+    
+    async def _acompute_with_lock(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Versión asíncrona de _compute_with_lock.
+        """
+        lock_key = f"{self.namespace}:lock:{key}"
+        token = str(uuid.uuid4())
+        
+        try:
+            acquired = await self.async_redis_client.set(lock_key, token, nx=True, ex=self.lock_seconds)
+        except Exception as e:
+            logger.warning(f"No se pudo tomar el lock de caché: {str(e)}")
+            await self._acount("misses")
+            return await compute()
+        
+        if not acquired:
+            deadline = time.monotonic() + self.lock_seconds
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                value = await self._aredis_get(key)
+                if value is not None:
+                    await self._acount("coalesced")
+                    return value
+                if not await self.async_redis_client.exists(lock_key):
+                    break
+            logger.warning(f"Espera de caché agotada para {key[:12]}, calculando")
+        
+        await self._acount("misses")
+        try:
+            value = await compute()
+            await self.async_redis_client.setex(
+                f"{self.namespace}:{key}",
+                self.ttl_seconds,
+                json.dumps(value, ensure_ascii=False)
+            )
+            return value
+        finally:
+            try:
+                if await self.async_redis_client.get(lock_key) == token:
+                    await self.async_redis_client.delete(lock_key)
+            except Exception:
+                pass
+    
+    async def _aredis_get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = await self.async_redis_client.get(f"{self.namespace}:{key}")
+        except Exception as e:
+            logger.warning(f"No se pudo leer la caché en Redis: {str(e)}")
+            return None
+        return json.loads(raw) if raw else None
+    
+    async def _acount(self, name: str):
+        self.stats[name] += 1
+        try:
+            await self.async_redis_client.hincrby(CACHE_STATS_KEY, name, 1)
+        except Exception:
+            pass
+    
+    def _redis_get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Lee una entrada de Redis. Un fallo de Redis no debe romper el trabajo.
+        """
+        try:
+            raw = self.redis_client.get(f"{self.namespace}:{key}")
+        except Exception as e:
+            logger.warning(f"No se pudo leer la caché en Redis: {str(e)}")
+            return None
+        return json.loads(raw) if raw else None
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)  # Marcar como usado recientemente
+        return value
+
+    def _memory_set(self, key: str, value: Dict[str, Any]):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)  # Expulsar el menos usado
+
+    def _count(self, name: str):
+        """
+        Incrementa un contador local y su agregado en Redis.
+        """
+        self.stats[name] += 1
+        try:
+            self.redis_client.hincrby(CACHE_STATS_KEY, name, 1)
+        except Exception:
+            pass
+
+
+def create_llm_result_cache(redis_client, async_redis_client=None) -> Optional[LLMResultCache]:
+    """
+    Crea la caché de resultados según la configuración (None si está desactivada).
+    """
+    if not settings.llm_cache_enabled:
+        return None
+    return LLMResultCache(
+        redis_client,
+        namespace="llm_cache",
+        ttl_seconds=settings.llm_cache_ttl_seconds,
+        max_memory_entries=settings.llm_cache_memory_entries,
+        lock_seconds=settings.llm_cache_lock_seconds,
+        async_redis_client=async_redis_client
+    )
+
+
+class TranscriptionCache:
+    """
+    Caché en disco de transcripciones de Whisper, con tamaño máximo.
+
+    Cada entrada es un archivo JSON (texto, segmentos e idioma) nombrado
+    con la clave. Al leer una entrada actualizamos su fecha de modificación,
+    así la expulsión por tamaño borra primero las menos usadas (LRU).
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None  # Se calcula al primer put()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve la transcripción guardada o None.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)  # Marcar como usada recientemente
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Entrada de caché de transcripción ilegible {key[:12]}: {str(e)}")
+            return None
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """
+        Guarda una transcripción (escritura atómica) y aplica el límite de tamaño.
+
+        Un error de disco (lleno, sólo lectura) no hace fallar el trabajo:
+        la transcripción ya está hecha, sólo se pierde la entrada de caché.
+        """
+        path = self._path(key)
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # No dejamos temporales a medias en el directorio de la caché
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+                raise
+
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = self._scan()[1]
+                else:
+                    self._total_bytes += len(data)
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except OSError as e:
+            logger.warning(f"No se pudo guardar la transcripción {key[:12]} en la caché: {str(e)}")
+
+    def _scan(self):
+        """
+        Recorre el directorio: devuelve [(mtime, tamaño, ruta)] y el total en bytes.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def _evict(self):
+        """
+        Borra las entradas menos usadas hasta quedar en el 90% del límite.
+        """
+        entries, total = self._scan()
+        target = int(self.max_bytes * 0.9)
+        for _, size, file_path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(file_path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._total_bytes = total
+        logger.info(f"Caché de transcripciones reducida a {total} bytes")
+
+
+def create_transcription_cache() -> Optional[TranscriptionCache]:
+    """
+    Crea la caché de transcripciones según la configuración (None si está desactivada).
+    """
+    if not settings.transcription_cache_enabled:
+        return None
+    return TranscriptionCache(
+        settings.transcription_cache_dir,
+        settings.transcription_cache_max_bytes
+    )
@@ -0,0 +1,270 @@
+"""
+Extracción map-reduce de conversaciones más largas que el contexto del modelo.
+
+_build_clinical_prompt mete la conversación completa en un solo prompt.
+Con consultas muy largas (varias personas, una hora de audio) la llamada
+falla por exceder el contexto, o la respuesta se corta en max_tokens.
+
+En su lugar:
+
+1. MAP: dividimos la conversación en fragmentos de como mucho
+   LLM_CHUNK_MAX_TOKENS tokens, cortando siempre entre turnos de palabra
+   ("Doctor: ...", "Paciente: ..."). Cada fragmento repite los últimos
+   turnos del anterior (solapamiento) para no perder el contexto de una
+   pregunta y su respuesta. Los fragmentos se extraen concurrentemente
+2. REDUCE: combinamos los resúmenes de forma determinista (sin otra
+   llamada al LLM): síntomas deduplicados por nombre normalizado, la
+   duración y la severidad más específicas, y la unión de factores de
+   riesgo y condiciones
+"""
+
+import re
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.models import ClinicalSummary, Symptom
+from app.tokens import count_tokens
+
+# Inicio de un turno de palabra: "Doctor:", "Dra. García:", "PACIENTE:",
+# opcionalmente precedido de una marca de tiempo "[00:12:03]"
+TURN_RE = re.compile(r"^\s*(?:\[[^\]]*\]\s*)?[^\W\d_][\w .()'-]{0,39}:\s")
+
+# Fin de frase (para textos sin turnos, como una transcripción de Whisper)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+
+# Severidades conocidas, de menor a mayor. Ante dos valores distintos para
+# el mismo síntoma nos quedamos con el mayor (el criterio conservador)
+SEVERITY_RANK = {
+    "leve": 1,
+    "moderado": 2,
+    "moderada": 2,
+    "severo": 3,
+    "severa": 3,
+    "grave": 3,
+    "intenso": 3,
+    "intensa": 3,
+}
+
+
+def split_turns(text: str) -> List[str]:
+    """
+    Divide una conversación en turnos de palabra.
+
+    Una línea que empieza con "Nombre:" abre un turno; las líneas siguientes
+    sin etiqueta pertenecen al mismo turno. Si el texto no tiene etiquetas
+    de hablante, los "turnos" son las frases.
+    """
+    turns: List[str] = []
+    current: List[str] = []
+    labeled = False
+    for line in text.splitlines():
+        if TURN_RE.match(line):
+            labeled = True
+            if current:
+                turns.append("\n".join(current).strip())
+            current = [line]
+        elif line.strip() or current:
+            current.append(line)
+    if current:
+        turns.append("\n".join(current).strip())
+
+    if not labeled:
+        turns = _SENTENCE_END_RE.split(text)
+    return [turn for turn in turns if turn.strip()]
+
+
+def _split_oversized(turn: str, max_tokens: int, count: Callable[[str], int]) -> List[Tuple[str, int]]:
+    """
+    Divide un turno que por sí solo no cabe en un fragmento: primero por
+    frases, si una frase sigue sin caber por palabras y, en último caso
+    (una "palabra" enorme, como un bloque base64), por caracteres.
+    """
+    pieces: List[Tuple[str, int]] = []
+    for sentence in _SENTENCE_END_RE.split(turn):
+        tokens = count(sentence)
+        if tokens <= max_tokens:
+            pieces.append((sentence, tokens))
+            continue
+        words: List[str] = []
+        size = 0
+        for word in sentence.split():
+            word_tokens = count(word + " ")
+            if word_tokens > max_tokens:
+                if words:
+                    pieces.append((" ".join(words), size))
+                    words, size = [], 0
+                step = max(1, len(word) * max_tokens // word_tokens)
+                pieces.extend((word[i:i + step], count(word[i:i + step])) for i in range(0, len(word), step))
+                continue
+            if words and size + word_tokens > max_tokens:
+                pieces.append((" ".join(words), size))
+                words, size = [], 0
+            words.append(word)
+            size += word_tokens
+        if words:
+            pieces.append((" ".join(words), size))
+    return pieces
+
+
+def chunk_conversation(
+    text: str,
+    max_tokens: int,
+    overlap_tokens: int = 0,
+    count: Optional[Callable[[str], int]] = None
+) -> List[str]:
+    """
+    Divide una conversación en fragmentos alineados con los turnos.
+
+    Args:
+        text: Conversación completa
+        max_tokens: Tokens máximos de cada fragmento
+        overlap_tokens: Tokens (en turnos completos) que cada fragmento repite del anterior
+        count: Función de conteo de tokens (por defecto app.tokens.count_tokens)
+
+    Returns:
+        Lista de fragmentos en orden. Un texto que cabe entero devuelve [text]
+
+    Explicación:
+        1. Contamos los tokens de cada turno una sola vez
+        2. Llenamos cada fragmento con turnos completos hasta max_tokens
+        3. Al empezar el siguiente, copiamos los últimos turnos del anterior
+           mientras sumen como mucho overlap_tokens
+    """
+    count = count or count_tokens
+    if count(text) <= max_tokens:
+        return [text]
+    # Con más de medio fragmento de solapamiento, cada fragmento aportaría
+    # poco texto nuevo y el número de llamadas se dispararía
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    units: List[Tuple[str, int]] = []
+    for turn in split_turns(text):
+        tokens = count(turn)
+        if tokens <= max_tokens:
+            units.append((turn, tokens))
+        else:
+            units.extend(_split_oversized(turn, max_tokens, count))
+
+    chunks: List[str] = []
+    current: List[Tuple[str, int]] = []
+    size = 0
+    has_new = False  # Un fragmento sólo con el solapamiento no aporta nada
+    for unit, tokens in units:
+        if current and has_new and size + tokens > max_tokens:
+            chunks.append("\n".join(u for u, _ in current))
+            overlap: List[Tuple[str, int]] = []
+            overlap_size = 0
+            for previous, previous_tokens in reversed(current):
+                if overlap_size + previous_tokens > overlap_tokens or overlap_size + previous_tokens + tokens > max_tokens:
+                    break
+                overlap.insert(0, (previous, previous_tokens))
+                overlap_size += previous_tokens
+            current, size, has_new = overlap, overlap_size, False
+        current.append((unit, tokens))
+        size += tokens
+        has_new = True
+    if has_new:
+        chunks.append("\n".join(u for u, _ in current))
+    return chunks
+
+
+def normalize_name(name: str) -> str:
+    """
+    Forma canónica de un nombre para deduplicar ("Cefalea." == "cefalea").
+
+    Minúsculas, sin tildes ni signos de puntuación y con los espacios colapsados.
+    """
+    decomposed = unicodedata.normalize("NFKD", name.lower())
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w\s]", " ", without_accents).split())
+
+
+def _duration_score(duration: Optional[str]) -> Tuple[int, int]:
+    """
+    Especificidad de una duración: con cifras ("3 días") gana a sin ellas
+    ("varios días"); a igualdad, la más larga ("3 días, empeora de noche").
+    """
+    if not duration or not duration.strip():
+        return (-1, 0)
+    return (1 if any(c.isdigit() for c in duration) else 0, len(duration))
+
+
+def _severity_score(severity: Optional[str]) -> int:
+    """
+    Severidad conocida (por rango) > severidad no reconocida > ninguna.
+    """
+    if not severity or not severity.strip():
+        return -1
+    return SEVERITY_RANK.get(normalize_name(severity), 0)
+
+
+def _merge_symptoms(symptoms: List[Symptom]) -> List[Symptom]:
+    """
+    Deduplica síntomas por nombre normalizado, en orden de primera aparición.
+    """
+    merged: Dict[str, Symptom] = {}
+    descriptions: Dict[str, List[str]] = {}
+    for symptom in symptoms:
+        key = normalize_name(symptom.name)
+        if not key:
+            continue
+        if key not in merged:
+            merged[key] = symptom.model_copy()
+            descriptions[key] = []
+        else:
+            best = merged[key]
+            # Con ">" estricto, a igualdad se conserva el primero (determinista)
+            if _duration_score(symptom.duration) > _duration_score(best.duration):
+                best.duration = symptom.duration
+            if _severity_score(symptom.severity) > _severity_score(best.severity):
+                best.severity = symptom.severity
+        if symptom.description and symptom.description.strip():
+            seen = {normalize_name(d) for d in descriptions[key]}
+            if normalize_name(symptom.description) not in seen:
+                descriptions[key].append(symptom.description.strip())
+
+    for key, symptom in merged.items():
+        symptom.description = "; ".join(descriptions[key]) or None
+    return list(merged.values())
+
+
+def _union(lists: List[List[str]]) -> List[str]:
+    """
+    Unión de listas de texto sin duplicados (por forma normalizada), en orden.
+    """
+    seen = set()
+    result: List[str] = []
+    for items in lists:
+        for item in items:
+            key = normalize_name(item)
+            if key and key not in seen:
+                seen.add(key)
+                result.append(item)
+    return result
+
+
+def merge_summaries(summaries: List[ClinicalSummary]) -> ClinicalSummary:
+    """
+    Combina los resúmenes de los fragmentos (en orden) en uno solo.
+
+    Es determinista: el mismo conjunto de resúmenes en el mismo orden
+    produce siempre el mismo resultado.
+
+    - Edad y género: el primer valor conocido
+    - Síntomas: deduplicados por nombre normalizado, con la duración más
+      específica, la severidad mayor y las descripciones distintas unidas
+    - Factores de riesgo y condiciones: unión sin duplicados
+    - Resumen narrativo: los resúmenes de cada fragmento, en orden
+    """
+    if len(summaries) == 1:
+        return summaries[0]
+
+    narratives = _union([[s.narrative_summary] for s in summaries if s.narrative_summary.strip()])
+    return ClinicalSummary(
+        patient_age=next((s.patient_age for s in summaries if s.patient_age is not None), None),
+        patient_gender=next((s.patient_gender for s in summaries if s.patient_gender), None),
+        symptoms=_merge_symptoms([symptom for s in summaries for symptom in s.symptoms]),
+        risk_factors=_union([s.risk_factors for s in summaries]),
+        relevant_conditions=_union([s.relevant_conditions for s in summaries]),
+        narrative_summary=" ".join(narratives)
+    )
@@ -0,0 +1,142 @@
+"""
+Compactación de transcripciones antes de la llamada al LLM.
+
+La salida de Whisper (y muchas transcripciones manuales) arrastra texto que
+no aporta nada a la extracción clínica pero que pagamos en cada llamada:
+tokens de entrada = latencia + coste.
+
+- Muletillas y disfluencias: "eh", "em", "mmm", "este…"
+- Repeticiones: "el el dolor", "me duele me duele", y los bucles típicos
+  de Whisper que repiten la misma frase varias veces
+- Cortesía sin contenido clínico: "Hola, buenos días.", "Muchas gracias, doctor."
+
+Las reglas son deterministas (sin modelo): el mismo texto produce siempre
+el mismo resultado, así la caché de resultados sigue funcionando e incluso
+acierta más (dos transcripciones que sólo difieren en muletillas comparten
+clave). Se conservan las etiquetas de hablante y el orden de los turnos.
+"""
+
+import re
+from typing import Any, Dict, List, Optional
+
+from app.chunking import TURN_RE, normalize_name
+from app.config import settings
+from app.tokens import count_tokens
+
+# Muletillas como palabra suelta (con la puntuación que las acompaña)
+_FILLER_RE = re.compile(
+    r"(?<!\w)(?:e+h+|e+m+|m+h?m+|a+h+|u+h+|u+m+|h+m+|este(?=\.\.\.|…))(?!\w)(?:\.\.\.|[,…])*",
+    re.IGNORECASE
+)
+
+# Una palabra o frase corta (hasta 6 palabras) repetida seguida: se deja una
+_REPEAT_RE = re.compile(r"\b([^\W\d_]\w*(?:\s+\w+){0,5})(?:[\s,]+\1\b)+", re.IGNORECASE)
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+
+# Una frase se considera cortesía si TODAS sus palabras están en este
+# conjunto y al menos una es un saludo/agradecimiento claro. Así "Bien." o
+# "Nada." (respuestas a preguntas clínicas) se conservan
+SMALL_TALK_WORDS = {
+    "hola", "buenos", "buenas", "buen", "dia", "dias", "tardes", "noches",
+    "gracias", "muchas", "muchisimas", "de", "nada", "a", "usted", "ti",
+    "adios", "hasta", "luego", "pronto", "encantado", "encantada", "un", "placer",
+    "que", "tal", "como", "esta", "estas", "bien", "muy", "todo", "vale", "perfecto",
+    "pase", "pasa", "adelante", "sientese", "sientate", "tome", "asiento",
+    "doctor", "doctora", "senor", "senora", "senorita", "igualmente",
+    "hello", "hi", "thanks", "thank", "you", "bye", "ok", "okay",
+}
+SMALL_TALK_MARKERS = {
+    "hola", "buenos", "buenas", "gracias", "adios", "hasta", "encantado", "encantada",
+    "placer", "tal", "sientese", "sientate", "adelante", "igualmente",
+    "hello", "hi", "thanks", "bye",
+}
+
+
+def _is_small_talk(sentence: str) -> bool:
+    words = set(normalize_name(sentence).split())
+    return bool(words) and words <= SMALL_TALK_WORDS and bool(words & SMALL_TALK_MARKERS)
+
+
+def _tidy(text: str) -> str:
+    """
+    Arregla los restos de puntuación y espacios que dejan las reglas.
+    """
+    text = re.sub(r"\s+([,.;:!?…])", r"\1", text)
+    text = re.sub(r"([,;])(?:\s*[,;])+", r"\1", text)
+    text = " ".join(text.split())
+    return text.lstrip(",;: ")
+
+
+def _compact_content(content: str, previous: List[Optional[str]]) -> str:
+    """
+    Compacta el texto de un turno (sin la etiqueta del hablante).
+
+    previous[0] es la última frase conservada (normalizada) del turno en
+    curso, para detectar frases repetidas seguidas (los bucles de Whisper).
+    Las líneas sin etiqueta de un mismo turno la comparten.
+    """
+    content = _FILLER_RE.sub(" ", content)
+    content = _REPEAT_RE.sub(r"\1", content)
+
+    kept = []
+    for sentence in _SENTENCE_END_RE.split(content):
+        sentence = _tidy(sentence)
+        if not sentence.strip(".!?… ") or _is_small_talk(sentence):
+            continue
+        normalized = normalize_name(sentence)
+        if normalized == previous[0]:
+            continue
+        previous[0] = normalized
+        kept.append(sentence)
+    return " ".join(kept)
+
+
+def compact_transcript(text: str) -> str:
+    """
+    Aplica las reglas de compactación a una conversación.
+
+    Explicación:
+        1. Procesamos la conversación línea a línea; si una línea empieza
+           por una etiqueta de hablante ("Paciente: ..."), se conserva tal cual
+        2. Del contenido quitamos muletillas y repeticiones inmediatas
+        3. Lo dividimos en frases y descartamos las de cortesía y las que
+           repiten la frase anterior DEL MISMO TURNO: si el paciente repite
+           la pregunta del médico ("¿Dolor de cabeza?" / "Dolor de cabeza.")
+           es su respuesta, y se conserva
+        4. Un turno que queda vacío desaparece entero (etiqueta incluida)
+    """
+    lines = []
+    previous: List[Optional[str]] = [None]
+    for line in text.splitlines():
+        match = TURN_RE.match(line)
+        if match:
+            previous = [None]
+        label = line[:match.end()].strip() if match else ""
+        content = _compact_content(line[match.end():] if match else line, previous)
+        if content:
+            lines.append(f"{label} {content}" if label else content)
+    return "\n".join(lines)
+
+
+def prepare_transcript(text: str) -> Dict[str, Any]:
+    """
+    Etapa previa a process_clinical_text: compacta y cuenta tokens.
+
+    Returns:
+        Diccionario con:
+        - text: Texto que se enviará al LLM (compactado si
+          TRANSCRIPT_COMPACTION_ENABLED; si la compactación lo dejara vacío,
+          el original)
+        - input_tokens_raw: Tokens de la transcripción original
+        - input_tokens: Tokens del texto que se envía
+    """
+    compacted = compact_transcript(text) if settings.transcript_compaction_enabled else text
+    if not compacted.strip():
+        compacted = text
+    tokens_raw = count_tokens(text)
+    return {
+        "text": compacted,
+        "input_tokens_raw": tokens_raw,
+        "input_tokens": count_tokens(compacted) if compacted is not text else tokens_raw,
+    }
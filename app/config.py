@@ -24,17 +24,120 @@ class Settings(BaseSettings):
     redis_host: str = "localhost"
     redis_port: int = 6379
     redis_db: int = 0
+    redis_max_connections: int = 100  # Tamaño del pool asíncrono del API
     
     # OpenAI configuration
     openai_api_key: Optional[str] = None
     openai_model: str = "gpt-4-turbo-preview"
     
+    # LLM backend configuration (ver app/llm.py)
+    llm_backend: str = "openai"  # openai, compatible (LLM_BASE_URL) o stub
+    llm_base_url: Optional[str] = None  # Servidor compatible con OpenAI
+    llm_timeout_seconds: float = 120.0  # Timeout de cada llamada al LLM
+    
+    # Stub LLM server configuration (python -m app.stub_llm_server)
+    stub_llm_host: str = "localhost"
+    stub_llm_port: int = 8100
+    stub_llm_latency_distribution: str = "lognormal"  # fixed, uniform, lognormal, exponential
+    stub_llm_latency_median_ms: float = 800.0  # Latencia típica de una respuesta
+    stub_llm_latency_sigma: float = 0.5  # Dispersión (lognormal) o ±fracción (uniform)
+    stub_llm_tokens_per_second: float = 0.0  # >0 añade tiempo por token generado
+    stub_llm_rate_limit_rate: float = 0.0  # Fracción de peticiones que responden 429
+    stub_llm_error_rate: float = 0.0  # Fracción de peticiones que responden 500
+    stub_llm_max_concurrency: int = 0  # >0: por encima de este número, responde 429
+    
+    llm_streaming: bool = True  # Publicar campos parciales mientras el LLM responde
+    llm_max_retries: int = 3  # Reintentos ante 429/503 (worker asyncio)
+    llm_retry_base_seconds: float = 1.0  # Espera del primer reintento (se duplica)
+    
+    # Compactación de la transcripción antes del LLM (ver app/compaction.py)
+    transcript_compaction_enabled: bool = True  # Muletillas, repeticiones y cortesía
+    
+    # Map-reduce de conversaciones largas (ver app/chunking.py)
+    llm_chunk_max_tokens: int = 6000  # Conversaciones más largas se dividen en fragmentos
+    llm_chunk_overlap_tokens: int = 300  # Turnos repetidos del fragmento anterior
+    llm_chunk_concurrency: int = 4  # Fragmentos extraídos a la vez (worker RQ)
+    
+    # Formato del JSON que emite el LLM (ver app/output_schema.py)
+    llm_output_schema: str = "compact"  # compact (menos tokens de salida) o full
+    
+    # Resumen narrativo desacoplado de la extracción estructurada (ver app/agent.py)
+    llm_narrative_mode: str = "concurrent"  # concurrent, lazy (bajo demanda) o combined (una llamada)
+    llm_structured_max_tokens: int = 1200  # Límite de la respuesta estructurada
+    llm_narrative_max_tokens: int = 600  # Límite del resumen narrativo
+    
+    # Agrupación de trabajos cortos en una llamada (worker asyncio, ver app/packing.py)
+    llm_pack_max_jobs: int = 1  # >1: hasta N trabajos cortos por llamada al LLM
+    llm_pack_max_input_tokens: int = 400  # Sólo se agrupan transcripciones de hasta estos tokens
+    llm_pack_max_wait_ms: float = 200.0  # Espera máxima para completar un grupo
+    llm_pack_output_tokens_per_job: int = 600  # max_tokens de la llamada = N × este valor
+    
+    # LLM result cache configuration
+    llm_cache_enabled: bool = True
+    llm_cache_ttl_seconds: int = 7 * 24 * 3600  # 7 días en Redis
+    llm_cache_memory_entries: int = 256  # Entradas en la LRU de cada proceso
+    llm_cache_lock_seconds: int = 120  # Espera máxima por una petición idéntica en curso
+    
     # Server configuration
     api_host: str = "0.0.0.0"
     api_port: int = 8000
+    result_max_wait: int = 60  # Máximo ?wait= (segundos) en /result
+    sse_keepalive_seconds: int = 15  # Intervalo de keepalive en /events
+    events_resync_seconds: int = 15  # Sin eventos, cada cuánto releen el estado el long-poll y el WebSocket
+    batch_enqueue_size: int = 500  # Trabajos por pipeline en /submit/batch
     
     # Whisper configuration
     whisper_model: str = "base"  # base, small, medium, large
+    whisper_language: Optional[str] = None  # ej: "es"; None = detección automática
+    
+    # Segmented transcription configuration
+    # Sólo en CPU: el pool usa fork, y con el modelo en GPU (CUDA) la
+    # transcripción es siempre secuencial (ver app/transcription.py)
+    transcription_workers: int = 1  # Procesos por audio largo (1 = secuencial)
+    transcription_segment_min_seconds: int = 600  # Sólo se segmentan audios más largos
+    transcription_window_seconds: int = 300  # Longitud objetivo de cada ventana
+    transcription_overlap_seconds: float = 5.0  # Solapamiento a cada lado
+    transcription_split_search_seconds: float = 15.0  # Margen para buscar un silencio
+    
+    # Transcription cache configuration
+    transcription_cache_enabled: bool = True
+    transcription_cache_dir: str = "data/transcripts"
+    transcription_cache_max_bytes: int = 1024 * 1024 * 1024  # 1 GB
+    
+    # Queue configuration
+    transcription_job_timeout: int = 3600  # Segundos por trabajo en transcription_jobs
+    extraction_job_timeout: int = 300  # Segundos por trabajo en extraction_jobs
+    
+    # Worker configuration
+    worker_preload: bool = True  # Cargar el agente antes de escuchar la cola
+    worker_executor: str = "fork"  # fork (un hijo por trabajo) o simple (sin fork)
+    worker_processes: int = 0  # Workers por supervisor (0 = número de CPUs)
+    
+    # Async worker configuration (python -m app.async_worker)
+    async_worker_max_jobs: int = 50  # Trabajos en vuelo por proceso (tope fijo)
+    async_worker_min_concurrency: int = 1  # Mínimo de llamadas al LLM simultáneas
+    async_worker_initial_concurrency: int = 8  # Punto de partida del límite adaptativo
+    async_worker_latency_spike_factor: float = 3.0  # Latencia x veces la habitual = saturación
+    # Sin latido durante este tiempo, otro worker devuelve a la cola los trabajos en vuelo
+    async_worker_heartbeat_timeout_seconds: float = 60.0
+    
+    # Bulk export configuration (POST /export, ver app/export.py)
+    export_dir: str = "data/exports"  # Directorio compartido con el API (descargas)
+    export_scan_count: int = 1000  # Claves por SCAN y por MGET
+    export_job_timeout: int = 6 * 3600  # Segundos por exportación
+    
+    # Deferred batch inference (POST /submit/batch?deferred=true, ver app/batch_inference.py)
+    batch_backend: str = "local"  # openai (Batch API) o local (archivos, llama al LLM_BACKEND)
+    batch_dir: str = "data/batches"  # Archivos JSONL de entrada y salida de cada lote
+    batch_max_requests: int = 50000  # Peticiones por lote (límite de la Batch API)
+    batch_completion_window: str = "24h"  # Ventana de la Batch API
+    batch_poll_interval_seconds: float = 60.0  # Cada cuánto se envían lotes y se consultan
+    batch_claim_timeout_seconds: float = 3600.0  # Reserva sin lote tras este tiempo = procesador caído
+    
+    # Audio storage configuration
+    # Directorio compartido (volumen) entre el API y el worker
+    audio_storage_dir: str = "data/audio"
+    upload_chunk_size: int = 1024 * 1024  # 1 MB por bloque
     
     class Config:
         """
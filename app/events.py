@@ -0,0 +1,193 @@
+"""
+Notificaciones de cambios de estado de los trabajos (push en lugar de polling).
+
+El worker publica cada cambio de estado en el canal Redis
+"job_events:{job_id}" (ver update_job_status en app/queue.py).
+
+Cada proceso del API mantiene UNA sola suscripción a "job_events:*"
+(JobEventHub) y reparte los eventos a los clientes interesados mediante
+colas asyncio en memoria. Así, miles de long-polls, streams SSE o
+WebSockets abiertos no ocupan miles de conexiones a Redis.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Dict, Iterable, Optional, Set, Any
+
+from app.config import settings
+from app.models import JobStatus
+from app.queue import async_redis_client, get_job_status_async, JOB_EVENTS_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Estados a partir de los cuales un trabajo ya no cambia
+TERMINAL_STATUSES = {JobStatus.COMPLETED.value, JobStatus.FAILED.value}
+
+# Espera entre reintentos de suscripción si Redis no responde (exponencial)
+RESUBSCRIBE_INITIAL_DELAY = 1.0
+RESUBSCRIBE_MAX_DELAY = 30.0
+
+
+class JobEventHub:
+    """
+    Suscriptor compartido de eventos de trabajos para un proceso del API.
+
+    Una tarea en segundo plano lee los mensajes de Redis y los copia en
+    las colas asyncio registradas para cada job_id.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._listeners: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+
+    async def start(self):
+        """
+        Inicia la suscripción si aún no está activa.
+
+        Esperamos la confirmación de PSUBSCRIBE antes de retornar, así un
+        cliente que se registra y luego lee el estado no pierde eventos.
+        """
+        async with self._start_lock:
+            if self._task is not None and not self._task.done():
+                return
+            pubsub = self._client.pubsub()
+            await pubsub.psubscribe(JOB_EVENTS_PATTERN)
+            await pubsub.get_message(timeout=1.0)  # Confirmación de la suscripción
+            self._task = asyncio.create_task(self._run(pubsub))
+
+    async def stop(self):
+        """
+        Detiene la tarea de lectura (se llama al apagar el API).
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self, pubsub):
+        """
+        Bucle que reparte los mensajes de Redis a las colas registradas.
+        """
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                except Exception as e:
+                    # Conexión perdida: reintentamos la suscripción
+                    logger.warning(f"Suscripción a eventos interrumpida: {str(e)}")
+                    await self._resubscribe(pubsub)
+                    continue
+                if not message:
+                    continue
+                job_id = message["channel"].split(":", 1)[1]
+                listeners = self._listeners.get(job_id)
+                if not listeners:
+                    continue
+                event = json.loads(message["data"])
+                for queue in list(listeners):
+                    queue.put_nowait(event)
+        finally:
+            await pubsub.reset()
+
+    async def _resubscribe(self, pubsub):
+        """
+        Rehace la suscripción, reintentando con espera exponencial mientras
+        Redis no responda: si la tarea muriera, ningún cliente del proceso
+        volvería a recibir eventos.
+        """
+        delay = RESUBSCRIBE_INITIAL_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await pubsub.reset()
+                await pubsub.psubscribe(JOB_EVENTS_PATTERN)
+                logger.info("Suscripción a eventos restablecida")
+                return
+            except Exception as e:
+                delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY)
+                logger.warning(f"No se pudo restablecer la suscripción a eventos ({str(e)}), reintento en {delay:.0f} s")
+
+    def add(self, queue: asyncio.Queue, job_ids: Iterable[str]):
+        """
+        Registra una cola para recibir los eventos de varios trabajos.
+        """
+        for job_id in job_ids:
+            self._listeners.setdefault(job_id, set()).add(queue)
+
+    def remove(self, queue: asyncio.Queue, job_ids: Iterable[str]):
+        """
+        Deja de enviar a la cola los eventos de esos trabajos.
+        """
+        for job_id in job_ids:
+            listeners = self._listeners.get(job_id)
+            if listeners is None:
+                continue
+            listeners.discard(queue)
+            if not listeners:
+                del self._listeners[job_id]
+
+    @contextlib.asynccontextmanager
+    async def listen(self, job_ids: Iterable[str]):
+        """
+        Context manager que entrega una cola con los eventos de los trabajos.
+
+        Uso:
+            async with job_event_hub.listen([job_id]) as events:
+                event = await events.get()
+        """
+        await self.start()
+        job_ids = list(job_ids)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.add(queue, job_ids)
+        try:
+            yield queue
+        finally:
+            self.remove(queue, job_ids)
+
+
+# Instancia compartida por todos los endpoints de este proceso
+job_event_hub = JobEventHub(async_redis_client)
+
+
+async def wait_for_job_completion(job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """
+    Long-poll: espera hasta `timeout` segundos a que el trabajo termine.
+
+    Returns:
+        El estado del trabajo (como get_job_status_async), terminado o no,
+        o None si el trabajo no existe.
+
+    Explicación:
+        1. Nos registramos para recibir eventos ANTES de leer el estado,
+           así no perdemos un cambio que ocurra entre ambas operaciones
+        2. Si el trabajo ya terminó, respondemos de inmediato
+        3. Si no, esperamos eventos hasta que termine o se agote el tiempo.
+           Cada settings.events_resync_seconds sin eventos releemos el
+           estado: un evento publicado mientras el hub reconectaba con
+           Redis se habría perdido
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    async with job_event_hub.listen([job_id]) as events:
+        job_data = await get_job_status_async(job_id)
+        while job_data and job_data.get("status") not in TERMINAL_STATUSES:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(
+                    events.get(), timeout=min(remaining, settings.events_resync_seconds)
+                )
+            except asyncio.TimeoutError:
+                job_data = await get_job_status_async(job_id)
+                continue
+            if event.get("status") in TERMINAL_STATUSES:
+                job_data = await get_job_status_async(job_id)
+
+    return job_data
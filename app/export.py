@@ -0,0 +1,258 @@
+"""
+Exportación masiva de resultados al estilo FHIR Bulk Data ($export).
+
+Los resúmenes completados viven en Redis como claves "result:{job_id}" y
+hasta ahora sólo se podían leer con una llamada a /result por trabajo.
+Una exportación los recorre todos y escribe un archivo NDJSON por tipo de
+recurso FHIR (un recurso por línea):
+
+    data/exports/{export_id}/Patient.ndjson
+    data/exports/{export_id}/Condition.ndjson
+    data/exports/{export_id}/Observation.ndjson
+    data/exports/{export_id}/ClinicalImpression.ndjson
+
+Flujo (el mismo patrón asíncrono que los trabajos clínicos):
+    1. POST /export crea el hash "export:{id}" y encola un trabajo RQ en export_jobs
+    2. Un worker ejecuta process_export_job: SCAN de las claves result:*
+       por bloques, un MGET por bloque, conversión con clinical_summary_to_fhir
+       y escritura en streaming a los archivos (memoria constante: los
+       job_id ya exportados se anotan en un conjunto de Redis)
+    3. GET /export/{id} informa del progreso y, al terminar, devuelve el
+       manifiesto con la URL y el número de recursos de cada archivo
+    4. GET /export/{id}/{Tipo}.ndjson descarga cada archivo
+
+Los ids de los recursos llevan el job_id como prefijo: en un mismo archivo
+conviven los recursos de miles de trabajos y deben ser únicos.
+"""
+
+import json
+import logging
+import os
+import re
+import traceback
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.config import settings
+from app.fhir import clinical_summary_to_fhir
+from app.models import ClinicalSummary
+from app.queue import (
+    JOB_TTL,
+    _push_rq_job,
+    async_redis_client,
+    export_queue,
+    redis_client
+)
+
+logger = logging.getLogger(__name__)
+
+# Tipos de recurso que produce clinical_summary_to_fhir (un archivo por tipo)
+EXPORT_RESOURCE_TYPES = ("Patient", "Condition", "Observation", "ClinicalImpression")
+
+RESULT_KEY_PREFIX = "result:"
+
+# Los ids de exportación son UUID: validarlos evita rutas como "../.."
+_EXPORT_ID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def export_key(export_id: str) -> str:
+    """
+    Hash de Redis con el estado y el progreso de una exportación.
+    """
+    return f"export:{export_id}"
+
+
+def export_file_path(export_id: str, resource_type: str) -> str:
+    """
+    Ruta del archivo NDJSON de un tipo de recurso.
+
+    Raises:
+        ValueError: Si el id o el tipo de recurso no son válidos
+    """
+    if not _EXPORT_ID_RE.match(export_id):
+        raise ValueError(f"Id de exportación inválido: {export_id!r}")
+    if resource_type not in EXPORT_RESOURCE_TYPES:
+        raise ValueError(f"Tipo de recurso no exportable: {resource_type!r}")
+    return os.path.join(settings.export_dir, export_id, f"{resource_type}.ndjson")
+
+
+async def start_export_async() -> str:
+    """
+    Crea una exportación y la encola en export_jobs (desde el API).
+
+    El hash de estado y el trabajo RQ se escriben en el mismo MULTI/EXEC,
+    igual que enqueue_job_async: nunca hay un trabajo sin estado.
+
+    Returns:
+        export_id de la nueva exportación
+    """
+    export_id = str(uuid.uuid4())
+    rq_job = export_queue.create_job(
+        "app.export.process_export_job",
+        args=(export_id,),
+        timeout=settings.export_job_timeout,
+        job_id=f"{export_id}_export"
+    )
+    key = export_key(export_id)
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={
+            "export_id": export_id,
+            "status": "pending",
+            "created_at": datetime.now().isoformat(),
+            "scanned": 0,
+            "exported": 0,
+            "skipped": 0
+        })
+        pipe.expire(key, JOB_TTL)
+        _push_rq_job(pipe, rq_job)
+        await pipe.execute()
+    return export_id
+
+
+async def get_export_status_async(export_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Estado y progreso de una exportación (None si no existe o expiró).
+    """
+    data = await async_redis_client.hgetall(export_key(export_id))
+    if not data:
+        return None
+    for counter in ("scanned", "exported", "skipped"):
+        data[counter] = int(data.get(counter, 0))
+    data["output"] = json.loads(data["output"]) if data.get("output") else {}
+    return data
+
+
+def _iter_result_batches(count: int) -> Iterator[Tuple[List[str], List[Optional[str]]]]:
+    """
+    Recorre las claves result:* por bloques y devuelve (claves, valores).
+
+    SCAN no bloquea Redis como KEYS: devuelve unas `count` claves por
+    llamada junto con un cursor para continuar. Los valores de cada bloque
+    se leen con un único MGET (un viaje de red por bloque, no por trabajo).
+    Un valor puede ser None si la clave expiró entre el SCAN y el MGET.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = redis_client.scan(cursor, match=f"{RESULT_KEY_PREFIX}*", count=count)
+        if keys:
+            yield keys, redis_client.mget(keys)
+        if cursor == 0:
+            break
+
+
+def export_seen_key(export_id: str) -> str:
+    """
+    Conjunto de Redis con los job_id ya exportados (deduplicación).
+    """
+    return f"export:{export_id}:seen"
+
+
+def _first_seen(seen_key: str, job_ids: List[str]) -> List[bool]:
+    """
+    Anota un bloque de job_id en el conjunto y dice cuáles no estaban.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.sadd(seen_key, job_id)
+    pipe.expire(seen_key, JOB_TTL)
+    return [bool(added) for added in pipe.execute()[:-1]]
+
+
+def _write_progress(key: str, progress: Dict[str, int], output: Dict[str, int]):
+    redis_client.hset(key, mapping={**progress, "output": json.dumps(output)})
+
+
+def process_export_job(export_id: str) -> Dict[str, int]:
+    """
+    Ejecuta una exportación (llamada por RQ desde la cola export_jobs).
+
+    Args:
+        export_id: Id devuelto por start_export_async
+
+    Returns:
+        Número de recursos escritos por tipo
+
+    Explicación:
+        1. Abrimos un archivo temporal por tipo de recurso
+        2. Por cada bloque de SCAN + MGET, convertimos cada resultado a un
+           Bundle (ids con el job_id como prefijo) y escribimos cada recurso
+           como una línea en el archivo de su tipo
+        3. Tras cada bloque actualizamos el progreso en "export:{id}"
+        4. Al terminar, renombramos los temporales: una descarga nunca ve
+           un archivo a medias. Los tipos sin recursos no generan archivo
+
+    SCAN puede devolver una clave más de una vez, y en bloques distintos;
+    para no duplicar recursos anotamos los job_id exportados en el
+    conjunto "export:{id}:seen" de Redis (un SADD por clave, en un único
+    pipeline por bloque; SADD devuelve 0 si ya estaba). Así la memoria del
+    worker no crece con el número de resultados. El conjunto se borra al
+    terminar y expira por si el worker muere. Un resultado ilegible no detiene
+    la exportación: se cuenta en "skipped".
+    """
+    key = export_key(export_id)
+    directory = os.path.dirname(export_file_path(export_id, EXPORT_RESOURCE_TYPES[0]))
+    os.makedirs(directory, exist_ok=True)
+    redis_client.hset(key, mapping={"status": "processing", "started_at": datetime.now().isoformat()})
+    logger.info(f"Iniciando exportación {export_id} en {directory}")
+
+    tmp_paths = {rt: export_file_path(export_id, rt) + ".tmp" for rt in EXPORT_RESOURCE_TYPES}
+    files = {rt: open(path, "w", encoding="utf-8") for rt, path in tmp_paths.items()}
+    output = dict.fromkeys(EXPORT_RESOURCE_TYPES, 0)
+    progress = {"scanned": 0, "exported": 0, "skipped": 0}
+    seen_key = export_seen_key(export_id)
+    try:
+        for keys, values in _iter_result_batches(settings.export_scan_count):
+            job_ids = [result_key[len(RESULT_KEY_PREFIX):] for result_key in keys]
+            for job_id, value, first in zip(job_ids, values, _first_seen(seen_key, job_ids)):
+                if value is None or not first:
+                    continue
+                progress["scanned"] += 1
+                try:
+                    bundle = clinical_summary_to_fhir(ClinicalSummary(**json.loads(value)), id_prefix=job_id)
+                except Exception as e:
+                    progress["skipped"] += 1
+                    logger.warning(f"Exportación {export_id}: resultado {job_id} ilegible ({str(e)})")
+                    continue
+                for entry in bundle["entry"]:
+                    resource = entry["resource"]
+                    resource_type = resource["resourceType"]
+                    files[resource_type].write(json.dumps(resource, ensure_ascii=False) + "\n")
+                    output[resource_type] += 1
+                progress["exported"] += 1
+            _write_progress(key, progress, output)
+
+        for f in files.values():
+            f.close()
+        for resource_type, tmp_path in tmp_paths.items():
+            if output[resource_type]:
+                os.replace(tmp_path, export_file_path(export_id, resource_type))
+            else:
+                os.remove(tmp_path)
+        output = {rt: n for rt, n in output.items() if n}
+
+        redis_client.hset(key, mapping={
+            **progress,
+            "status": "completed",
+            "completed_at": datetime.now().isoformat(),
+            "output": json.dumps(output)
+        })
+        redis_client.delete(seen_key)
+        logger.info(f"Exportación {export_id} completada: {progress['exported']} resultados, {output}")
+        return output
+
+    except Exception as e:
+        error_message = f"Error en la exportación: {str(e)}\n{traceback.format_exc()}"
+        logger.error(f"Exportación {export_id} fallida: {error_message}")
+        for f in files.values():
+            f.close()
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        redis_client.hset(key, mapping={
+            "status": "failed",
+            "completed_at": datetime.now().isoformat(),
+            "error": error_message
+        })
+        redis_client.delete(seen_key)
+        raise  # Re-lanzar para que RQ sepa que falló
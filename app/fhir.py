@@ -8,11 +8,12 @@ nuestros ClinicalSummary a un formato compatible con FHIR.
 Nota: Esta es una versión simplificada. FHIR completo es mucho más complejo.
 """
 
-from typing import Dict, Any, List
-from app.models import ClinicalSummary, Symptom
+import json
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple, Union
+from app.models import ClinicalSummary
 
 
-def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any]:
+def clinical_summary_to_fhir(clinical_summary: ClinicalSummary, id_prefix: Optional[str] = None) -> Dict[str, Any]:
     """
     Convierte un ClinicalSummary a formato FHIR-like.
     
@@ -24,10 +25,16 @@ def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any
     
     Args:
         clinical_summary: Resumen clínico a convertir
+        id_prefix: Prefijo para los ids de los recursos (p. ej. el job_id).
+                   Dentro de un Bundle basta con "patient-1", pero en una
+                   exportación masiva los recursos de muchos trabajos van al
+                   mismo archivo y sus ids deben ser únicos
     
     Returns:
         Diccionario con estructura FHIR-like
     """
+    prefix = f"{id_prefix}-" if id_prefix else ""
+    patient_id = f"{prefix}patient-1"
     fhir_bundle = {
         "resourceType": "Bundle",
         "type": "collection",
@@ -39,7 +46,7 @@ def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any
         patient_resource = {
             "resource": {
                 "resourceType": "Patient",
-                "id": "patient-1"
+                "id": patient_id
             }
         }
         
@@ -74,12 +81,12 @@ def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any
         condition_resource = {
             "resource": {
                 "resourceType": "Condition",
-                "id": f"condition-{idx + 1}",
+                "id": f"{prefix}condition-{idx + 1}",
                 "code": {
                     "text": condition
                 },
                 "subject": {
-                    "reference": "Patient/patient-1"
+                    "reference": f"Patient/{patient_id}"
                 },
                 "clinicalStatus": {
                     "coding": [
@@ -99,13 +106,13 @@ def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any
         observation_resource = {
             "resource": {
                 "resourceType": "Observation",
-                "id": f"observation-{idx + 1}",
+                "id": f"{prefix}observation-{idx + 1}",
                 "status": "final",
                 "code": {
                     "text": symptom.name
                 },
                 "subject": {
-                    "reference": "Patient/patient-1"
+                    "reference": f"Patient/{patient_id}"
                 },
                 "valueString": symptom.description or symptom.name
             }
@@ -136,16 +143,16 @@ def clinical_summary_to_fhir(clinical_summary: ClinicalSummary) -> Dict[str, Any
     clinical_impression = {
         "resource": {
             "resourceType": "ClinicalImpression",
-            "id": "impression-1",
+            "id": f"{prefix}impression-1",
             "status": "completed",
             "subject": {
-                "reference": "Patient/patient-1"
+                "reference": f"Patient/{patient_id}"
             },
             "summary": clinical_summary.narrative_summary,
             "finding": [
                 {
                     "itemReference": {
-                        "reference": f"Observation/observation-{idx + 1}"
+                        "reference": f"Observation/{prefix}observation-{idx + 1}"
                     }
                 }
                 for idx in range(len(clinical_summary.symptoms))
@@ -163,15 +170,34 @@ def fhir_to_clinical_summary(fhir_bundle: Dict[str, Any]) -> ClinicalSummary:
     
     Esta función es útil si recibimos datos en formato FHIR
     y queremos convertirlos a nuestro formato interno.
-    """
-    from app.models import ClinicalSummary, Symptom
     
-    # Extraer información del paciente
-    patient = None
+    Explicación:
+        1. Recorremos las entradas UNA sola vez, agrupando los recursos por
+           resourceType y guardando un índice "Tipo/id" -> recurso
+        2. El paciente se resuelve con la referencia subject de la
+           ClinicalImpression a través del índice (o el primer Patient)
+        3. Los síntomas se pasan como diccionarios: Pydantic valida la
+           lista completa de una vez al construir el ClinicalSummary
+    """
+    by_type: Dict[str, List[Dict[str, Any]]] = {}
+    by_id: Dict[str, Dict[str, Any]] = {}
     for entry in fhir_bundle.get("entry", []):
-        if entry.get("resource", {}).get("resourceType") == "Patient":
-            patient = entry["resource"]
-            break
+        resource = entry.get("resource")
+        if not resource:
+            continue
+        resource_type = resource.get("resourceType")
+        by_type.setdefault(resource_type, []).append(resource)
+        if "id" in resource:
+            by_id[f"{resource_type}/{resource['id']}"] = resource
+    
+    # Resumen narrativo y paciente al que se refiere
+    impressions = by_type.get("ClinicalImpression")
+    impression = impressions[0] if impressions else {}
+    narrative_summary = impression.get("summary", "")
+    
+    patient = by_id.get(impression.get("subject", {}).get("reference", ""))
+    if patient is None and "Patient" in by_type:
+        patient = by_type["Patient"][0]
     
     patient_age = None
     patient_gender = None
@@ -184,44 +210,32 @@ def fhir_to_clinical_summary(fhir_bundle: Dict[str, Any]) -> ClinicalSummary:
     
     # Extraer síntomas (Observations)
     symptoms = []
-    for entry in fhir_bundle.get("entry", []):
-        resource = entry.get("resource", {})
-        if resource.get("resourceType") == "Observation":
-            symptom_name = resource.get("code", {}).get("text", "")
-            duration = None
-            severity = None
-            
-            # Extraer duración y severidad de extensiones
-            for ext in resource.get("extension", []):
-                url = ext.get("url", "")
-                if "duration" in url:
-                    duration = ext.get("valueString")
-                elif "severity" in url:
-                    severity = ext.get("valueString")
-            
-            symptoms.append(Symptom(
-                name=symptom_name,
-                duration=duration,
-                severity=severity,
-                description=resource.get("valueString")
-            ))
+    for resource in by_type.get("Observation", []):
+        duration = None
+        severity = None
+        # Extraer duración y severidad de extensiones
+        for ext in resource.get("extension", []):
+            url = ext.get("url", "")
+            if "duration" in url:
+                duration = ext.get("valueString")
+            elif "severity" in url:
+                severity = ext.get("valueString")
+        symptoms.append({
+            "name": resource.get("code", {}).get("text", ""),
+            "duration": duration,
+            "severity": severity,
+            "description": resource.get("valueString")
+        })
     
     # Extraer condiciones
-    relevant_conditions = []
-    for entry in fhir_bundle.get("entry", []):
-        resource = entry.get("resource", {})
-        if resource.get("resourceType") == "Condition":
-            condition_text = resource.get("code", {}).get("text", "")
-            if condition_text:
-                relevant_conditions.append(condition_text)
-    
-    # Extraer resumen narrativo
-    narrative_summary = ""
-    for entry in fhir_bundle.get("entry", []):
-        resource = entry.get("resource", {})
-        if resource.get("resourceType") == "ClinicalImpression":
-            narrative_summary = resource.get("summary", "")
-            break
+    relevant_conditions = [
+        condition_text
+        for condition_text in (
+            resource.get("code", {}).get("text", "")
+            for resource in by_type.get("Condition", [])
+        )
+        if condition_text
+    ]
     
     return ClinicalSummary(
         patient_age=patient_age,
@@ -232,3 +246,31 @@ def fhir_to_clinical_summary(fhir_bundle: Dict[str, Any]) -> ClinicalSummary:
         narrative_summary=narrative_summary
     )
 
+
+def iter_fhir_ndjson(lines: Iterable[Union[str, bytes]]) -> Iterator[Tuple[Optional[ClinicalSummary], Optional[str]]]:
+    """
+    Decodifica un stream de bundles FHIR en NDJSON (un bundle por línea).
+    
+    Es un generador: lee y convierte un bundle cada vez, así que la
+    memoria no crece con el tamaño del archivo (se puede pasar un archivo
+    abierto directamente). Una línea inválida no detiene la lectura.
+    
+    Yields:
+        (ClinicalSummary, None) por cada bundle válido, o (None, mensaje de error)
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield fhir_to_clinical_summary(json.loads(line)), None
+        except (ValueError, AttributeError, TypeError) as e:
+            # ValueError incluye JSON inválido y errores de validación de Pydantic
+            yield None, f"Línea {line_number}: {str(e)}"
+
+
+def decode_fhir_ndjson_file(path: str) -> Iterator[Tuple[Optional[ClinicalSummary], Optional[str]]]:
+    """
+    iter_fhir_ndjson sobre un archivo en disco.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        yield from iter_fhir_ndjson(f)
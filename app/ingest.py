@@ -0,0 +1,184 @@
+"""
+Lectura incremental de lotes de conversaciones.
+
+/submit/batch recibe miles de conversaciones en una sola petición,
+como NDJSON (un objeto JSON por línea) o como un array JSON.
+Estas funciones leen el cuerpo de la petición por bloques y producen
+los registros uno a uno, así un lote de 100k líneas nunca tiene que
+estar completo en memoria.
+"""
+
+import codecs
+import json
+import re
+from typing import Any, AsyncIterator, List
+
+# Límite de tamaño de un único registro (protege contra líneas sin fin)
+MAX_RECORD_BYTES = 10 * 1024 * 1024
+
+# Caracteres con los que puede terminar un elemento del array (o lo que le
+# sigue): sin ninguno de ellos en el bloque nuevo, el elemento sigue incompleto
+_CLOSING_RE = re.compile(r'[}\]",]')
+
+# Un error de JSON a menos de esta distancia del final del texto puede ser
+# un elemento cortado (p. ej. un escape \uXXXX a medias) y no uno inválido
+_TRUNCATION_MARGIN = 6
+
+# Lo que puede seguir a un número cortado al final del bloque ("-0." + "5")
+_NUMBER_TAIL_RE = re.compile(r"[0-9.eE+-]*\Z")
+
+
+async def iter_ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """
+    Produce los registros de un stream NDJSON.
+
+    Las líneas vacías se ignoran. Una línea que no es JSON válido no
+    detiene la lectura: se informa como error en su posición.
+
+    Yields:
+        (registro, None) si la línea es válida, o (None, mensaje de error)
+
+    Buscamos los saltos de línea sólo en el bloque nuevo y guardamos los
+    trozos de la línea en curso en una lista: una línea larga que llega
+    en muchos bloques se recorre una vez, no una vez por bloque.
+    """
+    parts: List[bytes] = []
+    pending = 0
+    async for chunk in chunks:
+        start = 0
+        newline = chunk.find(b"\n")
+        while newline != -1:
+            parts.append(chunk[start:newline])
+            line = b"".join(parts)
+            parts.clear()
+            pending = 0
+            if line.strip():
+                yield _decode_record(line)
+            start = newline + 1
+            newline = chunk.find(b"\n", start)
+        if start < len(chunk):
+            parts.append(chunk[start:])
+            pending += len(chunk) - start
+            if pending > MAX_RECORD_BYTES:
+                raise ValueError(f"Registro mayor que {MAX_RECORD_BYTES} bytes")
+    line = b"".join(parts)
+    if line.strip():
+        yield _decode_record(line)
+
+
+class _JSONArrayParser:
+    """
+    Parser incremental de un array JSON de primer nivel.
+
+    Recibe texto por partes (feed) y devuelve los elementos completos.
+    Cada elemento se decodifica con JSONDecoder.raw_decode (implementado
+    en C), empezando justo después de la coma anterior; si el elemento
+    aún no llegó completo, guardamos los bloques siguientes en una lista
+    y no volvemos a intentarlo hasta que llega un carácter que podría
+    cerrarlo (_CLOSING_RE). Un elemento inválido (el error no está al
+    final del texto) se informa en cuanto se detecta.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        # Texto pendiente, en trozos (se une sólo al intentar decodificar)
+        self._parts: List[str] = []
+        self._pending = 0
+        # True si el último intento encontró un elemento incompleto
+        self._incomplete = False
+        # start: esperando '['; first: primer elemento o ']';
+        # value: elemento tras una coma; sep: ',' o ']'; done: array cerrado
+        self._state = "start"
+
+    def feed(self, text: str, final: bool = False) -> List[Any]:
+        if self._incomplete and not final and not _CLOSING_RE.search(text):
+            self._parts.append(text)
+            self._pending += len(text)
+            if self._pending > MAX_RECORD_BYTES:
+                raise ValueError(f"Registro mayor que {MAX_RECORD_BYTES} bytes")
+            return []
+        self._parts.append(text)
+        buffer = "".join(self._parts)
+        self._incomplete = False
+        pos = 0
+        records = []
+
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+
+            if self._state == "done":
+                raise ValueError("Contenido inesperado después del array JSON")
+            if self._state == "start":
+                if char != "[":
+                    raise ValueError("El cuerpo debe ser un array JSON")
+                self._state = "first"
+                pos += 1
+                continue
+            if self._state == "sep" or (self._state == "first" and char == "]"):
+                if char == "]":
+                    self._state = "done"
+                elif char == "," and self._state == "sep":
+                    self._state = "value"
+                else:
+                    raise ValueError(f"Se esperaba ',' o ']' en la posición {pos}")
+                pos += 1
+                continue
+
+            try:
+                record, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                truncated = e.msg.startswith("Unterminated string") or e.pos >= len(buffer) - _TRUNCATION_MARGIN
+                if final or not truncated:
+                    raise ValueError(f"JSON inválido: {str(e)}")
+                if len(buffer) - pos > MAX_RECORD_BYTES:
+                    raise ValueError(f"Registro mayor que {MAX_RECORD_BYTES} bytes")
+                self._incomplete = True
+                break  # Elemento incompleto: esperar más datos
+            if not final and isinstance(record, (int, float)) and _NUMBER_TAIL_RE.match(buffer, end):
+                break  # Un número al final del bloque podría continuar
+            records.append(record)
+            self._state = "sep"
+            pos = end
+
+        rest = buffer[pos:]
+        self._parts = [rest] if rest else []
+        self._pending = len(rest)
+        if final and self._state != "done":
+            raise ValueError("Array JSON incompleto")
+        return records
+
+
+async def iter_json_array_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """
+    Produce los elementos de un array JSON ([{...}, {...}, ...]) sin cargarlo completo.
+
+    Yields:
+        (registro, None) por cada elemento del array
+
+    Raises:
+        ValueError: si el cuerpo no es un array JSON bien formado. A diferencia
+        de NDJSON, tras un elemento inválido no hay forma de resincronizar.
+    """
+    # El decodificador incremental maneja caracteres UTF-8 partidos entre bloques
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    parser = _JSONArrayParser()
+
+    async for chunk in chunks:
+        for record in parser.feed(utf8.decode(chunk)):
+            yield record, None
+    for record in parser.feed(utf8.decode(b"", final=True), final=True):
+        yield record, None
+
+
+def _decode_record(raw: bytes):
+    """
+    Decodifica un registro; los errores se devuelven en lugar de lanzarse.
+    """
+    try:
+        return json.loads(raw), None
+    except ValueError as e:
+        return None, f"JSON inválido: {str(e)}"
@@ -0,0 +1,267 @@
+"""
+Parsers JSON para las respuestas del LLM.
+
+- IncrementalJSONObjectParser: con stream=True el LLM envía la respuesta
+  token a token. Este parser recibe esos fragmentos y entrega cada campo de
+  primer nivel del objeto JSON en cuanto termina de llegar (por ejemplo
+  "patient_age" mucho antes que "narrative_summary"), y avisa cuando el
+  objeto se cierra para dejar de leer el stream.
+- find_json_object: localiza el objeto JSON dentro de la respuesta completa
+  en una sola pasada (llaves equilibradas, respetando strings)
+- repair_truncated_json: si la respuesta se cortó en max_tokens, cierra el
+  objeto de forma determinista para aprovechar lo que sí llegó
+
+Con orjson instalado la decodificación es varias veces más rápida que con
+el módulo json estándar; si no está, usamos json.
+"""
+
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # Dependencia opcional
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def loads(data: str) -> Any:
+    """
+    json.loads con orjson si está disponible.
+
+    Raises:
+        ValueError: Si el JSON no es válido (orjson.JSONDecodeError y
+                    json.JSONDecodeError heredan de ValueError)
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class IncrementalJSONObjectParser:
+    """
+    Extrae los campos de primer nivel de un objeto JSON que llega por partes.
+
+    Recorremos cada carácter una sola vez siguiendo la profundidad de
+    llaves/corchetes y si estamos dentro de un string. Un campo de primer
+    nivel termina con una coma o con la llave final a profundidad 1; en ese
+    momento decodificamos sólo ese miembro ("clave": valor) con json.loads.
+
+    El texto anterior a la primera "{" (por ejemplo "```json") se ignora.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member: List[str] = []
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """
+        Procesa un fragmento y devuelve los campos completados en él.
+        """
+        completed: Dict[str, Any] = {}
+        for char in chunk:
+            if self.done:
+                break
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                self._member.append(char)
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if self._depth == 1 and char in ",}":
+                self._finish_member(completed)
+                if char == "}":
+                    self._depth = 0
+                    self.done = True
+                continue
+
+            self._member.append(char)
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+
+        return completed
+
+    def _finish_member(self, completed: Dict[str, Any]):
+        """
+        Decodifica el miembro acumulado ("clave": valor) y lo registra.
+        """
+        member = "".join(self._member).strip()
+        self._member = []
+        if not member:
+            return
+        try:
+            field = loads("{" + member + "}")
+        except ValueError:
+            logger.warning(f"Campo JSON inválido en el stream: {member[:80]}")
+            return
+        self.fields.update(field)
+        completed.update(field)
+
+
+# Caracteres que cambian la estructura; todo lo demás se salta sin mirarlo
+_STRUCTURAL_RE = re.compile(r'[{}\[\]",:]')
+# Un string JSON completo (forma "desenrollada": sin alternancias por carácter)
+_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+
+def find_json_object(text: str, start: int = 0) -> Tuple[Optional[int], int, bool]:
+    """
+    Localiza el primer objeto JSON de un texto en una sola pasada.
+
+    A diferencia de la regex voraz "{.*}", que va de la primera "{" a la
+    ÚLTIMA "}" del texto (incluyendo lo que el modelo escriba después del
+    objeto), seguimos la profundidad de llaves y corchetes ignorando los
+    que aparecen dentro de strings, y paramos al cerrar el objeto.
+
+    El recorrido salta de un carácter estructural al siguiente con
+    expresiones regulares (que se ejecutan en C) y se traga cada string
+    entero de una vez: el texto de narrative_summary no se mira carácter
+    a carácter en Python.
+
+    Returns:
+        (inicio, fin, completo): inicio es None si no hay ninguna "{".
+        Si el texto termina antes de cerrar el objeto (respuesta cortada),
+        fin es len(text) y completo es False
+    """
+    begin = text.find("{", start)
+    if begin < 0:
+        return None, len(text), False
+
+    depth = 0
+    position = begin
+    while True:
+        match = _STRUCTURAL_RE.search(text, position)
+        if match is None:
+            return begin, len(text), False
+        char = match.group()
+        if char == '"':
+            string = _STRING_RE.match(text, match.start())
+            if string is None:  # String sin cerrar: respuesta cortada
+                return begin, len(text), False
+            position = string.end()
+            continue
+        position = match.end()
+        if char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return begin, position, True
+
+
+# Escape \u incompleto al final de un string cortado ("\u00")
+_PARTIAL_UNICODE_ESCAPE_RE = re.compile(r"(\\+)u[0-9a-fA-F]{0,3}$")
+
+
+def _strip_partial_escape(fragment: str) -> str:
+    """
+    Quita un escape a medias del final de un string cortado.
+    """
+    trailing = len(fragment) - len(fragment.rstrip("\\"))
+    if trailing % 2 == 1:
+        return fragment[:-1]  # Una barra invertida suelta
+    match = _PARTIAL_UNICODE_ESCAPE_RE.search(fragment)
+    # Con un número par de barras, la "u" es texto normal (una barra escapada)
+    if match and len(match.group(1)) % 2 == 1:
+        return fragment[:match.start() + len(match.group(1)) - 1]
+    return fragment
+
+
+def repair_truncated_json(fragment: str) -> Optional[str]:
+    """
+    Cierra de forma determinista un objeto JSON cortado.
+
+    Recorremos el fragmento una vez (saltando entre caracteres estructurales,
+    como find_json_object) con una pila de contenedores abiertos y anotamos
+    el último punto "seguro": justo después de un valor completo o
+    de abrir un contenedor. Al llegar al final:
+
+    - Si estamos dentro del string de un VALOR de un objeto (típicamente
+      narrative_summary o una descripción), lo cerramos: el texto que llegó
+      es útil. Un string cortado dentro de una lista (un factor de riesgo a
+      medio escribir) o una clave a medias se descartan
+    - En otro caso volvemos al último punto seguro: se descartan el número,
+      literal o clave a medias y la coma colgante
+    - Cerramos los corchetes y llaves que quedaron abiertos, en orden
+
+    Args:
+        fragment: Texto desde la "{" inicial hasta el final de la respuesta
+
+    Returns:
+        JSON válido (si el fragmento era un prefijo de un objeto JSON) o
+        None si no hay nada que reparar
+    """
+    stack: List[str] = []
+    expect_key: List[bool] = []  # Por contenedor: ¿el próximo string es una clave?
+    safe: Optional[Tuple[int, str]] = None  # (posición, cierres pendientes)
+    truncated_string: Optional[int] = None  # Inicio de un string sin cerrar
+    string_is_key = False
+
+    def closers() -> str:
+        return "".join("}" if c == "{" else "]" for c in reversed(stack))
+
+    position = 0
+    while True:
+        match = _STRUCTURAL_RE.search(fragment, position)
+        if match is None:
+            break
+        char = match.group()
+        index = match.start()
+        position = match.end()
+        if char == '"':
+            string_is_key = bool(stack) and stack[-1] == "{" and expect_key[-1]
+            string = _STRING_RE.match(fragment, index)
+            if string is None:
+                truncated_string = index
+                break
+            position = string.end()
+            if not string_is_key:
+                safe = (position, closers())
+        elif char in "{[":
+            stack.append(char)
+            expect_key.append(char == "{")
+            safe = (position, closers())
+        elif char in "}]":
+            if not stack:
+                return None
+            stack.pop()
+            expect_key.pop()
+            if not stack:
+                return fragment[:position]  # No estaba cortado
+            safe = (position, closers())
+        elif char == ":" and stack:
+            expect_key[-1] = False
+        elif char == "," and stack:
+            # Una coma sigue siempre a un valor completo
+            safe = (index, closers())
+            if stack[-1] == "{":
+                expect_key[-1] = True
+
+    if truncated_string is not None and not string_is_key and stack and stack[-1] == "{":
+        return _strip_partial_escape(fragment) + '"' + closers()
+    if safe is None:
+        return None
+    position, pending = safe
+    return fragment[:position] + pending
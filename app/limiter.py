@@ -0,0 +1,135 @@
+"""
+Límite de concurrencia adaptativo para las llamadas al LLM.
+
+El worker asyncio puede tener decenas de trabajos en vuelo, pero el
+proveedor del LLM tiene límites de tasa que no conocemos de antemano
+(y que cambian con la carga). Este limitador usa AIMD, el mismo
+mecanismo que el control de congestión de TCP:
+
+- Aumento aditivo: cada vez que se completa "una ventana" de llamadas
+  sin problemas, el límite sube en 1
+- Disminución multiplicativa: ante un 429 (rate limit), un 503 o un pico
+  de latencia, el límite se multiplica por un factor (por defecto 0.5)
+
+Así la concurrencia sube hasta donde el proveedor responde bien y
+retrocede rápido cuando empieza a saturarse.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Códigos HTTP que indican que el proveedor está saturado
+OVERLOAD_STATUS_CODES = (429, 503)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """
+    True si el error indica saturación del proveedor (429/503 o timeout).
+
+    Los errores del cliente OpenAI (RateLimitError, APIStatusError) llevan
+    el código HTTP en status_code; así no dependemos de sus clases.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if type(error).__name__ == "APITimeoutError":
+        return True
+    return getattr(error, "status_code", None) in OVERLOAD_STATUS_CODES
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Semáforo cuyo tamaño se ajusta con AIMD según las respuestas del LLM.
+
+    Uso:
+        async with limiter.slot():
+            response = await client.chat.completions.create(...)
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: Optional[int] = None,
+        decrease_factor: float = 0.5,
+        latency_spike_factor: float = 3.0
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 4))
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        # Latencia "normal" (media móvil exponencial de las llamadas correctas)
+        self._latency_ewma: Optional[float] = None
+        # Tras una disminución ignoramos nuevas señales durante un intervalo:
+        # las llamadas que ya estaban en vuelo fallarían por la misma causa
+        self._last_decrease = 0.0
+
+        self.stats = {"successes": 0, "overloads": 0, "latency_spikes": 0, "decreases": 0}
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Ocupa un hueco durante una llamada y ajusta el límite al terminar.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+
+        start = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except BaseException as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            latency = time.monotonic() - start
+            async with self._condition:
+                self.in_flight -= 1
+                self._adjust(latency, overloaded)
+                self._condition.notify_all()
+
+    def _adjust(self, latency: float, overloaded: bool):
+        """
+        Aplica AIMD con el resultado de una llamada.
+        """
+        baseline = self._latency_ewma
+        spike = (
+            not overloaded
+            and baseline is not None
+            and latency > baseline * self.latency_spike_factor
+        )
+
+        if overloaded or spike:
+            self.stats["overloads" if overloaded else "latency_spikes"] += 1
+            now = time.monotonic()
+            cooldown = baseline if baseline is not None else 1.0
+            if now - self._last_decrease >= cooldown:
+                self._last_decrease = now
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self.stats["decreases"] += 1
+                logger.warning(
+                    f"LLM saturado ({'rate limit' if overloaded else f'latencia {latency:.1f} s'}): "
+                    f"concurrencia reducida a {self.current_limit}"
+                )
+            if overloaded:
+                return
+
+        # La latencia de referencia sólo aprende de llamadas correctas
+        self._latency_ewma = latency if baseline is None else 0.9 * baseline + 0.1 * latency
+        if not spike:
+            self.stats["successes"] += 1
+            # +1 por cada "ventana" completa de llamadas correctas
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
@@ -0,0 +1,105 @@
+"""
+Backends de LLM intercambiables.
+
+El agente habla siempre el protocolo de chat completions de OpenAI, pero
+el servidor que responde puede ser:
+
+- "openai": la API de OpenAI (necesita OPENAI_API_KEY)
+- "compatible": cualquier servidor compatible con OpenAI en LLM_BASE_URL
+  (vLLM, Ollama, LM Studio, un proxy interno...)
+- "stub": el servidor local de app/stub_llm_server.py, que devuelve JSON
+  clínico realista con la latencia y tasa de errores que configuremos.
+  Permite pruebas de carga y benchmarks sin pagar llamadas reales.
+
+Se elige con LLM_BACKEND. Se pueden registrar backends propios con
+register_backend().
+"""
+
+import logging
+from typing import Callable, Dict, Optional
+
+from openai import OpenAI, AsyncOpenAI
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LLMBackend:
+    """
+    Un backend de LLM: clientes síncrono y asíncrono apuntando al mismo servidor.
+
+    Attributes:
+        name: Nombre del backend ("openai", "compatible", "stub", ...)
+        base_url: URL del servidor (None = API de OpenAI)
+        client: Cliente OpenAI síncrono (workers RQ)
+        async_client: Cliente AsyncOpenAI (worker asyncio), sin reintentos
+                      internos: los 429 los gestiona el limitador adaptativo
+    """
+
+    def __init__(self, name: str, api_key: str, base_url: Optional[str] = None, timeout: Optional[float] = None):
+        self.name = name
+        self.base_url = base_url
+        options = {"api_key": api_key, "base_url": base_url}
+        if timeout is not None:
+            options["timeout"] = timeout
+        self.client = OpenAI(**options)
+        self.async_client = AsyncOpenAI(max_retries=0, **options)
+
+    @property
+    def identity(self) -> str:
+        """
+        Identifica el servidor en la clave de caché: el mismo prompt con el
+        mismo modelo en otro servidor (p. ej. el stub) es otro resultado.
+        """
+        return f"{self.name}:{self.base_url or ''}"
+
+
+def _openai_backend() -> LLMBackend:
+    if not settings.openai_api_key:
+        raise ValueError("OPENAI_API_KEY no configurada")
+    return LLMBackend("openai", settings.openai_api_key, timeout=settings.llm_timeout_seconds)
+
+
+def _compatible_backend() -> LLMBackend:
+    if not settings.llm_base_url:
+        raise ValueError("LLM_BASE_URL no configurada (necesaria con LLM_BACKEND=compatible)")
+    # Muchos servidores locales no piden clave, pero el cliente exige una
+    return LLMBackend(
+        "compatible",
+        settings.openai_api_key or "not-needed",
+        base_url=settings.llm_base_url,
+        timeout=settings.llm_timeout_seconds
+    )
+
+
+def _stub_backend() -> LLMBackend:
+    base_url = settings.llm_base_url or f"http://{settings.stub_llm_host}:{settings.stub_llm_port}/v1"
+    return LLMBackend("stub", "stub", base_url=base_url, timeout=settings.llm_timeout_seconds)
+
+
+# Registro de backends: nombre -> función que lo construye
+BACKENDS: Dict[str, Callable[[], LLMBackend]] = {
+    "openai": _openai_backend,
+    "compatible": _compatible_backend,
+    "stub": _stub_backend,
+}
+
+
+def register_backend(name: str, factory: Callable[[], LLMBackend]):
+    """
+    Registra un backend adicional (seleccionable con LLM_BACKEND=name).
+    """
+    BACKENDS[name] = factory
+
+
+def create_llm_backend(name: Optional[str] = None) -> LLMBackend:
+    """
+    Crea el backend configurado en LLM_BACKEND (o el indicado).
+    """
+    name = name or settings.llm_backend
+    if name not in BACKENDS:
+        raise ValueError(f"LLM_BACKEND desconocido: {name} (opciones: {', '.join(BACKENDS)})")
+    backend = BACKENDS[name]()
+    logger.info(f"Backend LLM '{backend.name}'" + (f" en {backend.base_url}" if backend.base_url else ""))
+    return backend
@@ -9,18 +9,43 @@ IMPORTANTE: Este archivo NO ejecuta inference directamente.
 Solo encola trabajos en Redis y consulta resultados.
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
-from typing import Optional
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional, Dict, Any
+import asyncio
+import json
 import logging
+import os
 
 from app.models import (
     SubmitRequest,
     JobResponse,
     ResultResponse,
-    JobStatus
+    JobStatus,
+    ClinicalSummary,
+    BatchJobResponse,
+    BatchError,
+    ExportOutput,
+    ExportResponse,
+    NarrativeResponse,
+    NarrativeStatus
 )
-from app.queue import enqueue_job, get_job_status
+from app.queue import (
+    enqueue_job_async,
+    enqueue_jobs_async,
+    get_job_status_async,
+    ping_async,
+    async_redis_client,
+    async_redis_pool,
+    request_narrative_async,
+    TOKEN_METRICS
+)
+from app.events import job_event_hub, wait_for_job_completion, TERMINAL_STATUSES
+from app.ingest import iter_ndjson_records, iter_json_array_records
+from app.cache import CACHE_STATS_KEY
+from app.export import export_file_path, get_export_status_async, start_export_async
+from app.storage import store_audio_stream
 from app.config import settings
 
 # Configurar logging
@@ -41,6 +66,15 @@ app = FastAPI(
 )
 
 
+@app.on_event("shutdown")
+async def close_redis_pool():
+    """
+    Cierra la suscripción a eventos y el pool asíncrono de Redis al apagar el API.
+    """
+    await job_event_hub.stop()
+    await async_redis_pool.disconnect()
+
+
 @app.get("/")
 async def root():
     """
@@ -82,7 +116,7 @@ async def submit_job(
     Explicación del flujo:
         1. Cliente envía petición POST con texto o audio
         2. Validamos que al menos uno esté presente
-        3. Si hay audio, lo guardamos temporalmente (el worker lo procesará)
+        3. Si hay audio, lo guardamos en el almacén compartido (el worker lo procesará)
         4. Encolamos el trabajo en Redis
         5. Devolvemos job_id inmediatamente (sin esperar el procesamiento)
         6. El worker (proceso separado) tomará el trabajo y lo procesará
@@ -102,22 +136,27 @@ async def submit_job(
         logger.info(f"Trabajo recibido con texto: {len(text)} caracteres")
     
     if audio_file:
-        # En producción, guardaríamos el archivo en almacenamiento (S3, etc.)
-        # Por ahora, guardamos el nombre del archivo
-        # El worker leerá el archivo desde donde lo guardemos
+        # Copiamos el audio al almacén compartido en bloques de tamaño fijo.
+        # Nunca cargamos el archivo completo en memoria: la copia se hace
+        # en un hilo para no bloquear el event loop con I/O de disco.
+        # El worker leerá el archivo usando el hash SHA-256 del contenido.
+        try:
+            blob = await run_in_threadpool(store_audio_stream, audio_file.file)
+        except Exception as e:
+            logger.error(f"Error al almacenar audio: {str(e)}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al almacenar audio: {str(e)}"
+            )
         job_data["audio_filename"] = audio_file.filename
-        # Leer contenido del archivo (en producción usaríamos almacenamiento externo)
-        audio_content = await audio_file.read()
-        job_data["audio_size"] = len(audio_content)
-        logger.info(f"Trabajo recibido con audio: {audio_file.filename}, {len(audio_content)} bytes")
-        
-        # TODO: Guardar archivo en almacenamiento temporal o permanente
-        # Por ahora, solo guardamos metadata
+        job_data["audio_sha256"] = blob["sha256"]
+        job_data["audio_size"] = blob["size"]
+        logger.info(f"Trabajo recibido con audio: {audio_file.filename}, {blob['size']} bytes")
     
     # Encolar trabajo en Redis
     # Esta función devuelve inmediatamente, no espera el procesamiento
     try:
-        job_id = enqueue_job(job_data)
+        job_id = await enqueue_job_async(job_data)
         logger.info(f"Trabajo encolado: {job_id}")
         
         return JobResponse(
@@ -133,16 +172,154 @@ async def submit_job(
         )
 
 
+@app.post("/submit/batch", response_model=BatchJobResponse)
+async def submit_batch(request: Request, deferred: bool = False):
+    """
+    Endpoint para enviar muchas conversaciones en una sola petición.
+    
+    El cuerpo puede ser:
+    - NDJSON (Content-Type: application/x-ndjson): un registro por línea
+    - Un array JSON (Content-Type: application/json)
+    
+    Cada registro es un objeto {"text": "..."} o directamente el texto.
+    
+    Con ?deferred=true los trabajos no van a los workers sino a la Batch
+    API (ver app/batch_inference.py): tardan horas, pero cuestan menos y no
+    compiten con los trabajos interactivos por el límite de peticiones.
+    
+    Explicación:
+        1. Leemos el cuerpo por bloques (request.stream()), sin cargarlo completo
+        2. Acumulamos hasta settings.batch_enqueue_size registros válidos
+        3. Los encolamos con un único pipeline de Redis y seguimos leyendo
+        4. Devolvemos los job_ids en el mismo orden que los registros
+    
+    Los registros inválidos no detienen el lote: se devuelven en "errors"
+    con su posición, y su job_id es None. Si Redis falla o el cliente se
+    desconecta a mitad del lote, la respuesta es parcial: los job_ids ya
+    encolados se conservan y el resto aparece en "errors".
+    """
+    content_type = request.headers.get("content-type", "")
+    if "json" in content_type and "ndjson" not in content_type and "jsonl" not in content_type:
+        records = iter_json_array_records(request.stream())
+    else:
+        records = iter_ndjson_records(request.stream())
+    
+    response = BatchJobResponse()
+    pending_data = []
+    pending_positions = []
+    
+    async def flush():
+        job_ids = await enqueue_jobs_async(pending_data, deferred=deferred)
+        for position, job_id in zip(pending_positions, job_ids):
+            response.job_ids[position] = job_id
+        response.accepted += len(job_ids)
+        pending_data.clear()
+        pending_positions.clear()
+    
+    stream_done = False
+    try:
+        try:
+            async for record, error in records:
+                index = len(response.job_ids)
+                response.job_ids.append(None)
+                if isinstance(record, str):
+                    record = {"text": record}
+                if error is None and not (isinstance(record, dict) and isinstance(record.get("text"), str) and record["text"].strip()):
+                    error = "El registro debe incluir un campo 'text' no vacío"
+                if error:
+                    response.errors.append(BatchError(index=index, error=error))
+                    continue
+                pending_data.append({"text": record["text"]})
+                pending_positions.append(index)
+                if len(pending_data) >= settings.batch_enqueue_size:
+                    await flush()
+        except ValueError as e:
+            # Error de formato del cuerpo: conservamos lo que ya se leyó
+            response.errors.append(BatchError(index=len(response.job_ids), error=str(e)))
+        stream_done = True
+        
+        if pending_data:
+            await flush()
+    except Exception as e:
+        # Un fallo de Redis o una desconexión del cliente a mitad del lote:
+        # los trabajos ya encolados siguen en la cola, así que devolvemos sus
+        # job_id y marcamos como error lo que quedó sin encolar
+        logger.error(f"Error al encolar lote: {str(e)}")
+        if response.accepted == 0:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al encolar lote: {str(e)}"
+            )
+        error = f"Error al encolar lote: {str(e)}"
+        response.errors.extend(BatchError(index=position, error=error) for position in pending_positions)
+        if not stream_done:
+            response.errors.append(BatchError(index=len(response.job_ids), error=error))
+        response.errors.sort(key=lambda batch_error: batch_error.index)
+    
+    response.rejected = response.job_ids.count(None)
+    logger.info(
+        f"Lote recibido{' (diferido)' if deferred else ''}: "
+        f"{response.accepted} encolados, {response.rejected} rechazados"
+    )
+    return response
+
+
+def _build_result_response(job_id: str, job_data: Dict[str, Any]) -> ResultResponse:
+    """
+    Construye la respuesta de /result a partir de los datos del trabajo en Redis.
+    
+    La comparten el endpoint de polling, el stream SSE y el WebSocket.
+    """
+    # Convertir status string a enum
+    status = JobStatus(job_data.get("status", "pending"))
+    
+    # Construir respuesta
+    response = ResultResponse(
+        job_id=job_id,
+        status=status,
+        created_at=job_data.get("created_at"),
+        started_at=job_data.get("started_at") or None,
+        completed_at=job_data.get("completed_at"),
+        error=job_data.get("error"),
+        job_class=job_data.get("job_class") or None
+    )
+    
+    # Si está completado, incluir el resumen clínico
+    if status == JobStatus.COMPLETED and "clinical_summary" in job_data:
+        response.clinical_summary = ClinicalSummary(**job_data["clinical_summary"])
+        usage = {name: int(job_data[name]) for name in TOKEN_METRICS if name in job_data}
+        response.token_usage = usage or None
+        response.output_schema = job_data.get("output_schema")
+        # Trabajos anteriores a la narrativa desacoplada: la narrativa ya está en el resultado
+        response.narrative_status = NarrativeStatus(job_data.get("narrative_status") or "completed")
+    # Si aún se está procesando, incluir los campos que ya llegaron del LLM
+    elif status == JobStatus.PROCESSING and job_data.get("partial_result"):
+        response.partial_summary = json.loads(job_data["partial_result"])
+    
+    return response
+
+
 @app.get("/result/{job_id}", response_model=ResultResponse)
-async def get_result(job_id: str):
+async def get_result(
+    job_id: str,
+    wait: int = Query(
+        0,
+        ge=0,
+        le=settings.result_max_wait,
+        description="Segundos a esperar (long-poll) a que el trabajo termine"
+    )
+):
     """
     Endpoint para consultar el resultado de un trabajo.
     
     El cliente puede hacer polling a este endpoint hasta que
-    el trabajo esté completado.
+    el trabajo esté completado. Con ?wait=N la petición queda abierta
+    hasta N segundos y responde en cuanto el trabajo termina (long-poll),
+    así el cliente no necesita consultar cada pocos segundos.
     
     Args:
         job_id: ID del trabajo a consultar
+        wait: Segundos máximos de espera (0 = responder de inmediato)
     
     Returns:
         ResultResponse con el estado y resultado (si está disponible)
@@ -154,7 +331,10 @@ async def get_result(job_id: str):
         4. Devolvemos el estado y resultado al cliente
     """
     try:
-        job_data = get_job_status(job_id)
+        if wait:
+            job_data = await wait_for_job_completion(job_id, wait)
+        else:
+            job_data = await get_job_status_async(job_id)
         
         if not job_data:
             raise HTTPException(
@@ -162,24 +342,7 @@ async def get_result(job_id: str):
                 detail=f"Trabajo {job_id} no encontrado"
             )
         
-        # Convertir status string a enum
-        status = JobStatus(job_data.get("status", "pending"))
-        
-        # Construir respuesta
-        response = ResultResponse(
-            job_id=job_id,
-            status=status,
-            created_at=job_data.get("created_at"),
-            completed_at=job_data.get("completed_at"),
-            error=job_data.get("error")
-        )
-        
-        # Si está completado, incluir el resumen clínico
-        if status == JobStatus.COMPLETED and "clinical_summary" in job_data:
-            from app.models import ClinicalSummary
-            response.clinical_summary = ClinicalSummary(**job_data["clinical_summary"])
-        
-        return response
+        return _build_result_response(job_id, job_data)
         
     except HTTPException:
         raise
@@ -191,6 +354,294 @@ async def get_result(job_id: str):
         )
 
 
+@app.get("/result/{job_id}/narrative", response_model=NarrativeResponse)
+async def get_narrative(job_id: str, response: Response):
+    """
+    Resumen narrativo de un trabajo completado.
+    
+    Con LLM_NARRATIVE_MODE=lazy la narrativa no se genera con el trabajo:
+    la primera petición a este endpoint la encola. Mientras se genera
+    responde 202 (como /export/{id}); con la narrativa lista (o fallida,
+    con su error), 200.
+    
+    El triaje no necesita este endpoint: /result/{job_id} devuelve los
+    campos estructurados en cuanto están.
+    """
+    job_data = await get_job_status_async(job_id)
+    if not job_data:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Trabajo {job_id} no encontrado"
+        )
+    if job_data.get("status") != JobStatus.COMPLETED.value:
+        raise HTTPException(
+            status_code=409,
+            detail=f"El trabajo {job_id} aún no está completado (estado: {job_data.get('status')})"
+        )
+    
+    narrative_status = NarrativeStatus(job_data.get("narrative_status") or "completed")
+    if narrative_status == NarrativeStatus.NOT_REQUESTED:
+        narrative_status = NarrativeStatus(await request_narrative_async(job_id) or "pending")
+        if narrative_status == NarrativeStatus.COMPLETED:
+            # Otra petición la pidió y se completó entre medias
+            job_data = await get_job_status_async(job_id) or job_data
+    
+    if narrative_status == NarrativeStatus.COMPLETED:
+        summary = job_data.get("clinical_summary") or {}
+        return NarrativeResponse(
+            job_id=job_id,
+            narrative_status=narrative_status,
+            narrative_summary=summary.get("narrative_summary", "")
+        )
+    if narrative_status == NarrativeStatus.FAILED:
+        return NarrativeResponse(job_id=job_id, narrative_status=narrative_status, error=job_data.get("narrative_error"))
+    
+    response.status_code = 202
+    return NarrativeResponse(job_id=job_id, narrative_status=narrative_status)
+
+
+async def _job_event_stream(job_id: str):
+    """
+    Generador de eventos SSE para un trabajo.
+    
+    Envía el estado actual y luego un evento por cada cambio de estado
+    (o resultado parcial del LLM), hasta que el trabajo termina. Mientras no hay cambios, envía un
+    comentario periódico para que proxies y balanceadores no cierren
+    la conexión, y vuelve a leer el estado por si se perdió algún evento.
+    """
+    async with job_event_hub.listen([job_id]) as events:
+        job_data = await get_job_status_async(job_id)
+        last_status = None
+        while job_data:
+            status = job_data.get("status")
+            if status != last_status:
+                response = _build_result_response(job_id, job_data)
+                yield f"event: status\ndata: {response.model_dump_json()}\n\n"
+                last_status = status
+            if status in TERMINAL_STATUSES:
+                break
+            try:
+                event = await asyncio.wait_for(events.get(), timeout=settings.sse_keepalive_seconds)
+            except asyncio.TimeoutError:
+                # Sin eventos: releemos el estado por si el cambio se publicó
+                # mientras el hub reconectaba con Redis (se habría perdido)
+                job_data = await get_job_status_async(job_id)
+                if job_data and job_data.get("status") == status:
+                    yield ": keepalive\n\n"
+                continue
+            job_data = await get_job_status_async(job_id)
+            if event.get("partial") and job_data and job_data.get("status") == status:
+                response = _build_result_response(job_id, job_data)
+                yield f"event: partial\ndata: {response.model_dump_json()}\n\n"
+
+
+@app.get("/events/{job_id}")
+async def stream_job_events(job_id: str):
+    """
+    Stream Server-Sent Events con los cambios de estado de un trabajo.
+    
+    El navegador (EventSource) o cualquier cliente HTTP recibe un evento
+    "status" con el mismo contenido que /result/{job_id} cada vez que el
+    estado cambia. El stream se cierra cuando el trabajo termina.
+    """
+    if not await get_job_status_async(job_id):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Trabajo {job_id} no encontrado"
+        )
+    
+    return StreamingResponse(
+        _job_event_stream(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.websocket("/ws/jobs")
+async def watch_jobs(websocket: WebSocket):
+    """
+    WebSocket para seguir varios trabajos a la vez.
+    
+    Protocolo (mensajes JSON):
+        Cliente → {"action": "subscribe", "job_ids": ["id1", "id2"]}
+        Cliente → {"action": "unsubscribe", "job_ids": ["id1"]}
+        Servidor → el mismo contenido que /result/{job_id}, al suscribirse
+                   y en cada cambio de estado. Cuando un trabajo termina,
+                   se deja de seguir automáticamente.
+    
+    Como en el stream SSE, si pasan settings.events_resync_seconds sin
+    eventos releemos el estado de los trabajos seguidos y enviamos los que
+    cambiaron (por si se perdió un evento mientras el hub reconectaba).
+    """
+    await websocket.accept()
+    await job_event_hub.start()
+    events: asyncio.Queue = asyncio.Queue()
+    watched = set()
+    # Último estado enviado de cada trabajo (para las relecturas periódicas)
+    sent_status: Dict[str, str] = {}
+    
+    async def receive_commands():
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                job_ids = [str(job_id) for job_id in message.get("job_ids", [])]
+            except (ValueError, AttributeError, TypeError):
+                await events.put({"error": "Mensaje inválido"})
+                continue
+            
+            if message.get("action") == "unsubscribe":
+                job_event_hub.remove(events, job_ids)
+                watched.difference_update(job_ids)
+                continue
+            
+            new_ids = [job_id for job_id in job_ids if job_id not in watched]
+            job_event_hub.add(events, new_ids)
+            watched.update(new_ids)
+            # Evento sintético: pide al emisor el estado actual de cada trabajo
+            for job_id in new_ids:
+                events.put_nowait({"job_id": job_id})
+    
+    async def send_updates():
+        while True:
+            try:
+                event = await asyncio.wait_for(events.get(), timeout=settings.events_resync_seconds)
+            except asyncio.TimeoutError:
+                for job_id in watched:
+                    events.put_nowait({"job_id": job_id, "resync": True})
+                continue
+            if "error" in event:
+                await websocket.send_json(event)
+                continue
+            job_id = event["job_id"]
+            if job_id not in watched:
+                continue
+            job_data = await get_job_status_async(job_id)
+            if not job_data:
+                await websocket.send_json({"job_id": job_id, "error": "Trabajo no encontrado"})
+            else:
+                status = job_data.get("status")
+                if event.get("resync") and sent_status.get(job_id) == status:
+                    continue
+                response = _build_result_response(job_id, job_data)
+                await websocket.send_text(response.model_dump_json())
+                sent_status[job_id] = status
+                if status not in TERMINAL_STATUSES:
+                    continue
+            job_event_hub.remove(events, [job_id])
+            watched.discard(job_id)
+            sent_status.pop(job_id, None)
+    
+    tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_updates())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                logger.error(f"Error en WebSocket: {task.exception()}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        job_event_hub.remove(events, list(watched))
+
+
+def _build_export_response(export_id: str, export_data: Dict[str, Any]) -> ExportResponse:
+    """
+    Construye la respuesta de /export a partir del hash "export:{id}".
+    """
+    status = JobStatus(export_data.get("status", "pending"))
+    response = ExportResponse(
+        export_id=export_id,
+        status=status,
+        scanned=export_data["scanned"],
+        exported=export_data["exported"],
+        skipped=export_data["skipped"],
+        error=export_data.get("error"),
+        created_at=export_data.get("created_at"),
+        started_at=export_data.get("started_at") or None,
+        completed_at=export_data.get("completed_at")
+    )
+    # El manifiesto sólo se publica cuando todos los archivos están escritos
+    if status == JobStatus.COMPLETED:
+        response.output = [
+            ExportOutput(type=resource_type, url=f"/export/{export_id}/{resource_type}.ndjson", count=count)
+            for resource_type, count in export_data["output"].items()
+        ]
+    return response
+
+
+@app.post("/export", response_model=ExportResponse, status_code=202)
+async def start_export(response: Response):
+    """
+    Inicia una exportación masiva de todos los resultados completados.
+    
+    Al estilo de $export de FHIR Bulk Data: responde 202 de inmediato y la
+    exportación se ejecuta en un worker de la cola export_jobs. La cabecera
+    Content-Location indica dónde consultar el progreso.
+    
+    Explicación:
+        1. Creamos el estado de la exportación y la encolamos (un MULTI/EXEC)
+        2. El worker recorre result:* con SCAN + MGET y escribe un NDJSON
+           por tipo de recurso (Patient, Condition, Observation, ClinicalImpression)
+        3. El cliente consulta GET /export/{export_id} hasta que termina
+        4. Descarga cada archivo del manifiesto
+    """
+    try:
+        export_id = await start_export_async()
+    except Exception as e:
+        logger.error(f"Error al encolar exportación: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al encolar exportación: {str(e)}"
+        )
+    logger.info(f"Exportación encolada: {export_id}")
+    response.headers["Content-Location"] = f"/export/{export_id}"
+    return ExportResponse(export_id=export_id, status=JobStatus.PENDING)
+
+
+@app.get("/export/{export_id}", response_model=ExportResponse)
+async def get_export_status(export_id: str, response: Response):
+    """
+    Progreso de una exportación.
+    
+    Como en FHIR Bulk Data: 202 con la cabecera X-Progress mientras está en
+    curso, y 200 con el manifiesto (output) cuando termina.
+    """
+    export_data = await get_export_status_async(export_id)
+    if not export_data:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Exportación {export_id} no encontrada"
+        )
+    
+    result = _build_export_response(export_id, export_data)
+    if result.status in (JobStatus.PENDING, JobStatus.PROCESSING):
+        response.status_code = 202
+        response.headers["X-Progress"] = f"{result.exported} resultados exportados"
+    return result
+
+
+@app.get("/export/{export_id}/{filename}")
+async def download_export_file(export_id: str, filename: str):
+    """
+    Descarga un archivo NDJSON de una exportación completada (p. ej. Patient.ndjson).
+    
+    FileResponse envía el archivo por bloques: no se carga en memoria.
+    """
+    resource_type, _, extension = filename.partition(".")
+    try:
+        if extension != "ndjson":
+            raise ValueError(f"Archivo desconocido: {filename}")
+        path = export_file_path(export_id, resource_type)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    
+    if not await run_in_threadpool(os.path.isfile, path):
+        raise HTTPException(
+            status_code=404,
+            detail=f"La exportación {export_id} no tiene el archivo {filename}"
+        )
+    return FileResponse(path, media_type="application/fhir+ndjson", filename=f"{resource_type}.ndjson")
+
+
 @app.get("/health")
 async def health_check():
     """
@@ -201,8 +652,7 @@ async def health_check():
     """
     try:
         # Verificar conexión a Redis
-        from app.queue import redis_client
-        redis_client.ping()
+        await ping_async()
         return {"status": "healthy", "redis": "connected"}
     except Exception as e:
         return JSONResponse(
@@ -211,6 +661,23 @@ async def health_check():
         )
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """
+    Contadores de la caché de resultados del LLM (agregados de todos los workers).
+    
+    - memory_hits: resultados servidos desde la LRU en memoria de un worker
+    - redis_hits: resultados servidos desde Redis
+    - misses: llamadas reales al LLM
+    - coalesced: peticiones idénticas que esperaron a otra en curso
+    """
+    stats = await async_redis_client.hgetall(CACHE_STATS_KEY)
+    counters = {name: int(stats.get(name, 0)) for name in ("memory_hits", "redis_hits", "misses", "coalesced")}
+    lookups = counters["memory_hits"] + counters["redis_hits"] + counters["misses"]
+    counters["hit_ratio"] = round((lookups - counters["misses"]) / lookups, 4) if lookups else 0.0
+    return counters
+
+
 # Punto de entrada cuando se ejecuta con uvicorn
 # uvicorn app.main:app --reload
 if __name__ == "__main__":
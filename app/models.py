@@ -25,6 +25,18 @@ class JobStatus(str, Enum):
     FAILED = "failed"          # Error durante el procesamiento
 
 
+class NarrativeStatus(str, Enum):
+    """
+    Estado del resumen narrativo, que se genera aparte de los campos
+    estructurados (ver LLM_NARRATIVE_MODE).
+    """
+    NOT_REQUESTED = "not_requested"  # Modo lazy: nadie lo ha pedido aún
+    PENDING = "pending"              # Pedido, esperando a un worker
+    PROCESSING = "processing"        # El LLM lo está generando
+    COMPLETED = "completed"          # Ya está en clinical_summary.narrative_summary
+    FAILED = "failed"                # Error (el trabajo sigue completado)
+
+
 class SubmitRequest(BaseModel):
     """
     Schema para la petición POST a /submit.
@@ -113,7 +125,90 @@ class ResultResponse(BaseModel):
         None,
         description="Resumen clínico (solo si status=completed)"
     )
+    partial_summary: Optional[Dict[str, Any]] = Field(
+        None,
+        description="Campos ya extraídos mientras el LLM sigue generando (solo si status=processing)"
+    )
     error: Optional[str] = Field(None, description="Mensaje de error (solo si status=failed)")
+    token_usage: Optional[Dict[str, int]] = Field(
+        None,
+        description="Tokens de la transcripción (original y compactada) y uso del LLM (solo si status=completed)"
+    )
+    narrative_status: Optional[NarrativeStatus] = Field(
+        None,
+        description="Estado del resumen narrativo, que puede llegar después de los campos estructurados (solo si status=completed)"
+    )
+    output_schema: Optional[str] = Field(
+        None,
+        description="Esquema de salida del LLM con su versión, p. ej. \"compact/1\" (solo si status=completed)"
+    )
+    job_class: Optional[str] = Field(
+        None,
+        description="\"interactive\" (workers) o \"deferred\" (Batch API, ver /submit/batch?deferred=true)"
+    )
     created_at: Optional[datetime] = Field(None, description="Cuándo se creó el trabajo")
+    started_at: Optional[datetime] = Field(None, description="Cuándo un worker empezó a procesarlo")
     completed_at: Optional[datetime] = Field(None, description="Cuándo se completó el trabajo")
 
+
+
+class NarrativeResponse(BaseModel):
+    """
+    Schema para la respuesta de /result/{job_id}/narrative.
+    
+    narrative_summary sólo viene cuando narrative_status=completed.
+    """
+    job_id: str = Field(..., description="ID del trabajo")
+    narrative_status: NarrativeStatus = Field(..., description="Estado del resumen narrativo")
+    narrative_summary: Optional[str] = Field(None, description="Resumen narrativo (solo si narrative_status=completed)")
+    error: Optional[str] = Field(None, description="Mensaje de error (solo si narrative_status=failed)")
+
+
+class BatchError(BaseModel):
+    """
+    Error de un registro individual dentro de un lote.
+    """
+    index: int = Field(..., description="Posición del registro en el lote (desde 0)")
+    error: str = Field(..., description="Motivo por el que no se encoló")
+
+
+class BatchJobResponse(BaseModel):
+    """
+    Schema para la respuesta de /submit/batch.
+    
+    job_ids conserva el orden del lote: la posición i corresponde al
+    registro i. Los registros rechazados tienen None y aparecen en errors.
+    """
+    job_ids: List[Optional[str]] = Field(default_factory=list, description="IDs de trabajo en el orden del lote")
+    accepted: int = Field(0, description="Registros encolados")
+    rejected: int = Field(0, description="Registros rechazados")
+    errors: List[BatchError] = Field(default_factory=list, description="Errores por registro")
+
+
+class ExportOutput(BaseModel):
+    """
+    Un archivo de una exportación (formato del manifiesto de FHIR Bulk Data).
+    """
+    type: str = Field(..., description="Tipo de recurso FHIR del archivo")
+    url: str = Field(..., description="URL de descarga del archivo NDJSON")
+    count: int = Field(..., description="Recursos (líneas) en el archivo")
+
+
+class ExportResponse(BaseModel):
+    """
+    Schema para la respuesta de /export y /export/{export_id}.
+    
+    Mientras la exportación está en curso, los contadores indican el
+    progreso; al completarse, output es el manifiesto con un archivo NDJSON
+    por tipo de recurso.
+    """
+    export_id: str = Field(..., description="ID de la exportación")
+    status: JobStatus = Field(..., description="Estado de la exportación")
+    scanned: int = Field(0, description="Resultados leídos de Redis hasta ahora")
+    exported: int = Field(0, description="Resultados convertidos a FHIR")
+    skipped: int = Field(0, description="Resultados ilegibles que se omitieron")
+    output: List[ExportOutput] = Field(default_factory=list, description="Archivos generados (solo si status=completed)")
+    error: Optional[str] = Field(None, description="Mensaje de error (solo si status=failed)")
+    created_at: Optional[datetime] = Field(None, description="Cuándo se solicitó la exportación")
+    started_at: Optional[datetime] = Field(None, description="Cuándo un worker empezó a exportar")
+    completed_at: Optional[datetime] = Field(None, description="Cuándo terminó la exportación")
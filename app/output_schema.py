@@ -0,0 +1,188 @@
+"""
+Esquemas de salida del LLM: el formato en que le pedimos el JSON.
+
+Los tokens de SALIDA dominan la latencia de una llamada: el modelo los
+genera uno a uno, mientras que el prompt se procesa en paralelo. La
+plantilla original ("full") pide claves largas (relevant_conditions,
+narrative_summary) y repite name/duration/severity/description en cada
+síntoma, además de la indentación que el modelo copia de la plantilla.
+
+El esquema "compact" pide lo mismo con claves de una letra, los síntomas
+como listas posicionales y sin espacios:
+
+    {"a":45,"g":"masculino","s":[["cefalea","3 días","moderado","frontal"]],
+     "r":["tabaquismo"],"c":["migraña"],"n":"Paciente de 45 años..."}
+
+decode_output lo traduce de vuelta a los campos de ClinicalSummary. El
+decodificador reconoce ambos esquemas por sus claves, así que una
+respuesta en el formato "equivocado" (o un resultado antiguo) se sigue
+leyendo bien.
+
+Con la narrativa desacoplada (LLM_NARRATIVE_MODE, ver app/agent.py) la
+llamada estructurada usa la plantilla "structured_template" de su
+esquema, sin el resumen narrativo.
+
+Cada esquema tiene una versión; el worker guarda "<nombre>/<versión>" en
+el trabajo (output_schema) y forma parte de la clave de la caché.
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+# Texto que identifica el esquema compacto en el prompt (lo usa el stub)
+COMPACT_MARKER = "JSON compacto"
+
+FULL_TEMPLATE = """Responde en formato JSON con la siguiente estructura:
+{
+    "patient_age": <número o null>,
+    "patient_gender": "<texto o null>",
+    "symptoms": [
+        {
+            "name": "<nombre del síntoma>",
+            "duration": "<duración>",
+            "severity": "<severidad>",
+            "description": "<descripción>"
+        }
+    ],
+    "risk_factors": ["<factor1>", "<factor2>"],
+    "relevant_conditions": ["<condición1>", "<condición2>"],
+    "narrative_summary": "<resumen narrativo>"
+}
+"""
+
+COMPACT_TEMPLATE = f"""Responde SOLO con {COMPACT_MARKER}, en una línea y sin espacios fuera de los textos:
+{{"a":<edad o null>,"g":"<género>"|null,"s":[["<síntoma>","<duración>"|null,"<severidad>"|null,"<descripción>"|null]],"r":["<factor de riesgo>"],"c":["<condición>"],"n":"<resumen narrativo>"}}
+Claves: a=edad, g=género, s=síntomas (cada uno [nombre, duración, severidad, descripción]; omite los null del final), r=factores de riesgo, c=condiciones relevantes, n=resumen narrativo.
+"""
+
+FULL_STRUCTURED_TEMPLATE = """Responde en formato JSON con la siguiente estructura:
+{
+    "patient_age": <número o null>,
+    "patient_gender": "<texto o null>",
+    "symptoms": [
+        {
+            "name": "<nombre del síntoma>",
+            "duration": "<duración>",
+            "severity": "<severidad>",
+            "description": "<descripción>"
+        }
+    ],
+    "risk_factors": ["<factor1>", "<factor2>"],
+    "relevant_conditions": ["<condición1>", "<condición2>"]
+}
+"""
+
+COMPACT_STRUCTURED_TEMPLATE = f"""Responde SOLO con {COMPACT_MARKER}, en una línea y sin espacios fuera de los textos:
+{{"a":<edad o null>,"g":"<género>"|null,"s":[["<síntoma>","<duración>"|null,"<severidad>"|null,"<descripción>"|null]],"r":["<factor de riesgo>"],"c":["<condición>"]}}
+Claves: a=edad, g=género, s=síntomas (cada uno [nombre, duración, severidad, descripción]; omite los null del final), r=factores de riesgo, c=condiciones relevantes.
+"""
+
+# Nombre -> versión y plantillas de respuesta que van al final del prompt
+# (con y sin resumen narrativo). Cambiar una plantilla exige subir su versión
+OUTPUT_SCHEMAS: Dict[str, Dict[str, str]] = {
+    "full": {"version": "1", "template": FULL_TEMPLATE, "structured_template": FULL_STRUCTURED_TEMPLATE},
+    "compact": {"version": "1", "template": COMPACT_TEMPLATE, "structured_template": COMPACT_STRUCTURED_TEMPLATE},
+}
+
+# Clave compacta -> campo de ClinicalSummary
+COMPACT_KEYS = {
+    "a": "patient_age",
+    "g": "patient_gender",
+    "s": "symptoms",
+    "r": "risk_factors",
+    "c": "relevant_conditions",
+    "n": "narrative_summary",
+}
+
+# Orden de los elementos de un síntoma compacto
+SYMPTOM_FIELDS = ("name", "duration", "severity", "description")
+
+# Clave corta -> campo de Symptom, por si el modelo devuelve el síntoma
+# como objeto abreviado en lugar de como lista
+SYMPTOM_KEYS = {
+    "n": "name",
+    "d": "duration",
+    "s": "severity",
+    "desc": "description",
+}
+
+
+def get_output_schema(name: str) -> Dict[str, str]:
+    """
+    Esquema por nombre.
+
+    Raises:
+        ValueError: Si el esquema no existe
+    """
+    if name not in OUTPUT_SCHEMAS:
+        raise ValueError(f"LLM_OUTPUT_SCHEMA desconocido: {name} (opciones: {', '.join(OUTPUT_SCHEMAS)})")
+    return OUTPUT_SCHEMAS[name]
+
+
+def schema_id(name: str) -> str:
+    """
+    Identificador con versión que se guarda en cada trabajo ("compact/1").
+    """
+    return f"{name}/{get_output_schema(name)['version']}"
+
+
+def _decode_symptom(item: Any) -> Any:
+    """
+    ["cefalea", "3 días"] -> {"name": "cefalea", "duration": "3 días"}.
+
+    Un síntoma que ya es un objeto (esquema full o claves cortas) se
+    devuelve con las claves largas.
+    """
+    if isinstance(item, list):
+        return dict(zip(SYMPTOM_FIELDS, item))
+    if isinstance(item, str):
+        return {"name": item}
+    if isinstance(item, dict):
+        return {SYMPTOM_KEYS.get(key, key): value for key, value in item.items()}
+    return item
+
+
+def decode_output(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Traduce la salida del LLM (cualquier esquema) a los campos de ClinicalSummary.
+
+    También sirve para resultados parciales del streaming: sólo traduce
+    las claves presentes.
+    """
+    if not any(key in data for key in COMPACT_KEYS):
+        return data
+    decoded = {COMPACT_KEYS.get(key, key): value for key, value in data.items()}
+    symptoms = decoded.get("symptoms")
+    if isinstance(symptoms, list):
+        decoded["symptoms"] = [_decode_symptom(item) for item in symptoms]
+    return decoded
+
+
+def encode_output(fields: Dict[str, Any], name: str) -> str:
+    """
+    Escribe un resultado como lo emitiría el modelo con un esquema.
+
+    La usan el LLM de pruebas y el benchmark de esquemas para comparar
+    tokens de salida con el mismo contenido. Sin narrative_summary en
+    fields (llamada estructurada), la salida tampoco lo lleva.
+    """
+    if name == "full":
+        # El modelo copia la indentación de la plantilla
+        return json.dumps(fields, ensure_ascii=False, indent=4)
+
+    symptoms: List[List[Optional[str]]] = []
+    for symptom in fields.get("symptoms") or []:
+        values = [symptom.get(field) for field in SYMPTOM_FIELDS]
+        while len(values) > 1 and values[-1] is None:
+            values.pop()
+        symptoms.append(values)
+    compact = {
+        "a": fields.get("patient_age"),
+        "g": fields.get("patient_gender"),
+        "s": symptoms,
+        "r": fields.get("risk_factors") or [],
+        "c": fields.get("relevant_conditions") or [],
+    }
+    if "narrative_summary" in fields:
+        compact["n"] = fields["narrative_summary"] or ""
+    return json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,100 @@
+"""
+Agrupación de trabajos cortos en una sola llamada al LLM.
+
+Muchas transcripciones (llamadas a la línea de enfermería, consultas
+rápidas) son tan cortas que el system prompt y las instrucciones de
+_build_clinical_prompt pesan más que la propia conversación. Cada
+trabajo paga esas instrucciones y la sobrecarga de una petición HTTP.
+
+Con LLM_PACK_MAX_JOBS > 1 el worker asyncio junta hasta N trabajos cortos
+(LLM_PACK_MAX_INPUT_TOKENS) que llegan a la vez y los manda en una única
+petición, que devuelve una lista de resúmenes con el número de cada
+conversación (ver ClinicalAgent.aextract_packed). Las instrucciones se
+pagan una vez por grupo en lugar de una vez por trabajo.
+
+JobPacker sólo decide CUÁNDO se envía un grupo:
+- En cuanto tiene LLM_PACK_MAX_JOBS trabajos
+- O cuando el primero lleva LLM_PACK_MAX_WAIT_MS esperando: con poco
+  tráfico no retrasamos un trabajo esperando a otros que no llegan
+
+Cada trabajo espera a su propio resultado (un Future), así el worker
+sigue tratando cada trabajo por separado (estado, métricas, errores).
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class JobPacker:
+    """
+    Agrupa peticiones concurrentes y las procesa juntas.
+
+    Args:
+        process_pack: Corrutina que recibe la lista de elementos del grupo
+                      y devuelve sus resultados en el mismo orden
+        max_jobs: Elementos máximos por grupo
+        max_wait_seconds: Espera máxima del primer elemento antes de enviar
+                          un grupo incompleto
+    """
+
+    def __init__(
+        self,
+        process_pack: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_jobs: int,
+        max_wait_seconds: float
+    ):
+        self.process_pack = process_pack
+        self.max_jobs = max(1, max_jobs)
+        self.max_wait_seconds = max_wait_seconds
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.stats = {"packs": 0, "items": 0}
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Añade un elemento al grupo en curso y espera su resultado.
+
+        Si el grupo falla entero, la excepción llega a todos sus elementos.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_jobs:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_seconds, self._flush)
+        return await future
+
+    def _flush(self):
+        """
+        Envía el grupo en curso (sin esperar a que termine).
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pack, self._pending = self._pending, []
+        if not pack:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(pack))
+        # Guardamos la referencia: el event loop sólo guarda referencias débiles
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pack: List[Tuple[Any, asyncio.Future]]):
+        self.stats["packs"] += 1
+        self.stats["items"] += len(pack)
+        try:
+            results = await self.process_pack([item for item, _ in pack])
+        except Exception as e:
+            logger.error(f"Grupo de {len(pack)} trabajos fallido: {str(e)}")
+            for _, future in pack:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(pack, results):
+            if not future.done():
+                future.set_result(result)
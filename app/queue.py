@@ -9,10 +9,14 @@ directamente conectados.
 
 import json
 import uuid
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 import redis
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
 from rq import Queue
+from rq.job import Job
+from rq.utils import utcnow, utcformat
 from app.config import settings
 
 
@@ -26,10 +30,192 @@ redis_client = redis.Redis(
     decode_responses=True  # Convierte bytes a strings automáticamente
 )
 
-# Cola de trabajos usando RQ (Redis Queue)
+# Conexión para los workers RQ
+# RQ guarda los trabajos serializados (bytes comprimidos), así que sus
+# workers necesitan una conexión SIN decode_responses
+rq_connection = redis.Redis(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    db=settings.redis_db
+)
+
+# Cliente asíncrono para el API
+# Los endpoints de FastAPI son async: si usaran redis_client, cada llamada
+# bloquearía el event loop hasta que Redis respondiera. redis.asyncio
+# permite "await" sobre la red y seguir atendiendo otras peticiones.
+# Todos los endpoints comparten el mismo pool de conexiones.
+async_redis_pool = aioredis.ConnectionPool(
+    host=settings.redis_host,
+    port=settings.redis_port,
+    db=settings.redis_db,
+    max_connections=settings.redis_max_connections,
+    decode_responses=True
+)
+async_redis_client = aioredis.Redis(connection_pool=async_redis_pool)
+
+# Colas de trabajos usando RQ (Redis Queue)
 # RQ es una biblioteca que usa Redis para crear colas de trabajos
-# 'clinical_jobs' es el nombre de la cola
-job_queue = Queue('clinical_jobs', connection=redis_client)
+# Separamos el trabajo en dos etapas con colas (y workers) distintas:
+# - transcription_jobs: Whisper, intensivo en CPU, trabajos de minutos
+# - extraction_jobs: llamada al LLM, casi todo espera de red
+# Así los trabajos de texto no esperan detrás de los audios, y cada
+# etapa se escala con su propio tipo de worker.
+TRANSCRIPTION_QUEUE = "transcription_jobs"
+EXTRACTION_QUEUE = "extraction_jobs"
+transcription_queue = Queue(TRANSCRIPTION_QUEUE, connection=redis_client)
+extraction_queue = Queue(EXTRACTION_QUEUE, connection=redis_client)
+
+# Exportaciones masivas de resultados (app/export.py): trabajos largos
+# de I/O que no deben ocupar a los workers de las otras colas
+EXPORT_QUEUE = "export_jobs"
+export_queue = Queue(EXPORT_QUEUE, connection=redis_client)
+
+# Trabajos diferidos (POST /submit/batch?deferred=true): no van a una cola
+# RQ sino a esta lista, que app/batch_inference.py vacía en lotes de la
+# Batch API. Esperan horas en lugar de segundos, así que viven más
+DEFERRED_QUEUE_KEY = "deferred_jobs"
+DEFERRED_JOB_TTL = timedelta(hours=72)
+
+# Trabajos diferidos que un procesador de lotes ha sacado de la lista y aún
+# no están en un lote: una lista por reserva ("deferred_jobs:claim:{id}") y
+# un conjunto ordenado reserva -> instante, para devolverlos a la lista si
+# el procesador muere antes de terminar (ver recover_deferred_claims)
+DEFERRED_CLAIMS_KEY = "deferred_jobs:claims"
+
+# Trabajos que un worker asyncio ha sacado de una cola RQ y aún no ha
+# terminado: una lista por worker y cola ("async_worker:{id}:processing:{cola}")
+# y un conjunto ordenado lista -> último latido del worker, para devolverlos
+# a su cola si el worker muere (ver recover_processing_lists_async)
+PROCESSING_LISTS_KEY = "async_worker:processing"
+
+# Función del worker y timeout de cada etapa
+STAGE_FUNCTIONS = {
+    "transcription": "app.worker.process_transcription_job",
+    "extraction": "app.worker.process_clinical_job",
+    # Resumen narrativo bajo demanda (LLM_NARRATIVE_MODE=lazy), en la cola de extracción
+    "narrative": "app.worker.process_narrative_job"
+}
+
+# Los metadatos y resultados de los trabajos expiran a las 24 horas
+JOB_TTL = timedelta(hours=24)
+
+# Contadores de tokens que el worker guarda en "job:{id}" (ver app/compaction.py
+# y ClinicalAgent._record_usage): tokens de la transcripción original y tras
+# la compactación, y llamadas/tokens reales del LLM (llm_pack_size: trabajos
+# con los que compartió la llamada, ver app/packing.py)
+TOKEN_METRICS = (
+    "input_tokens_raw",
+    "input_tokens",
+    "llm_calls",
+    "llm_prompt_tokens",
+    "llm_completion_tokens",
+    "llm_usage_estimated",
+    "llm_pack_size"
+)
+
+# Estado de la narrativa cuando se completa la extracción estructurada,
+# según LLM_NARRATIVE_MODE (ver ClinicalAgent.process_clinical_text):
+# el trabajo pasa a "completed" sin esperar a la prosa, y narrative_status
+# sigue su propio ciclo (not_requested -> pending -> processing -> completed/failed)
+NARRATIVE_STATUS_ON_COMPLETE = {
+    "combined": "completed",
+    "concurrent": "processing",
+    "lazy": "not_requested"
+}
+
+# Canales pub/sub donde se publican los cambios de estado de cada trabajo
+JOB_EVENTS_PATTERN = "job_events:*"
+
+
+def job_events_channel(job_id: str) -> str:
+    """
+    Canal Redis en el que se publican los cambios de estado de un trabajo.
+    """
+    return f"job_events:{job_id}"
+
+
+def _build_job_metadata(job_id: str, job_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Construye el hash "job:{id}" que guardamos para cada trabajo.
+    
+    Lo comparten las versiones síncrona y asíncrona de enqueue_job.
+    """
+    return {
+        "job_id": job_id,
+        "status": "pending",
+        "created_at": datetime.now().isoformat(),
+        "text": job_data.get("text") or "",
+        "audio_filename": job_data.get("audio_filename") or "",
+        "audio_sha256": job_data.get("audio_sha256") or "",
+        "audio_size": job_data.get("audio_size") or 0,
+        "audio_url": job_data.get("audio_url") or "",
+        "job_class": job_data.get("job_class") or "interactive"
+    }
+
+
+def _job_stage(job_data: Dict[str, Any]) -> str:
+    """
+    Etapa en la que entra un trabajo nuevo: los audios sin texto empiezan
+    por la transcripción; el resto va directo a la extracción.
+    """
+    if job_data.get("audio_sha256") and not job_data.get("text"):
+        return "transcription"
+    return "extraction"
+
+
+def job_id_from_rq_id(rq_job_id: str) -> str:
+    """
+    job_id al que pertenece un trabajo RQ (quita el sufijo de etapa, si lo hay).
+    """
+    return rq_job_id.split("_", 1)[0]
+
+
+def stage_from_rq_id(rq_job_id: str) -> Optional[str]:
+    """
+    Etapa que indica el sufijo de un trabajo RQ ("narrative"), o None si no lo lleva.
+    """
+    _, _, stage = rq_job_id.partition("_")
+    return stage or None
+
+
+def _prepare_rq_job(job_id: str, stage: str = "extraction", follow_up: bool = False) -> Job:
+    """
+    Crea (sin guardarlo) el trabajo RQ que ejecutará el worker de una etapa.
+    
+    Usamos nuestro job_id también como ID del trabajo RQ, así
+    "job:{id}" y "rq:job:{id}" se refieren siempre al mismo trabajo.
+    Las etapas siguientes (follow_up=True, la extracción tras la
+    transcripción) llevan el sufijo "_{etapa}": son otro trabajo RQ, y RQ
+    guarda el estado final de la etapa anterior en "rq:job:{id}" DESPUÉS
+    de que ésta encola la siguiente.
+    """
+    if stage == "transcription":
+        queue, timeout = transcription_queue, settings.transcription_job_timeout
+    else:
+        queue, timeout = extraction_queue, settings.extraction_job_timeout
+    rq_job = queue.create_job(
+        STAGE_FUNCTIONS[stage],  # Función a ejecutar
+        args=(job_id,),  # Argumento para la función
+        timeout=timeout,  # Timeout propio de cada etapa
+        job_id=f"{job_id}_{stage}" if follow_up else job_id
+    )
+    rq_job.enqueued_at = utcnow()
+    return rq_job
+
+
+def _push_rq_job(pipe, rq_job: Job):
+    """
+    Añade a un pipeline los comandos que RQ usa para encolar un trabajo.
+    
+    Son los mismos comandos que ejecuta Queue.enqueue_job (registrar la
+    cola, guardar el hash del trabajo y hacer RPUSH del ID), pero escritos
+    en un pipeline que puede ser síncrono o asíncrono. Así el API puede
+    encolar sin usar el cliente bloqueante.
+    """
+    queue_key = f"{Queue.redis_queue_namespace_prefix}{rq_job.origin}"
+    pipe.sadd(Queue.redis_queues_keys, queue_key)
+    pipe.hset(rq_job.key, mapping=rq_job.to_dict())
+    pipe.rpush(queue_key, rq_job.id)
 
 
 def enqueue_job(job_data: Dict[str, Any]) -> str:
@@ -45,43 +231,196 @@ def enqueue_job(job_data: Dict[str, Any]) -> str:
     Explicación:
         1. Generamos un UUID único para el trabajo
         2. Guardamos los datos del trabajo en Redis con una clave única
-        3. Encolamos el trabajo en la cola RQ
+        3. Encolamos el trabajo en la cola RQ de su primera etapa: los audios
+           van a transcription_jobs y los textos directamente a extraction_jobs
         4. El worker (que está escuchando la cola) tomará este trabajo y lo procesará
+    
+        Los pasos 2 y 3 van en un único pipeline MULTI/EXEC: una sola ida y
+        vuelta a Redis, y el worker nunca ve un trabajo sin sus metadatos.
     """
     # Generar ID único para el trabajo
     # uuid4() genera un UUID aleatorio (muy poco probable de colisiones)
     job_id = str(uuid.uuid4())
     
-    # Guardar datos del trabajo en Redis
     # Usamos un hash de Redis para almacenar metadatos del trabajo
     job_key = f"job:{job_id}"
-    job_metadata = {
-        "job_id": job_id,
-        "status": "pending",
-        "created_at": datetime.now().isoformat(),
-        "text": job_data.get("text") or "",
-        "audio_filename": job_data.get("audio_filename") or "",
-        "audio_url": job_data.get("audio_url") or ""
-    }
     
+    # El trabajo RQ apunta a la función de su primera etapa
+    # (transcripción o extracción), que el worker ejecutará con job_id
+    rq_job = _prepare_rq_job(job_id, _job_stage(job_data))
+    
+    # transaction=True envuelve los comandos en MULTI/EXEC (atómico)
+    pipe = redis_client.pipeline(transaction=True)
     # Guardar en Redis con expiración de 24 horas
     # Esto previene que Redis se llene de trabajos antiguos
-    redis_client.hset(job_key, mapping=job_metadata)
-    redis_client.expire(job_key, timedelta(hours=24))
-    
+    pipe.hset(job_key, mapping=_build_job_metadata(job_id, job_data))
+    pipe.expire(job_key, JOB_TTL)
     # Encolar el trabajo en RQ
-    # job_queue.enqueue() añade el trabajo a la cola
-    # 'process_clinical_job' es la función que el worker ejecutará
-    # job_id se pasa como argumento a esa función
-    job_queue.enqueue(
-        'app.worker.process_clinical_job',  # Función a ejecutar
-        job_id,  # Argumento para la función
-        job_timeout=300  # Timeout de 5 minutos para el trabajo
-    )
+    _push_rq_job(pipe, rq_job)
+    pipe.execute()
+    
+    return job_id
+
+
+async def enqueue_job_async(job_data: Dict[str, Any]) -> str:
+    """
+    Versión asíncrona de enqueue_job para los endpoints del API.
+    
+    Guarda los metadatos y encola el trabajo RQ en un único pipeline
+    sobre el cliente asíncrono, sin bloquear el event loop.
+    """
+    job_id = str(uuid.uuid4())
+    job_key = f"job:{job_id}"
+    rq_job = _prepare_rq_job(job_id, _job_stage(job_data))
+    
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key, mapping=_build_job_metadata(job_id, job_data))
+        pipe.expire(job_key, JOB_TTL)
+        _push_rq_job(pipe, rq_job)
+        await pipe.execute()
     
     return job_id
 
 
+async def enqueue_jobs_async(job_data_list: List[Dict[str, Any]], deferred: bool = False) -> List[str]:
+    """
+    Encola varios trabajos con un solo pipeline (carga masiva).
+    
+    Es la versión en lote de enqueue_job_async: todos los metadatos y
+    los trabajos RQ se escriben en una única ida y vuelta a Redis,
+    en lugar de una por trabajo.
+    
+    Con deferred=True (sólo texto) los trabajos van a DEFERRED_QUEUE_KEY
+    en lugar de a extraction_jobs: se procesan en lotes de la Batch API
+    (ver app/batch_inference.py), más baratos y sin ocupar el límite de
+    peticiones de los trabajos interactivos.
+    
+    Returns:
+        Lista de job_ids, en el mismo orden que job_data_list
+    """
+    job_ids = []
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        for job_data in job_data_list:
+            job_id = str(uuid.uuid4())
+            job_key = f"job:{job_id}"
+            if deferred:
+                pipe.hset(job_key, mapping=_build_job_metadata(job_id, {**job_data, "job_class": "deferred"}))
+                pipe.expire(job_key, DEFERRED_JOB_TTL)
+                pipe.rpush(DEFERRED_QUEUE_KEY, job_id)
+            else:
+                pipe.hset(job_key, mapping=_build_job_metadata(job_id, job_data))
+                pipe.expire(job_key, JOB_TTL)
+                _push_rq_job(pipe, _prepare_rq_job(job_id, _job_stage(job_data)))
+            job_ids.append(job_id)
+        await pipe.execute()
+    
+    return job_ids
+
+
+def deferred_claim_key(claim_id: str) -> str:
+    """
+    Lista con los trabajos diferidos de una reserva.
+    """
+    return f"deferred_jobs:claim:{claim_id}"
+
+
+def claim_deferred_jobs(claim_id: str, max_jobs: int) -> List[str]:
+    """
+    Reserva hasta max_jobs trabajos diferidos, en orden de llegada.
+    
+    Los trabajos pasan de la lista a la reserva claim_id en un MULTI/EXEC
+    con WATCH: dos procesos que vacían la lista a la vez nunca se llevan
+    el mismo trabajo, y ninguno se pierde aunque el proceso muera antes de
+    meterlos en un lote (release_deferred_claim o requeue_deferred_jobs
+    cierran la reserva).
+    """
+    def move(pipe):
+        job_ids = pipe.lrange(DEFERRED_QUEUE_KEY, 0, max_jobs - 1)
+        pipe.multi()
+        if job_ids:
+            pipe.ltrim(DEFERRED_QUEUE_KEY, len(job_ids), -1)
+            pipe.rpush(deferred_claim_key(claim_id), *job_ids)
+            pipe.zadd(DEFERRED_CLAIMS_KEY, {claim_id: datetime.now().timestamp()})
+        return job_ids
+    
+    return redis_client.transaction(move, DEFERRED_QUEUE_KEY, value_from_callable=True)
+
+
+def release_deferred_claim(pipe, claim_id: str):
+    """
+    Añade a un pipeline los comandos que cierran una reserva (sus trabajos
+    ya están en un lote, devueltos a la lista o terminados).
+    """
+    pipe.delete(deferred_claim_key(claim_id))
+    pipe.zrem(DEFERRED_CLAIMS_KEY, claim_id)
+
+
+def push_deferred_jobs(pipe, job_ids: List[str]):
+    """
+    Añade a un pipeline la devolución de trabajos al principio de la lista
+    de diferidos, conservando su orden.
+    """
+    if job_ids:
+        pipe.lpush(DEFERRED_QUEUE_KEY, *reversed(job_ids))
+
+
+def requeue_deferred_jobs(job_ids: List[str], claim_id: Optional[str] = None):
+    """
+    Devuelve trabajos diferidos al principio de la lista (p. ej. los de
+    un lote que expiró sin terminarlos), conservando su orden.
+    
+    Con claim_id, en el mismo MULTI/EXEC se cierra esa reserva.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    push_deferred_jobs(pipe, job_ids)
+    if claim_id is not None:
+        release_deferred_claim(pipe, claim_id)
+    pipe.execute()
+
+
+def recover_deferred_claims(older_than_seconds: float) -> int:
+    """
+    Devuelve a la lista los trabajos de las reservas abandonadas (más
+    antiguas que older_than_seconds: su procesador murió antes de meterlos
+    en un lote).
+    
+    Returns:
+        Trabajos devueltos a la lista
+    """
+    recovered = 0
+    cutoff = datetime.now().timestamp() - older_than_seconds
+    for claim_id in redis_client.zrangebyscore(DEFERRED_CLAIMS_KEY, 0, cutoff):
+        claim_key = deferred_claim_key(claim_id)
+        
+        def move(pipe):
+            job_ids = pipe.lrange(claim_key, 0, -1)
+            pipe.multi()
+            push_deferred_jobs(pipe, job_ids)
+            release_deferred_claim(pipe, claim_id)
+            return len(job_ids)
+        
+        recovered += redis_client.transaction(move, claim_key, value_from_callable=True)
+    return recovered
+
+
+def _merge_job_result(job_data: Dict[str, Any], result_data: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Combina el hash del trabajo con su resultado (leídos en el mismo pipeline).
+    
+    HGETALL devuelve un diccionario vacío si la clave no existe,
+    así que no necesitamos un EXISTS previo.
+    """
+    if not job_data:
+        return None
+    
+    # Si el trabajo está completado, adjuntar el resultado
+    if job_data.get("status") == "completed" and result_data:
+        # json.loads convierte el string JSON a un diccionario Python
+        job_data["clinical_summary"] = json.loads(result_data)
+    
+    return job_data
+
+
 def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
     """
     Obtiene el estado y resultado de un trabajo.
@@ -94,29 +433,91 @@ def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
     
     Explicación:
         El worker guarda el resultado en Redis cuando termina.
-        Esta función lee ese resultado.
+        Esta función lee el hash del trabajo y el resultado en un
+        único MULTI/EXEC, así ambos corresponden al mismo instante.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hgetall(f"job:{job_id}")
+    pipe.get(f"result:{job_id}")
+    job_data, result_data = pipe.execute()
+    
+    return _merge_job_result(job_data, result_data)
+
+
+async def get_job_status_async(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Versión asíncrona de get_job_status para los endpoints del API.
+    """
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(f"job:{job_id}")
+        pipe.get(f"result:{job_id}")
+        job_data, result_data = await pipe.execute()
+    
+    return _merge_job_result(job_data, result_data)
+
+
+async def ping_async() -> bool:
+    """
+    Verifica la conexión a Redis sin bloquear el event loop.
+    """
+    return await async_redis_client.ping()
+
+
+def _write_job_status(
+    pipe,
+    job_id: str,
+    status: str,
+    result: Optional[Dict[str, Any]] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
+    """
+    Añade a un pipeline los comandos de update_job_status.
+    
+    Lo comparten la versión síncrona (workers RQ) y la asíncrona (worker asyncio).
     """
     job_key = f"job:{job_id}"
+    fields = {"status": status}
     
-    # Verificar si el trabajo existe
-    if not redis_client.exists(job_key):
-        return None
+    # Si hay un resultado, guardarlo en una clave separada
+    if result:
+        pipe.setex(
+            f"result:{job_id}",
+            JOB_TTL,  # Expira en 24 horas
+            json.dumps(result)  # Convertir dict a JSON string
+        )
+        fields["completed_at"] = datetime.now().isoformat()
     
-    # Obtener todos los campos del hash
-    job_data = redis_client.hgetall(job_key)
+    # Si hay un error, guardarlo
+    if error:
+        fields["error"] = error
+        fields["completed_at"] = datetime.now().isoformat()
     
-    # Si el trabajo está completado, también obtener el resultado
-    if job_data.get("status") == "completed":
-        result_key = f"result:{job_id}"
-        result_data = redis_client.get(result_key)
-        if result_data:
-            # json.loads convierte el string JSON a un diccionario Python
-            job_data["clinical_summary"] = json.loads(result_data)
+    # Contadores del trabajo (tokens de entrada, uso del LLM) en el mismo hash
+    if metrics:
+        fields.update(metrics)
     
-    return job_data
+    # Actualizar estado (y marcas de tiempo) con un solo HSET
+    pipe.hset(job_key, mapping=fields)
+    # Inicio del procesamiento: HSETNX conserva el primero (un audio pasa
+    # por "processing" en la transcripción y otra vez en la extracción).
+    # created_at -> started_at es la espera en cola.
+    if status == "processing":
+        pipe.hsetnx(job_key, "started_at", datetime.now().isoformat())
+    # Notificar el cambio (el evento no incluye el resultado: es ligero)
+    event = {"job_id": job_id, "status": status}
+    if "completed_at" in fields:
+        event["completed_at"] = fields["completed_at"]
+    pipe.publish(job_events_channel(job_id), json.dumps(event))
 
 
-def update_job_status(job_id: str, status: str, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+def update_job_status(
+    job_id: str,
+    status: str,
+    result: Optional[Dict[str, Any]] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
     """
     Actualiza el estado de un trabajo.
     
@@ -127,24 +528,334 @@ def update_job_status(job_id: str, status: str, result: Optional[Dict[str, Any]]
         status: Nuevo estado (processing, completed, failed)
         result: Resultado del procesamiento (si está completo)
         error: Mensaje de error (si falló)
+        metrics: Contadores y metadatos que se guardan como campos del hash
+                 del trabajo (p. ej. input_tokens, llm_prompt_tokens; ver
+                 TOKEN_METRICS, y output_schema)
+    
+    Explicación:
+        Todos los cambios van en un único MULTI/EXEC. El resultado se
+        escribe en la misma transacción que status=completed, así que
+        ningún cliente puede ver el trabajo completado sin su resultado.
+        En la misma transacción publicamos el cambio en el canal
+        job_events:{job_id}, para que el API avise a los clientes que
+        esperan (long-poll, SSE, WebSocket) sin que tengan que hacer polling.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    _write_job_status(pipe, job_id, status, result, error, metrics)
+    pipe.execute()
+
+
+async def update_job_status_async(
+    job_id: str,
+    status: str,
+    result: Optional[Dict[str, Any]] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
+    """
+    Versión asíncrona de update_job_status para el worker asyncio.
+    """
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        _write_job_status(pipe, job_id, status, result, error, metrics)
+        await pipe.execute()
+
+
+def enqueue_extraction(job_id: str, transcript: str):
+    """
+    Pasa un trabajo transcrito a la cola de extracción.
+    
+    En un único MULTI/EXEC guardamos la transcripción en el hash del
+    trabajo y encolamos la etapa de extracción. El trabajo sigue en
+    estado "processing": para el cliente es un único trabajo.
     """
     job_key = f"job:{job_id}"
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(job_key, mapping={"text": transcript, "transcribed_at": datetime.now().isoformat()})
+    _push_rq_job(pipe, _prepare_rq_job(job_id, "extraction", follow_up=True))
+    pipe.execute()
+
+
+def _write_job_partial(pipe, job_id: str, partial: Dict[str, Any]):
+    pipe.hset(f"job:{job_id}", "partial_result", json.dumps(partial, ensure_ascii=False))
+    pipe.publish(
+        job_events_channel(job_id),
+        json.dumps({"job_id": job_id, "status": "processing", "partial": True})
+    )
+
+
+def update_job_partial(job_id: str, partial: Dict[str, Any]):
+    """
+    Guarda los campos extraídos hasta ahora mientras el LLM sigue generando.
+    
+    Se guardan en el campo "partial_result" del hash del trabajo y se
+    notifica por el canal de eventos, así los clientes (SSE, WebSocket)
+    ven la edad, el género o los síntomas antes de que termine la narrativa.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    _write_job_partial(pipe, job_id, partial)
+    pipe.execute()
+
+
+async def update_job_partial_async(job_id: str, partial: Dict[str, Any]):
+    """
+    Versión asíncrona de update_job_partial para el worker asyncio.
+    """
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        _write_job_partial(pipe, job_id, partial)
+        await pipe.execute()
+
+
+def processing_list_key(worker_id: str, queue_name: str) -> str:
+    """
+    Lista con los trabajos de una cola que un worker asyncio tiene en vuelo.
+    """
+    return f"async_worker:{worker_id}:processing:{queue_name}"
+
+
+async def pop_rq_job_id_async(queue_names: List[str], timeout: int, worker_id: str) -> Optional[Tuple[str, str]]:
+    """
+    Saca el siguiente trabajo de las colas RQ, o None si no llega ninguno.
     
-    # Actualizar estado
-    redis_client.hset(job_key, "status", status)
+    Como el ID del trabajo RQ es nuestro job_id (más un sufijo de etapa,
+    ver job_id_from_rq_id), el worker asyncio puede consumir las mismas
+    colas que los workers RQ sin deserializar el trabajo.
     
-    # Si hay un resultado, guardarlo en una clave separada
-    if result:
-        result_key = f"result:{job_id}"
-        redis_client.setex(
-            result_key,
-            timedelta(hours=24),  # Expira en 24 horas
-            json.dumps(result)  # Convertir dict a JSON string
+    El trabajo no desaparece de Redis: LMOVE lo pasa de la cola a la lista
+    de trabajos en vuelo del worker (processing_list_key) en una sola
+    operación, y ack_rq_job_async lo quita al terminar. Si el worker muere
+    entre medias, recover_processing_lists_async lo devuelve a su cola.
+    
+    Probamos las colas en orden sin bloquear; si están vacías, esperamos
+    (BLMOVE) en la primera: timeout segundos con una sola cola, uno con
+    varias, para volver pronto a mirar las demás.
+    
+    Returns:
+        (cola, ID del trabajo RQ) o None
+    """
+    for name in queue_names:
+        rq_job_id = await async_redis_client.lmove(
+            f"{Queue.redis_queue_namespace_prefix}{name}", processing_list_key(worker_id, name), "LEFT", "RIGHT"
         )
-        redis_client.hset(job_key, "completed_at", datetime.now().isoformat())
+        if rq_job_id is not None:
+            return name, rq_job_id
+    name = queue_names[0]
+    rq_job_id = await async_redis_client.blmove(
+        f"{Queue.redis_queue_namespace_prefix}{name}",
+        processing_list_key(worker_id, name),
+        timeout if len(queue_names) == 1 else 1,
+        "LEFT",
+        "RIGHT"
+    )
+    if rq_job_id is None:
+        return None
+    return name, rq_job_id
+
+
+async def ack_rq_job_async(worker_id: str, queue_name: str, rq_job_id: str):
+    """
+    Quita un trabajo terminado (completado o fallido) de la lista en vuelo del worker.
+    """
+    await async_redis_client.lrem(processing_list_key(worker_id, queue_name), 1, rq_job_id)
+
+
+async def touch_processing_lists_async(worker_id: str, queue_names: List[str]):
+    """
+    Latido del worker: anota el instante actual en sus listas de trabajos en vuelo.
+    """
+    now = datetime.now().timestamp()
+    await async_redis_client.zadd(
+        PROCESSING_LISTS_KEY, {processing_list_key(worker_id, name): now for name in queue_names}
+    )
+
+
+async def release_processing_lists_async(worker_id: str, queue_names: List[str]):
+    """
+    Da de baja las listas de un worker que se detiene. Las que aún tienen
+    trabajos (p. ej. un ack que falló) siguen registradas y se recuperan.
+    """
+    for name in queue_names:
+        key = processing_list_key(worker_id, name)
+        if not await async_redis_client.llen(key):
+            await async_redis_client.zrem(PROCESSING_LISTS_KEY, key)
+
+
+async def recover_processing_lists_async(older_than_seconds: float) -> int:
+    """
+    Devuelve a su cola los trabajos de los workers asyncio muertos (cuyo
+    último latido es más antiguo que older_than_seconds).
     
-    # Si hay un error, guardarlo
+    Los trabajos vuelven al principio de la cola, en su orden, y se
+    procesan de nuevo desde el principio: su hash "job:{id}" se había
+    quedado en "processing".
+    
+    Returns:
+        Trabajos devueltos a las colas
+    """
+    recovered = 0
+    cutoff = datetime.now().timestamp() - older_than_seconds
+    for key in await async_redis_client.zrangebyscore(PROCESSING_LISTS_KEY, 0, cutoff):
+        queue_key = f"{Queue.redis_queue_namespace_prefix}{key.rsplit(':processing:', 1)[1]}"
+        # Cada LMOVE es atómico: dos workers recuperando a la vez no duplican trabajos
+        while await async_redis_client.lmove(key, queue_key, "RIGHT", "LEFT") is not None:
+            recovered += 1
+        await async_redis_client.zrem(PROCESSING_LISTS_KEY, key)
+    return recovered
+
+
+async def mark_rq_job_async(rq_job_id: str, status: str):
+    """
+    Refleja en el trabajo RQ (rq:job:{id}) el estado que le da el worker asyncio.
+    
+    Así las herramientas de RQ (rq info, dashboards) ven los trabajos
+    iniciados y terminados aunque no los haya ejecutado un worker RQ.
+    """
+    timestamp_field = "started_at" if status == "started" else "ended_at"
+    rq_job_key = f"{Job.redis_job_namespace_prefix}{rq_job_id}"
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(rq_job_key, mapping={"status": status, timestamp_field: utcformat(utcnow())})
+        if status != "started":
+            pipe.expire(rq_job_key, JOB_TTL)
+        await pipe.execute()
+
+
+def _narrative_result_data(job_id: str, stored: Optional[str], narrative: str) -> str:
+    """
+    El resultado guardado del trabajo con su narrative_summary actualizado.
+    """
+    if stored is None:
+        raise ValueError(f"Resultado del trabajo {job_id} no encontrado")
+    result = json.loads(stored)
+    result["narrative_summary"] = narrative
+    return json.dumps(result)
+
+
+def _write_job_narrative(
+    pipe,
+    job_id: str,
+    narrative_status: str,
+    result_data: Optional[str] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
+    """
+    Añade a un pipeline los comandos de update_job_narrative.
+    """
+    job_key = f"job:{job_id}"
+    fields = {"narrative_status": narrative_status}
+    if result_data is not None:
+        pipe.setex(f"result:{job_id}", JOB_TTL, result_data)
+        fields["narrative_completed_at"] = datetime.now().isoformat()
     if error:
-        redis_client.hset(job_key, "error", error)
-        redis_client.hset(job_key, "completed_at", datetime.now().isoformat())
+        fields["narrative_error"] = error
+        fields["narrative_completed_at"] = datetime.now().isoformat()
+    if metrics:
+        fields.update(metrics)
+    pipe.hset(job_key, mapping=fields)
+    # El trabajo ya estaba completado: el evento sólo anuncia la narrativa
+    pipe.publish(
+        job_events_channel(job_id),
+        json.dumps({"job_id": job_id, "status": "completed", "narrative_status": narrative_status})
+    )
+
+
+def update_job_narrative(
+    job_id: str,
+    narrative_status: str,
+    narrative: Optional[str] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
+    """
+    Actualiza el resumen narrativo de un trabajo ya completado.
+    
+    Args:
+        job_id: ID del trabajo
+        narrative_status: Nuevo estado de la narrativa (processing, completed, failed)
+        narrative: Texto del resumen (se escribe en "result:{id}")
+        error: Mensaje de error (si falló la narrativa; el trabajo sigue completado)
+        metrics: Contadores del trabajo (uso del LLM, incluida la llamada narrativa)
+    
+    Explicación:
+        El resultado es un JSON en "result:{id}": para cambiar sólo su
+        narrative_summary lo leemos y lo reescribimos. WATCH sobre la clave
+        garantiza que nadie lo cambió entre la lectura y el MULTI/EXEC
+        (si alguien lo hizo, redis-py repite la función).
+    """
+    result_key = f"result:{job_id}"
+    
+    def write(pipe):
+        result_data = None
+        if narrative is not None:
+            result_data = _narrative_result_data(job_id, pipe.get(result_key), narrative)
+        pipe.multi()
+        _write_job_narrative(pipe, job_id, narrative_status, result_data, error, metrics)
+    
+    redis_client.transaction(write, result_key)
+
+
+async def update_job_narrative_async(
+    job_id: str,
+    narrative_status: str,
+    narrative: Optional[str] = None,
+    error: Optional[str] = None,
+    metrics: Optional[Dict[str, Any]] = None
+):
+    """
+    Versión asíncrona de update_job_narrative para el worker asyncio.
+    """
+    result_key = f"result:{job_id}"
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                result_data = None
+                if narrative is not None:
+                    await pipe.watch(result_key)
+                    result_data = _narrative_result_data(job_id, await pipe.get(result_key), narrative)
+                pipe.multi()
+                _write_job_narrative(pipe, job_id, narrative_status, result_data, error, metrics)
+                await pipe.execute()
+                return
+            except WatchError:
+                continue
 
+
+async def request_narrative_async(job_id: str) -> Optional[str]:
+    """
+    Pide el resumen narrativo de un trabajo (modo lazy, desde el API).
+    
+    La primera petición encola su generación (un trabajo RQ
+    "{job_id}_narrative" en extraction_jobs); las siguientes sólo leen el
+    estado.
+    
+    Returns:
+        narrative_status tras la petición (None si el trabajo no existe)
+    
+    Explicación:
+        WATCH sobre "job:{id}": si dos peticiones llegan a la vez, sólo el
+        MULTI/EXEC de una tiene éxito; la otra repite la lectura, ve
+        "pending" y no encola otra vez.
+    """
+    job_key = f"job:{job_id}"
+    async with async_redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(job_key)
+                if not await pipe.exists(job_key):
+                    return None
+                narrative_status = await pipe.hget(job_key, "narrative_status")
+                if narrative_status != "not_requested":
+                    await pipe.unwatch()
+                    # Sin narrative_status: trabajo anterior a la narrativa
+                    # desacoplada, con la narrativa ya en el resultado
+                    return narrative_status or "completed"
+                pipe.multi()
+                pipe.hset(job_key, mapping={
+                    "narrative_status": "pending",
+                    "narrative_requested_at": datetime.now().isoformat()
+                })
+                pipe.hdel(job_key, "narrative_error")
+                _push_rq_job(pipe, _prepare_rq_job(job_id, "narrative", follow_up=True))
+                await pipe.execute()
+                return "pending"
+            except WatchError:
+                continue
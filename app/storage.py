@@ -0,0 +1,101 @@
+"""
+Almacenamiento de audio direccionado por contenido.
+
+Los archivos de audio subidos al API se guardan en un directorio compartido
+(un volumen montado tanto en el API como en el worker). Cada archivo se
+nombra con el hash SHA-256 de su contenido, así:
+
+- El API escribe el audio en bloques de tamaño fijo, sin cargarlo completo en memoria
+- El worker encuentra el archivo sólo con el hash guardado en Redis
+- Dos subidas idénticas terminan en el mismo archivo (deduplicación gratis)
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from typing import BinaryIO, Dict, Any, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Un hash SHA-256 en hexadecimal tiene exactamente 64 caracteres
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def blob_path(sha256: str) -> str:
+    """
+    Devuelve la ruta donde se guarda (o se guardaría) un blob.
+
+    Usamos los dos primeros caracteres del hash como subdirectorio
+    para no acumular cientos de miles de archivos en una sola carpeta.
+    """
+    if not _SHA256_RE.match(sha256):
+        raise ValueError(f"Hash de audio inválido: {sha256!r}")
+    return os.path.join(settings.audio_storage_dir, sha256[:2], sha256)
+
+
+def store_audio_stream(fileobj: BinaryIO, chunk_size: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Copia un stream de audio al almacén, calculando su hash mientras se escribe.
+
+    Args:
+        fileobj: Objeto tipo archivo (binario) del que leer el audio
+        chunk_size: Tamaño de cada bloque leído (por defecto settings.upload_chunk_size)
+
+    Returns:
+        Diccionario con sha256, size y path del blob almacenado
+
+    Explicación:
+        1. Escribimos en un archivo temporal dentro del mismo directorio
+        2. Actualizamos el hash con cada bloque (memoria constante)
+        3. Al terminar, renombramos el temporal a su nombre definitivo.
+           os.replace es atómico en el mismo sistema de archivos, así que
+           el worker nunca ve un archivo a medio escribir.
+    """
+    chunk_size = chunk_size or settings.upload_chunk_size
+    os.makedirs(settings.audio_storage_dir, exist_ok=True)
+
+    hasher = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=settings.audio_storage_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                tmp_file.write(chunk)
+                size += len(chunk)
+
+        sha256 = hasher.hexdigest()
+        final_path = blob_path(sha256)
+        if os.path.exists(final_path):
+            # Mismo contenido ya almacenado: descartamos la copia nueva
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info(f"Audio almacenado: {sha256} ({size} bytes)")
+    return {"sha256": sha256, "size": size, "path": final_path}
+
+
+def resolve_audio_path(sha256: str) -> str:
+    """
+    Devuelve la ruta local de un audio almacenado a partir de su hash.
+
+    Raises:
+        FileNotFoundError: si el blob no existe en el almacén
+    """
+    path = blob_path(sha256)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Audio {sha256} no encontrado en {settings.audio_storage_dir}")
+    return path
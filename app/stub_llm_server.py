@@ -0,0 +1,373 @@
+"""
+Servidor LLM de pruebas compatible con la API de OpenAI.
+
+Implementa POST /v1/chat/completions (normal y con stream=True) y
+devuelve el JSON clínico que espera el agente, construido a partir de
+la conversación del prompt (edad, género, síntomas, factores de riesgo).
+No llama a ningún modelo: responde tras una latencia simulada.
+
+Sirve para pruebas de carga y planificación de capacidad sin coste:
+- La latencia sigue una distribución configurable (fixed, uniform,
+  lognormal, exponential) más un tiempo opcional por token generado
+- Una fracción configurable de peticiones responde 429 o 500
+- Por encima de STUB_LLM_MAX_CONCURRENCY peticiones simultáneas responde
+  429, como un proveedor saturado (útil para probar el limitador adaptativo)
+
+Uso:
+    python -m app.stub_llm_server --port 8100 --latency-median-ms 1500 --rate-limit-rate 0.05
+    LLM_BACKEND=stub python -m app.async_worker extraction_jobs
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.config import settings
+from app.output_schema import COMPACT_MARKER, encode_output
+
+app = FastAPI(title="Stub LLM (compatible con OpenAI)")
+
+# Contadores expuestos en GET /stats
+stats = {"requests": 0, "rate_limited": 0, "errors": 0, "in_flight": 0, "peak_in_flight": 0}
+
+# Vocabulario para construir respuestas realistas a partir del texto
+SYMPTOMS = {
+    "dolor de cabeza": "cefalea",
+    "cefalea": "cefalea",
+    "fiebre": "fiebre",
+    "tos": "tos",
+    "náuseas": "náuseas",
+    "vómitos": "vómitos",
+    "mareo": "mareo",
+    "fatiga": "fatiga",
+    "cansancio": "fatiga",
+    "dolor abdominal": "dolor abdominal",
+    "dolor de estómago": "dolor abdominal",
+    "dolor en el pecho": "dolor torácico",
+    "dolor torácico": "dolor torácico",
+    "falta de aire": "disnea",
+    "dificultad para respirar": "disnea",
+    "dolor de garganta": "odinofagia",
+    "dolor de espalda": "lumbalgia",
+}
+RISK_FACTORS = {
+    "fumador": "tabaquismo",
+    "fuma": "tabaquismo",
+    "diabetes": "diabetes mellitus",
+    "hipertensión": "hipertensión arterial",
+    "tensión alta": "hipertensión arterial",
+    "obesidad": "obesidad",
+    "colesterol": "dislipidemia",
+    "antecedentes familiares": "historial familiar",
+    "historial familiar": "historial familiar",
+    "alcohol": "consumo de alcohol",
+}
+CONDITIONS = {
+    "cefalea": "migraña",
+    "fiebre": "infección viral",
+    "tos": "infección respiratoria",
+    "dolor torácico": "síndrome coronario a descartar",
+    "disnea": "insuficiencia respiratoria a descartar",
+    "dolor abdominal": "gastroenteritis",
+    "odinofagia": "faringitis",
+    "lumbalgia": "lumbalgia mecánica",
+}
+SEVERITIES = ("leve", "moderado", "severo")
+
+# Cada conversación de un prompt agrupado (ver ClinicalAgent._build_packed_prompt)
+_PACKED_RE = re.compile(r"=== CONVERSACIÓN \d+ ===\n(.*?)(?=\n\n=== CONVERSACIÓN |\s*Por favor, extrae)", re.DOTALL)
+
+
+def _conversation_from_messages(messages: List[Dict[str, Any]]) -> str:
+    """
+    Extrae la conversación clínica del prompt del agente (o el último mensaje).
+    """
+    content = str(messages[-1].get("content", "")) if messages else ""
+    match = re.search(r"CONVERSACIÓN:\s*(.*?)\s*Por favor, (?:extrae|redacta)", content, re.DOTALL)
+    return match.group(1) if match else content
+
+
+def _output_schema_from_messages(messages: List[Dict[str, Any]]) -> str:
+    """
+    Esquema de salida que pide el prompt ("compact" si lleva su marca).
+    """
+    content = str(messages[-1].get("content", "")) if messages else ""
+    return "compact" if COMPACT_MARKER in content else "full"
+
+
+def _packed_conversations(content: str) -> List[str]:
+    """
+    Conversaciones de un prompt agrupado ("=== CONVERSACIÓN 1 ===", ...), en orden.
+    """
+    return _PACKED_RE.findall(content)
+
+
+def build_packed_response(conversations: List[str], schema: str) -> str:
+    """
+    Lista JSON con un objeto por conversación y su número en "id".
+    """
+    items = [
+        {"id": number, **json.loads(encode_output(build_clinical_json(text), schema))}
+        for number, text in enumerate(conversations, 1)
+    ]
+    if schema == "full":
+        return json.dumps(items, ensure_ascii=False, indent=4)
+    return json.dumps(items, ensure_ascii=False, separators=(",", ":"))
+
+
+def build_response_content(messages: List[Dict[str, Any]]) -> str:
+    """
+    Respuesta a un prompt del agente, según lo que pide:
+
+    - Sólo el resumen narrativo ("Redacta un resumen narrativo"): texto plano
+    - Varias conversaciones numeradas (llamada agrupada): una lista JSON
+    - Sólo los campos estructurados (la plantilla no tiene narrativa)
+    - Todo junto (la llamada combinada)
+    """
+    content = str(messages[-1].get("content", "")) if messages else ""
+    packed = _packed_conversations(content)
+    if packed:
+        return build_packed_response(packed, _output_schema_from_messages(messages))
+    fields = build_clinical_json(_conversation_from_messages(messages))
+    if content.lstrip().startswith("Redacta un resumen narrativo"):
+        return fields["narrative_summary"]
+    if '"narrative_summary"' not in content and '"n":' not in content:
+        del fields["narrative_summary"]
+    return encode_output(fields, _output_schema_from_messages(messages))
+
+
+def build_clinical_json(text: str) -> Dict[str, Any]:
+    """
+    Construye una respuesta con la estructura del prompt a partir del texto.
+    """
+    lower = text.lower()
+    age_match = re.search(r"(\d{1,3})\s*años", lower)
+    gender = None
+    if re.search(r"\b(mujer|femenin[oa]|señora)\b", lower):
+        gender = "femenino"
+    elif re.search(r"\b(hombre|masculino|varón|señor)\b", lower):
+        gender = "masculino"
+
+    duration_match = re.search(r"(?:hace|durante|desde)\s+(\d+\s+(?:horas?|días?|semanas?|meses?|años?))", lower)
+    duration = duration_match.group(1) if duration_match else None
+
+    symptoms = []
+    seen = set()
+    for phrase, name in SYMPTOMS.items():
+        if phrase in lower and name not in seen:
+            seen.add(name)
+            symptoms.append({
+                "name": name,
+                "duration": duration,
+                "severity": SEVERITIES[len(phrase) % len(SEVERITIES)],
+                "description": f"Refiere {phrase}"
+            })
+
+    risk_factors = sorted({label for phrase, label in RISK_FACTORS.items() if phrase in lower})
+    conditions = [CONDITIONS[s["name"]] for s in symptoms if s["name"] in CONDITIONS]
+
+    subject = "Paciente"
+    if age_match:
+        subject += f" de {age_match.group(1)} años"
+    complaint = ", ".join(s["name"] for s in symptoms) or "motivo de consulta no especificado"
+    narrative = f"{subject} que consulta por {complaint}"
+    if duration:
+        narrative += f" de {duration} de evolución"
+    if risk_factors:
+        narrative += f". Antecedentes: {', '.join(risk_factors)}"
+    narrative += "."
+
+    return {
+        "patient_age": int(age_match.group(1)) if age_match else None,
+        "patient_gender": gender,
+        "symptoms": symptoms,
+        "risk_factors": risk_factors,
+        "relevant_conditions": conditions,
+        "narrative_summary": narrative
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Aproximación habitual: ~4 caracteres por token.
+    """
+    return max(1, len(text) // 4)
+
+
+def sample_latency_seconds() -> float:
+    """
+    Latencia base (hasta el primer token) según la distribución configurada.
+    """
+    median = settings.stub_llm_latency_median_ms / 1000
+    sigma = settings.stub_llm_latency_sigma
+    distribution = settings.stub_llm_latency_distribution
+    if distribution == "fixed":
+        return median
+    if distribution == "uniform":
+        return random.uniform(median * (1 - sigma), median * (1 + sigma))
+    if distribution == "exponential":
+        return random.expovariate(1 / median) if median > 0 else 0.0
+    # lognormal: la mediana de exp(N(mu, sigma)) es exp(mu)
+    return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+def _error_response(status_code: int, message: str, error_type: str) -> JSONResponse:
+    headers = {"retry-after": "1"} if status_code == 429 else None
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": {"message": message, "type": error_type, "code": None, "param": None}},
+        headers=headers
+    )
+
+
+def _check_failures() -> Optional[JSONResponse]:
+    """
+    Decide si esta petición falla (saturación o error aleatorio).
+    """
+    if settings.stub_llm_max_concurrency and stats["in_flight"] > settings.stub_llm_max_concurrency:
+        stats["rate_limited"] += 1
+        return _error_response(429, "Too many concurrent requests (stub)", "rate_limit_exceeded")
+    roll = random.random()
+    if roll < settings.stub_llm_rate_limit_rate:
+        stats["rate_limited"] += 1
+        return _error_response(429, "Rate limit reached (stub)", "rate_limit_exceeded")
+    if roll < settings.stub_llm_rate_limit_rate + settings.stub_llm_error_rate:
+        stats["errors"] += 1
+        return _error_response(500, "Internal server error (stub)", "server_error")
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """
+    Equivalente de la API de OpenAI: respuesta completa o stream SSE.
+    """
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "stub")
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+    streaming = False
+
+    try:
+        failure = _check_failures()
+        if failure is not None:
+            # Los errores también tardan (menos que una respuesta normal)
+            await asyncio.sleep(sample_latency_seconds() / 10)
+            return failure
+
+        # Mismo contenido, en el esquema de salida y con las partes que pide el prompt
+        content = build_response_content(messages)
+        prompt_tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+        completion_tokens = estimate_tokens(content)
+        completion_id = f"chatcmpl-stub-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        per_token = 1 / settings.stub_llm_tokens_per_second if settings.stub_llm_tokens_per_second > 0 else 0.0
+
+        if body.get("stream"):
+            streaming = True
+            return StreamingResponse(
+                _stream_chunks(completion_id, created, model, content, per_token),
+                media_type="text/event-stream"
+            )
+
+        await asyncio.sleep(sample_latency_seconds() + per_token * completion_tokens)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+    finally:
+        # En streaming, el contador se libera al terminar el stream
+        if not streaming:
+            stats["in_flight"] -= 1
+
+
+async def _stream_chunks(completion_id: str, created: int, model: str, content: str, per_token: float):
+    """
+    Produce la respuesta como eventos SSE "chat.completion.chunk", ~4 caracteres por token.
+    """
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    try:
+        await asyncio.sleep(sample_latency_seconds())
+        yield chunk({"role": "assistant", "content": ""})
+        # Agrupamos 8 tokens por evento para no generar miles de eventos
+        step = 32
+        for start in range(0, len(content), step):
+            if per_token:
+                await asyncio.sleep(per_token * step / 4)
+            yield chunk({"content": content[start:start + step]})
+        yield chunk({}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        stats["in_flight"] -= 1
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": settings.openai_model, "object": "model", "owned_by": "stub"}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Contadores del stub (peticiones, 429, 500, concurrencia máxima observada).
+    """
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Servidor LLM de pruebas compatible con OpenAI")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=settings.stub_llm_port)
+    parser.add_argument("--latency-distribution", choices=["fixed", "uniform", "lognormal", "exponential"])
+    parser.add_argument("--latency-median-ms", type=float)
+    parser.add_argument("--latency-sigma", type=float)
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--rate-limit-rate", type=float)
+    parser.add_argument("--error-rate", type=float)
+    parser.add_argument("--max-concurrency", type=int)
+    args = parser.parse_args()
+
+    # Los argumentos explícitos tienen prioridad sobre STUB_LLM_* del entorno
+    for option in (
+        "latency_distribution", "latency_median_ms", "latency_sigma", "tokens_per_second",
+        "rate_limit_rate", "error_rate", "max_concurrency"
+    ):
+        value = getattr(args, option)
+        if value is not None:
+            setattr(settings, f"stub_llm_{option}", value)
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,173 @@
+"""
+Supervisor multi-proceso de workers.
+
+En lugar de ejecutar N contenedores con un worker cada uno (y N copias
+de los pesos de Whisper en memoria), el supervisor:
+
+1. Carga el agente clínico UNA vez
+2. Hace fork de N procesos worker que comparten esas páginas de memoria
+3. Reinicia los workers que terminan inesperadamente
+4. Reenvía SIGTERM/SIGINT a los hijos para un apagado ordenado
+
+Uso:
+    python -m app.supervisor transcription_jobs --processes 8
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, List, Optional
+
+from app import worker as worker_module
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Si un hijo muere antes de este tiempo, esperamos antes de reiniciarlo
+# para no entrar en un bucle de reinicios si algo está roto
+MIN_CHILD_UPTIME_SECONDS = 5.0
+MAX_RESTART_BACKOFF_SECONDS = 30.0
+
+
+def resolve_worker_count(requested: Optional[int] = None) -> int:
+    """
+    Número de procesos worker a lanzar.
+
+    Prioridad: argumento explícito, settings.worker_processes, número de CPUs.
+    """
+    count = requested or settings.worker_processes or os.cpu_count() or 1
+    return max(1, count)
+
+
+class WorkerSupervisor:
+    """
+    Proceso padre que mantiene N workers RQ vivos.
+
+    Todos los hijos se crean con os.fork() después de cargar el modelo,
+    así que comparten sus pesos (copy-on-write) en lugar de cargar una
+    copia cada uno.
+    """
+
+    def __init__(self, queue_names: List[str], num_workers: int, executor: Optional[str] = None):
+        self.queue_names = queue_names
+        self.num_workers = num_workers
+        self.executor = executor
+        self.children: Dict[int, float] = {}  # pid -> momento de inicio
+        self.stopping = False
+        self.restart_backoff = 1.0
+
+    def run(self):
+        """
+        Carga el modelo, lanza los workers y los supervisa hasta recibir una señal.
+        """
+        worker_module.initialize_agent(load_whisper=worker_module.needs_whisper(self.queue_names))
+        # Congelar los objetos existentes evita que el recolector de basura
+        # de cada hijo escriba en (y duplique) las páginas del modelo
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        logger.info(
+            f"Supervisor iniciado: {self.num_workers} workers en colas "
+            f"{', '.join(self.queue_names)} (carga de modelos: "
+            f"{worker_module.agent_load_seconds or 0:.2f} s)"
+        )
+        for _ in range(self.num_workers):
+            self._spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            started_at = self.children.pop(pid, None)
+            if started_at is None:
+                continue
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                logger.info(f"Worker {pid} terminado ({exit_code})")
+                continue
+
+            uptime = time.monotonic() - started_at
+            logger.warning(f"Worker {pid} terminó inesperadamente ({exit_code}) tras {uptime:.1f} s, reiniciando")
+            if uptime < MIN_CHILD_UPTIME_SECONDS:
+                time.sleep(self.restart_backoff)
+                self.restart_backoff = min(self.restart_backoff * 2, MAX_RESTART_BACKOFF_SECONDS)
+            else:
+                self.restart_backoff = 1.0
+            if not self.stopping:
+                self._spawn()
+
+        logger.info("Supervisor detenido")
+
+    def _spawn(self) -> int:
+        """
+        Hace fork de un worker. En el hijo esta función nunca retorna.
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Proceso hijo: RQ instala sus propios manejadores de señales
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                self._limit_torch_threads()
+                worker_module.start_worker(self.queue_names, executor=self.executor)
+            except BaseException:
+                logger.exception("Worker terminó con error")
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+
+        self.children[pid] = time.monotonic()
+        logger.info(f"Worker {pid} iniciado")
+        return pid
+
+    def _limit_torch_threads(self):
+        """
+        Reparte los núcleos entre los workers.
+
+        Por defecto PyTorch usa todos los núcleos en cada proceso; con N
+        procesos eso provoca N veces más hilos que CPUs.
+        """
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.num_workers))
+
+    def _handle_stop(self, signum, frame):
+        """
+        Reenvía la señal a los hijos y deja de reiniciarlos.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f"Señal {signum} recibida, deteniendo {len(self.children)} workers...")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Supervisor de workers del Clinical Summarizer Agent")
+    parser.add_argument("queues", nargs="*", default=worker_module.DEFAULT_QUEUES, help="Colas a escuchar")
+    parser.add_argument("--processes", type=int, default=None, help="Número de workers (por defecto: CPUs)")
+    parser.add_argument("--executor", choices=["fork", "simple"], default=None)
+    args = parser.parse_args()
+
+    WorkerSupervisor(
+        args.queues,
+        resolve_worker_count(args.processes),
+        executor=args.executor
+    ).run()
@@ -0,0 +1,67 @@
+"""
+Conteo de tokens para decidir cuánto texto cabe en una llamada al LLM.
+
+Los límites del modelo (contexto y max_tokens) se miden en tokens, no en
+caracteres. Con tiktoken (lo instala openai-whisper) contamos exactamente
+con el tokenizador del modelo; si no está disponible, o el modelo no es de
+OpenAI y no tiene codificación conocida, usamos la aproximación habitual de
+~4 caracteres por token (algo pesimista en español, que es lo seguro para
+no pasarse del límite).
+"""
+
+import functools
+import logging
+from typing import Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # Dependencia opcional
+    tiktoken = None
+
+# Caracteres por token de la aproximación sin tokenizador
+CHARS_PER_TOKEN = 4
+
+# Codificación de los modelos de chat actuales de OpenAI (GPT-4, GPT-3.5)
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """
+    Codificación de tiktoken para un modelo (None si no se puede usar).
+
+    Se guarda en caché: construirla cuesta decenas de milisegundos.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        # Sin red, tiktoken no puede descargar la tabla BPE la primera vez
+        logger.warning(f"tiktoken no disponible para {model} ({str(e)}), usando aproximación")
+        return None
+    try:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken no disponible ({str(e)}), usando aproximación")
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Número de tokens de un texto para el modelo (por defecto OPENAI_MODEL).
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(model or settings.openai_model)
+    if encoding is None:
+        return max(1, len(text) // CHARS_PER_TOKEN)
+    # disallowed_special=(): un texto que contenga "<|endoftext|>" se cuenta
+    # como texto normal en lugar de lanzar una excepción
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,296 @@
+"""
+Transcripción segmentada y en paralelo de grabaciones largas.
+
+Whisper decodifica un archivo de forma secuencial, en un solo núcleo.
+Para consultas de 30-60 minutos dividimos el audio en ventanas:
+
+1. Buscamos puntos de corte en silencios cerca de cada múltiplo de la
+   longitud de ventana (así no cortamos palabras)
+2. Cada ventana se extiende unos segundos sobre sus vecinas (solapamiento)
+3. Las ventanas se transcriben en paralelo en un pool de procesos (fork)
+4. Unimos los segmentos en orden: cada ventana aporta sólo los segmentos
+   cuyo centro cae en su tramo "propio", y quitamos las palabras repetidas
+   en la frontera entre ventanas
+
+Sólo en CPU: un hijo creado con fork no puede usar el contexto CUDA del
+padre, así que con el modelo en GPU transcribimos de forma secuencial. Y
+el padre nunca ejecuta el modelo: hacer fork con los hilos de torch/OpenMP
+ya arrancados puede bloquear a los hijos. La detección de idioma va en un
+hijo, y los audios cortos se transcriben enteros en un hijo de un pool de
+un solo proceso (transcribe_in_worker), así un audio corto no deja los
+hilos arrancados para el siguiente audio largo del mismo worker.
+"""
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import whisper
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE  # 16 kHz
+
+# Tramas de 30 ms para medir la energía al buscar silencios
+FRAME_SAMPLES = SAMPLE_RATE * 30 // 1000
+
+# Estado compartido con los procesos del pool.
+# Se asigna ANTES de crear el pool con fork, así los hijos heredan el modelo
+# y el audio ya cargados en lugar de recibirlos serializados.
+_pool_model = None
+_pool_audio: Optional[np.ndarray] = None
+
+
+def find_split_points(audio: np.ndarray, window_samples: int, search_samples: int) -> List[int]:
+    """
+    Devuelve los puntos de corte (en muestras) entre ventanas.
+
+    Cerca de cada corte ideal buscamos, dentro de ±search_samples, la
+    trama de menor energía: normalmente una pausa entre frases.
+    """
+    points: List[int] = []
+    total = len(audio)
+    target = window_samples
+
+    # No creamos una última ventana de menos de un cuarto de la longitud
+    while target < total - window_samples // 4:
+        low = max(target - search_samples, (points[-1] if points else 0) + FRAME_SAMPLES)
+        high = min(target + search_samples, total - FRAME_SAMPLES)
+        frames = (high - low) // FRAME_SAMPLES
+        if frames <= 0:
+            cut = target
+        else:
+            region = audio[low:low + frames * FRAME_SAMPLES].reshape(frames, FRAME_SAMPLES)
+            energy = np.square(region).mean(axis=1)
+            cut = low + int(np.argmin(energy)) * FRAME_SAMPLES + FRAME_SAMPLES // 2
+        points.append(cut)
+        target = cut + window_samples
+
+    return points
+
+
+def plan_windows(total_samples: int, split_points: List[int], overlap_samples: int) -> List[Dict[str, int]]:
+    """
+    Construye las ventanas a transcribir.
+
+    Cada ventana tiene un tramo propio [own_start, own_end) entre dos
+    cortes, y se decodifica con overlap_samples extra a cada lado.
+    """
+    bounds = [0] + split_points + [total_samples]
+    windows = []
+    for own_start, own_end in zip(bounds, bounds[1:]):
+        windows.append({
+            "start": max(0, own_start - overlap_samples),
+            "end": min(total_samples, own_end + overlap_samples),
+            "own_start": own_start,
+            "own_end": own_end
+        })
+    return windows
+
+
+def _init_pool_worker(num_workers: int):
+    """
+    Inicializador de cada proceso del pool: reparte los núcleos.
+    """
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+
+def _detect_language_in_worker() -> str:
+    """
+    detect_language dentro de un proceso del pool (el padre no ejecuta el modelo).
+    """
+    return detect_language(_pool_model, _pool_audio)
+
+
+def _transcribe_whole(options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Transcribe el audio completo dentro de un proceso del pool.
+    """
+    return _pool_model.transcribe(_pool_audio, **options)
+
+
+def _transcribe_window(window: Dict[str, int], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Transcribe una ventana (se ejecuta dentro de un proceso del pool).
+
+    Las opciones llegan como argumento: el idioma se detecta después de
+    crear el pool, así que los hijos no lo heredan.
+
+    Devuelve los segmentos con tiempos absolutos (segundos desde el inicio).
+    """
+    audio = _pool_audio[window["start"]:window["end"]]
+    result = _pool_model.transcribe(audio, **options)
+    offset = window["start"] / SAMPLE_RATE
+    return [
+        {
+            "start": segment["start"] + offset,
+            "end": segment["end"] + offset,
+            "text": segment["text"]
+        }
+        for segment in result.get("segments", [])
+    ]
+
+
+def _normalize_word(word: str) -> str:
+    return word.strip(".,;:!?¡¿\"'()").lower()
+
+
+def _drop_repeated_prefix(previous: str, current: str, min_words: int = 2, max_words: int = 20) -> str:
+    """
+    Quita del inicio de `current` las palabras que repiten el final de `previous`.
+
+    Ocurre cuando una frase cae justo en la frontera y ambas ventanas la transcriben.
+    """
+    previous_words = [_normalize_word(w) for w in previous.split()]
+    current_words = current.split()
+    normalized_current = [_normalize_word(w) for w in current_words]
+    longest = min(len(previous_words), len(current_words), max_words)
+    for size in range(longest, min_words - 1, -1):
+        if previous_words[-size:] == normalized_current[:size]:
+            return " " + " ".join(current_words[size:]) if size < len(current_words) else ""
+    return current
+
+
+def stitch_segments(windows: List[Dict[str, int]], window_segments: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Une los segmentos de todas las ventanas en orden, sin duplicados.
+
+    Explicación:
+        1. De cada ventana conservamos sólo los segmentos cuyo punto medio
+           cae en su tramo propio; lo transcrito en el solapamiento lo
+           aporta la ventana vecina
+        2. En la frontera, si el primer segmento de una ventana repite las
+           últimas palabras del segmento anterior, las quitamos
+    """
+    stitched: List[Dict[str, Any]] = []
+    for window, segments in zip(windows, window_segments):
+        own_start = window["own_start"] / SAMPLE_RATE
+        own_end = window["own_end"] / SAMPLE_RATE
+        first_in_window = True
+        for segment in segments:
+            middle = (segment["start"] + segment["end"]) / 2
+            if not own_start <= middle < own_end:
+                continue
+            text = segment["text"]
+            if first_in_window and stitched:
+                text = _drop_repeated_prefix(stitched[-1]["text"], text)
+            first_in_window = False
+            if text.strip():
+                stitched.append({**segment, "text": text})
+    return stitched
+
+
+def detect_language(model, audio: np.ndarray) -> str:
+    """
+    Detecta el idioma con los primeros 30 segundos.
+
+    Lo hacemos una vez para todo el audio; si cada ventana detectara
+    el suyo, una ventana con poco habla podría elegir otro idioma.
+    """
+    clip = whisper.pad_or_trim(audio)
+    n_mels = getattr(model.dims, "n_mels", 80)
+    mel = whisper.log_mel_spectrogram(clip, n_mels).to(model.device)
+    _, probs = model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+
+def _on_gpu(model) -> bool:
+    device = getattr(model, "device", None)
+    return device is not None and device.type != "cpu"
+
+
+@contextlib.contextmanager
+def _fork_pool(model, audio: np.ndarray, processes: int, threads_divisor: int):
+    """
+    Pool de procesos (fork) que hereda el modelo y el audio.
+
+    threads_divisor reparte los núcleos entre los hijos (ver _init_pool_worker).
+    """
+    global _pool_model, _pool_audio
+
+    _pool_model, _pool_audio = model, audio
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_pool_worker,
+            initargs=(threads_divisor,)
+        ) as pool:
+            yield pool
+    finally:
+        _pool_model, _pool_audio = None, None
+
+
+def transcribe_in_worker(model, audio: np.ndarray, options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Transcribe el audio completo (sin ventanas) en un proceso hijo.
+
+    La usan los audios cortos cuando hay transcripción segmentada: si el
+    padre ejecutara el modelo, el siguiente fork heredaría los hilos de
+    torch/OpenMP ya arrancados. Con el modelo en GPU no hay fork y
+    transcribimos en el propio proceso.
+    """
+    if _on_gpu(model):
+        return model.transcribe(audio, **options)
+    with _fork_pool(model, audio, processes=1, threads_divisor=1) as pool:
+        return pool.submit(_transcribe_whole, options).result()
+
+
+def transcribe_segmented(
+    model,
+    audio: np.ndarray,
+    options: Dict[str, Any],
+    workers: int,
+    window_seconds: float,
+    overlap_seconds: float,
+    search_seconds: float
+) -> Dict[str, Any]:
+    """
+    Transcribe un audio largo dividiéndolo en ventanas procesadas en paralelo.
+
+    Args:
+        model: Modelo Whisper ya cargado (los hijos lo heredan con fork)
+        audio: Audio mono a 16 kHz (whisper.load_audio)
+        options: Opciones de decodificación para model.transcribe()
+        workers: Número de procesos del pool
+        window_seconds: Longitud objetivo de cada ventana
+        overlap_seconds: Solapamiento a cada lado de la ventana
+        search_seconds: Margen para buscar un silencio alrededor de cada corte
+
+    Returns:
+        Diccionario con text, segments y language (como la transcripción normal)
+    """
+    options = dict(options)
+    if _on_gpu(model):
+        # Los hijos de un fork no pueden usar el contexto CUDA del padre
+        logger.info(f"Modelo en {model.device.type}: transcripción secuencial (la segmentada es sólo para CPU)")
+        return model.transcribe(audio, **options)
+
+    split_points = find_split_points(
+        audio,
+        int(window_seconds * SAMPLE_RATE),
+        int(search_seconds * SAMPLE_RATE)
+    )
+    windows = plan_windows(len(audio), split_points, int(overlap_seconds * SAMPLE_RATE))
+    logger.info(f"Transcripción segmentada: {len(windows)} ventanas, {workers} procesos")
+
+    with _fork_pool(model, audio, processes=min(workers, len(windows)), threads_divisor=workers) as pool:
+        # La primera pasada del modelo ocurre ya en un hijo, nunca en el padre
+        if not options.get("language"):
+            options["language"] = pool.submit(_detect_language_in_worker).result()
+        # map() conserva el orden de las ventanas
+        window_segments = list(pool.map(_transcribe_window, windows, [options] * len(windows)))
+
+    segments = stitch_segments(windows, window_segments)
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": options["language"]
+    }
@@ -9,12 +9,30 @@ IMPORTANTE: Este proceso puede tardar minutos en procesar un trabajo,
 pero el API responde en milisegundos porque no espera este proceso.
 """
 
+import argparse
+import gc
 import logging
+import time
 import traceback
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 
-from app.queue import redis_client, update_job_status, get_job_status
+from app.queue import (
+    rq_connection,
+    update_job_status,
+    get_job_status,
+    update_job_partial,
+    update_job_narrative,
+    enqueue_extraction,
+    NARRATIVE_STATUS_ON_COMPLETE,
+    TRANSCRIPTION_QUEUE,
+    EXTRACTION_QUEUE,
+    EXPORT_QUEUE
+)
 from app.agent import ClinicalAgent
+from app.models import ClinicalSummary
+from app.compaction import prepare_transcript
+from app.output_schema import schema_id
+from app.storage import resolve_audio_path
 from app.config import settings
 
 # Configurar logging
@@ -28,27 +46,95 @@ logger = logging.getLogger(__name__)
 # Esto es costoso, por eso lo hacemos una sola vez, no por cada trabajo
 clinical_agent = None
 
+# Segundos que tardó la carga de modelos (None si aún no se cargaron)
+agent_load_seconds = None
+
+
+# Colas por defecto de un worker que no indica ninguna
+# (extracción primero: los trabajos cortos no esperan detrás de los audios;
+# las exportaciones masivas, al final)
+DEFAULT_QUEUES = [EXTRACTION_QUEUE, TRANSCRIPTION_QUEUE, EXPORT_QUEUE]
+
+
+def needs_whisper(queue_names: List[str]) -> bool:
+    """
+    Un worker que sólo atiende extraction_jobs (o export_jobs) no necesita cargar Whisper.
+    """
+    return any(name not in (EXTRACTION_QUEUE, EXPORT_QUEUE) for name in queue_names)
+
 
-def initialize_agent():
+def initialize_agent(load_whisper: bool = True):
     """
     Inicializa el agente clínico.
     
     Esta función carga los modelos necesarios (Whisper, LLM, etc.)
     Se llama una vez al iniciar el worker.
+    
+    IMPORTANTE: RQ ejecuta cada trabajo en un proceso hijo (fork).
+    Si el agente se crea dentro del hijo, se pierde al terminar el trabajo
+    y el siguiente vuelve a cargar Whisper. Por eso start_worker() llama a
+    esta función en el proceso padre, antes de empezar a escuchar la cola:
+    los hijos heredan el agente ya cargado (copy-on-write).
     """
-    global clinical_agent
+    global clinical_agent, agent_load_seconds
     if clinical_agent is None:
         logger.info("Inicializando agente clínico...")
-        clinical_agent = ClinicalAgent()
-        logger.info("Agente clínico inicializado")
+        start = time.perf_counter()
+        clinical_agent = ClinicalAgent(load_whisper=load_whisper)
+        agent_load_seconds = time.perf_counter() - start
+        logger.info(f"Agente clínico inicializado en {agent_load_seconds:.2f} s")
     return clinical_agent
 
 
+def process_transcription_job(job_id: str):
+    """
+    Etapa de transcripción (cola transcription_jobs).
+    
+    Transcribe el audio del trabajo con Whisper y lo pasa a la cola
+    extraction_jobs con la transcripción guardada en el trabajo. Así el
+    worker de transcripción (CPU) queda libre para el siguiente audio
+    mientras otro worker espera al LLM.
+    """
+    try:
+        logger.info(f"Iniciando transcripción del trabajo {job_id}")
+        
+        job_data = get_job_status(job_id)
+        if not job_data:
+            raise ValueError(f"Trabajo {job_id} no encontrado")
+        
+        update_job_status(job_id, "processing")
+        agent = initialize_agent()
+        
+        audio_sha256 = job_data.get("audio_sha256")
+        if not audio_sha256:
+            raise ValueError("El trabajo no tiene audio para transcribir")
+        
+        audio_path = resolve_audio_path(audio_sha256)
+        logger.info(f"Transcribiendo audio: {job_data.get('audio_filename')} ({audio_path})")
+        text = agent.transcribe_audio(audio_path, audio_sha256=audio_sha256)
+        logger.info(f"Transcripción completada: {len(text)} caracteres")
+        
+        if not text.strip():
+            raise ValueError("La transcripción está vacía")
+        
+        # Siguiente etapa: extracción con el LLM
+        enqueue_extraction(job_id, text)
+        logger.info(f"Trabajo {job_id} enviado a la cola de extracción")
+        
+    except Exception as e:
+        error_message = f"Error transcribiendo trabajo: {str(e)}\n{traceback.format_exc()}"
+        logger.error(f"Error en trabajo {job_id}: {error_message}")
+        update_job_status(job_id, "failed", error=error_message)
+        raise
+
+
 def process_clinical_job(job_id: str):
     """
-    Función principal que procesa un trabajo clínico.
+    Función principal que procesa un trabajo clínico (etapa de extracción).
     
-    Esta función es llamada por RQ cuando hay un trabajo en la cola.
+    Esta función es llamada por RQ cuando hay un trabajo en la cola
+    extraction_jobs (directamente si se envió texto, o tras la
+    transcripción si se envió audio).
     
     Args:
         job_id: ID del trabajo a procesar
@@ -56,10 +142,15 @@ def process_clinical_job(job_id: str):
     Flujo:
         1. Obtener datos del trabajo desde Redis
         2. Actualizar estado a "processing"
-        3. Si hay audio, transcribirlo con Whisper
-        4. Procesar texto con el agente clínico
-        5. Guardar resultado en Redis
-        6. Actualizar estado a "completed" o "failed"
+        3. Si hay audio sin transcribir (trabajos encolados antes de separar
+           las etapas), transcribirlo con Whisper
+        4. Compactar la transcripción y contar sus tokens (app/compaction.py)
+        5. Procesar texto con el agente clínico
+        6. En cuanto están los campos estructurados, guardar el resultado (y
+           tokens de entrada/uso del LLM) y marcar el trabajo "completed"
+        7. Con LLM_NARRATIVE_MODE=concurrent, añadir después el resumen
+           narrativo (narrative_status); si falla, el trabajo sigue completado
+        8. Si falla la extracción, marcar el trabajo "failed"
     
     IMPORTANTE: Esta función puede tardar varios minutos.
     Por eso NO la ejecutamos en el API directamente.
@@ -81,32 +172,77 @@ def process_clinical_job(job_id: str):
         # Obtener texto del trabajo
         text = job_data.get("text")
         audio_filename = job_data.get("audio_filename")
+        audio_sha256 = job_data.get("audio_sha256")
         
         # Si hay audio pero no texto, transcribirlo
-        if audio_filename and not text:
-            logger.info(f"Transcribiendo audio: {audio_filename}")
-            # TODO: Cargar archivo de audio desde almacenamiento
-            # Por ahora, asumimos que el texto ya está disponible
-            # En producción, aquí cargaríamos el archivo y lo transcribiríamos
-            text = agent.transcribe_audio(audio_filename)
+        if audio_sha256 and not text:
+            # El API guardó el audio en el almacén compartido usando su hash
+            audio_path = resolve_audio_path(audio_sha256)
+            logger.info(f"Transcribiendo audio: {audio_filename} ({audio_path})")
+            text = agent.transcribe_audio(audio_path, audio_sha256=audio_sha256)
             logger.info(f"Transcripción completada: {len(text)} caracteres")
         
         if not text:
             raise ValueError("No se proporcionó texto ni audio válido")
         
+        # Quitar muletillas, repeticiones y cortesía antes del LLM
+        prepared = prepare_transcript(text)
+        metrics = {
+            "input_tokens_raw": prepared["input_tokens_raw"],
+            "input_tokens": prepared["input_tokens"],
+            "llm_calls": 0,
+            "llm_prompt_tokens": 0,
+            "llm_completion_tokens": 0
+        }
+        logger.info(f"Transcripción compactada: {prepared['input_tokens_raw']} -> {prepared['input_tokens']} tokens")
+        
         # Procesar texto con el agente clínico
         # ESTA ES LA PARTE DE INFERENCE - puede tardar varios segundos o minutos
         logger.info(f"Procesando texto con agente clínico...")
-        clinical_summary = agent.process_clinical_text(text)
-        logger.info(f"Procesamiento completado")
+        narrative_mode = settings.llm_narrative_mode
+        completed = []
         
-        # Convertir resultado a dict para guardarlo en Redis
-        result_dict = clinical_summary.model_dump() if hasattr(clinical_summary, 'model_dump') else clinical_summary.dict()
+        def complete_structured(summary: ClinicalSummary):
+            # El trabajo se completa en cuanto están los campos estructurados:
+            # el triaje no espera a la prosa. La narrativa sigue su propio
+            # estado (narrative_status, ver update_job_narrative).
+            # mode="json" convierte datetime a string para que json.dumps funcione.
+            # output_schema: esquema con el que respondió el LLM (p. ej. "compact/1")
+            update_job_status(
+                job_id,
+                "completed",
+                result=summary.model_dump(mode="json"),
+                metrics={
+                    **metrics,
+                    "output_schema": schema_id(settings.llm_output_schema),
+                    "narrative_status": NARRATIVE_STATUS_ON_COMPLETE[narrative_mode]
+                }
+            )
+            completed.append(True)
+            logger.info(f"Trabajo {job_id} completado (narrativa: {NARRATIVE_STATUS_ON_COMPLETE[narrative_mode]})")
         
-        # Guardar resultado y actualizar estado
-        update_job_status(job_id, "completed", result=result_dict)
-        logger.info(f"Trabajo {job_id} completado exitosamente")
+        try:
+            # Los campos parciales se publican en el trabajo según llegan del LLM
+            clinical_summary = agent.process_clinical_text(
+                prepared["text"],
+                on_partial=lambda fields: update_job_partial(job_id, fields),
+                usage=metrics,
+                on_structured=complete_structured
+            )
+        except Exception as e:
+            if not completed:
+                raise
+            # Sólo falló la narrativa: el trabajo sigue completado
+            error_message = f"Error generando la narrativa: {str(e)}\n{traceback.format_exc()}"
+            logger.error(f"Error en la narrativa del trabajo {job_id}: {error_message}")
+            update_job_narrative(job_id, "failed", error=error_message, metrics=metrics)
+            return None
+        
+        if narrative_mode == "concurrent":
+            update_job_narrative(job_id, "completed", narrative=clinical_summary.narrative_summary, metrics=metrics)
+        logger.info(f"Procesamiento completado")
         
+        result_dict = clinical_summary.model_dump(mode="json")
         return result_dict
         
     except Exception as e:
@@ -117,14 +253,100 @@ def process_clinical_job(job_id: str):
         raise  # Re-lanzar para que RQ sepa que falló
 
 
-# Este bloque solo se ejecuta si ejecutamos este archivo directamente
-# Normalmente, RQ ejecutará este worker con: rq worker clinical_jobs
-if __name__ == "__main__":
-    from rq import Worker, Queue, Connection
+def process_narrative_job(job_id: str):
+    """
+    Genera el resumen narrativo de un trabajo ya completado (modo lazy).
     
-    # Conectar a Redis y escuchar la cola 'clinical_jobs'
-    with Connection(redis_client):
-        worker = Worker(Queue('clinical_jobs'))
-        logger.info("Worker iniciado. Escuchando cola 'clinical_jobs'...")
-        worker.work()  # Esto bloquea y procesa trabajos indefinidamente
+    La encola request_narrative_async la primera vez que alguien pide la
+    narrativa (GET /result/{job_id}/narrative).
+    
+    Explicación:
+        1. Marcamos la narrativa como "processing"
+        2. Volvemos a compactar la transcripción: la compactación es
+           determinista, así el LLM recibe el mismo texto que en la extracción
+        3. Generamos la narrativa, sumando su uso del LLM a los contadores
+           que ya tiene el trabajo
+        4. La escribimos en el resultado y la marcamos "completed" (o
+           "failed" con su error; el trabajo en sí sigue completado)
+    """
+    try:
+        logger.info(f"Generando narrativa del trabajo {job_id}")
+        job_data = get_job_status(job_id)
+        if not job_data or not job_data.get("text"):
+            raise ValueError(f"Trabajo {job_id} no encontrado o sin texto")
+        update_job_narrative(job_id, "processing")
+        
+        agent = initialize_agent(load_whisper=False)
+        prepared = prepare_transcript(job_data["text"])
+        metrics = {name: int(job_data.get(name) or 0) for name in ("llm_calls", "llm_prompt_tokens", "llm_completion_tokens")}
+        narrative = agent.generate_narrative(prepared["text"], usage=metrics)
+        
+        update_job_narrative(job_id, "completed", narrative=narrative, metrics=metrics)
+        logger.info(f"Narrativa del trabajo {job_id} completada")
+        return narrative
+    
+    except Exception as e:
+        error_message = f"Error generando la narrativa: {str(e)}\n{traceback.format_exc()}"
+        logger.error(f"Error en la narrativa del trabajo {job_id}: {error_message}")
+        update_job_narrative(job_id, "failed", error=error_message)
+        raise  # Re-lanzar para que RQ sepa que falló
 
+
+def start_worker(
+    queue_names: Optional[List[str]] = None,
+    executor: Optional[str] = None,
+    burst: bool = False
+):
+    """
+    Inicia un worker RQ con el agente clínico precargado.
+    
+    Args:
+        queue_names: Colas a escuchar (por defecto extraction_jobs y transcription_jobs)
+        executor: "fork" (un proceso hijo por trabajo, el modo de RQ) o
+                  "simple" (ejecuta los trabajos en el mismo proceso, sin fork)
+        burst: Si es True, el worker termina cuando la cola queda vacía
+    
+    Explicación:
+        1. Cargamos los modelos UNA vez en este proceso
+        2. gc.freeze() mueve los objetos ya creados a una generación que el
+           recolector de basura no recorre, así los hijos no "tocan" (y copian)
+           las páginas de memoria del modelo heredado
+        3. Con executor="fork", cada hijo hereda el agente ya cargado;
+           con executor="simple", el agente sigue vivo entre trabajos
+    """
+    from rq import Queue, Worker, SimpleWorker
+    
+    queue_names = queue_names or DEFAULT_QUEUES
+    executor = executor or settings.worker_executor
+    
+    if settings.worker_preload:
+        initialize_agent(load_whisper=needs_whisper(queue_names))
+        gc.freeze()
+    
+    worker_class = SimpleWorker if executor == "simple" else Worker
+    queues = [Queue(name, connection=rq_connection) for name in queue_names]
+    worker = worker_class(queues, connection=rq_connection)
+    logger.info(
+        f"Worker iniciado ({worker_class.__name__}). "
+        f"Escuchando colas: {', '.join(queue_names)}..."
+    )
+    worker.work(burst=burst)  # Esto bloquea y procesa trabajos indefinidamente
+
+
+# Este bloque solo se ejecuta si ejecutamos este archivo directamente:
+#   python -m app.worker transcription_jobs
+# Con "rq worker transcription_jobs" el agente se cargaría dentro de cada hijo,
+# es decir, una vez por trabajo.
+if __name__ == "__main__":
+    # Importamos desde 'app.worker' y no usamos las funciones de __main__:
+    # RQ resuelve 'app.worker.process_clinical_job' en ese módulo, así que
+    # el agente precargado debe quedar guardado allí.
+    from app.worker import start_worker as _start_worker
+    
+    parser = argparse.ArgumentParser(description="Worker del Clinical Summarizer Agent")
+    parser.add_argument("queues", nargs="*", default=DEFAULT_QUEUES, help="Colas a escuchar")
+    parser.add_argument("--executor", choices=["fork", "simple"], default=None)
+    parser.add_argument("--burst", action="store_true", help="Terminar cuando la cola esté vacía")
+    args = parser.parse_args()
+    
+    _start_worker(args.queues, executor=args.executor, burst=args.burst)
@@ -0,0 +1,6 @@
+"""
+Benchmarks del Clinical Summarizer Agent.
+
+Cada módulo se ejecuta desde la raíz del proyecto, por ejemplo:
+    python -m benchmarks.bench_queue
+"""
@@ -0,0 +1,193 @@
+"""
+Micro-benchmarks de las rutas calientes en Python puro.
+
+Mide, sobre entradas sintéticas de varios tamaños (desde un síntoma
+hasta cientos de síntomas y narrativas de varios MB):
+
+- clinical_summary_to_fhir / fhir_to_clinical_summary (app/fhir.py)
+- ClinicalAgent._parse_llm_response (respuesta completa y cortada) y
+  ClinicalAgent._build_clinical_prompt
+- construcción de ClinicalSummary y model_dump / model_dump(mode="json")
+
+Para cada función reporta:
+- ops/seg: timeit, el mejor de --repeat repeticiones (autorange decide
+  cuántas llamadas hace cada repetición)
+- memoria por llamada (tracemalloc): pico asignado durante la llamada y
+  lo que sigue vivo al terminar (el resultado), en KiB y bloques
+
+El agente se crea con ClinicalAgent.__new__, sin __init__: no carga
+Whisper ni necesita clave del LLM.
+
+Uso:
+    python -m benchmarks.bench_hotpaths --sizes tiny,small,large --json resultados.json
+"""
+
+import argparse
+import json
+import random
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from app.agent import ClinicalAgent
+from app.fhir import clinical_summary_to_fhir, fhir_to_clinical_summary
+from app.models import ClinicalSummary
+
+# Tamaño de cada entrada: número de síntomas/condiciones/factores y
+# longitud de la narrativa (y de la conversación del prompt)
+SIZES = {
+    "tiny": {"symptoms": 1, "conditions": 1, "risk_factors": 1, "narrative_chars": 200},
+    "small": {"symptoms": 5, "conditions": 3, "risk_factors": 3, "narrative_chars": 2_000},
+    "medium": {"symptoms": 40, "conditions": 20, "risk_factors": 20, "narrative_chars": 50_000},
+    "large": {"symptoms": 300, "conditions": 150, "risk_factors": 100, "narrative_chars": 1_000_000},
+    "huge": {"symptoms": 1_000, "conditions": 500, "risk_factors": 300, "narrative_chars": 4_000_000},
+}
+
+WORDS = (
+    "paciente refiere dolor cefalea fiebre tos disnea náuseas fatiga mareo "
+    "desde hace días semanas leve moderado severo antecedentes tratamiento "
+    "exploración auscultación normal presión arterial frecuencia cardíaca"
+).split()
+
+
+def _text(chars: int, rng: random.Random) -> str:
+    words: List[str] = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def build_inputs(size: Dict[str, int], seed: int = 1) -> Dict[str, Any]:
+    """
+    Construye las entradas sintéticas de un tamaño.
+    """
+    rng = random.Random(seed)
+    data = {
+        "patient_age": 57,
+        "patient_gender": "femenino",
+        "symptoms": [
+            {
+                "name": f"síntoma {i} {rng.choice(WORDS)}",
+                "duration": f"{rng.randint(1, 30)} días",
+                "severity": rng.choice(("leve", "moderado", "severo")),
+                "description": _text(80, rng)
+            }
+            for i in range(size["symptoms"])
+        ],
+        "risk_factors": [f"factor {i} {rng.choice(WORDS)}" for i in range(size["risk_factors"])],
+        "relevant_conditions": [f"condición {i} {rng.choice(WORDS)}" for i in range(size["conditions"])],
+        "narrative_summary": _text(size["narrative_chars"], rng),
+    }
+    summary = ClinicalSummary(**data)
+    return {
+        "data": data,
+        "summary": summary,
+        "bundle": clinical_summary_to_fhir(summary),
+        # Como responde un LLM real: texto alrededor de un bloque JSON
+        "llm_response": "Aquí está el análisis estructurado:\n```json\n"
+                        + json.dumps(data, ensure_ascii=False, indent=2) + "\n```\n",
+        # Respuesta cortada en max_tokens a mitad de la narrativa (ruta de reparación)
+        "llm_response_truncated": "```json\n" + json.dumps(data, ensure_ascii=False, indent=2)[:-200],
+        "conversation": _text(size["narrative_chars"], rng),
+    }
+
+
+def hot_paths(inputs: Dict[str, Any]) -> Dict[str, Callable[[], Any]]:
+    """
+    Funciones a medir, ya ligadas a sus entradas.
+    """
+    agent = ClinicalAgent.__new__(ClinicalAgent)
+    data, summary, bundle = inputs["data"], inputs["summary"], inputs["bundle"]
+    llm_response, conversation = inputs["llm_response"], inputs["conversation"]
+    truncated = inputs["llm_response_truncated"]
+    return {
+        "clinical_summary_to_fhir": lambda: clinical_summary_to_fhir(summary),
+        "fhir_to_clinical_summary": lambda: fhir_to_clinical_summary(bundle),
+        "_parse_llm_response": lambda: agent._parse_llm_response(conversation, llm_response),
+        "_parse_llm_response (cortada)": lambda: agent._parse_llm_response(conversation, truncated),
+        "_build_clinical_prompt": lambda: agent._build_clinical_prompt(conversation),
+        "ClinicalSummary(**data)": lambda: ClinicalSummary(**data),
+        "model_dump": lambda: summary.model_dump(),
+        "model_dump(mode=json)": lambda: summary.model_dump(mode="json"),
+    }
+
+
+def measure_speed(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """
+    ops/seg con timeit: el mejor de `repeat` repeticiones.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return {"ops_per_sec": number / best, "us_per_call": best / number * 1e6}
+
+
+def measure_memory(func: Callable[[], Any]) -> Dict[str, float]:
+    """
+    Memoria de una llamada con tracemalloc: pico durante la llamada y
+    lo que queda asignado al terminar (el resultado que devuelve).
+    """
+    func()  # Calentamiento: cachés internas, compilación de regex, etc.
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    retained_bytes = sum(stat.size_diff for stat in diff)
+    retained_blocks = sum(stat.count_diff for stat in diff)
+    del result
+    return {
+        "peak_kib": (peak - baseline) / 1024,
+        "retained_kib": retained_bytes / 1024,
+        "retained_blocks": retained_blocks,
+    }
+
+
+def run(sizes: List[str], repeat: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for size_name in sizes:
+        inputs = build_inputs(SIZES[size_name])
+        results[size_name] = {}
+        for name, func in hot_paths(inputs).items():
+            results[size_name][name] = {**measure_speed(func, repeat), **measure_memory(func)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de rutas calientes")
+    parser.add_argument("--sizes", default="tiny,small,medium,large", help=f"Tamaños ({', '.join(SIZES)})")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones de timeit (se toma la mejor)")
+    parser.add_argument("--json", dest="json_path", help="Guardar resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    for size_name in sizes:
+        if size_name not in SIZES:
+            parser.error(f"Tamaño desconocido: {size_name}")
+
+    results = run(sizes, args.repeat)
+
+    print(f"{'tamaño':<8}{'función':<32}{'ops/seg':>12}{'µs/llamada':>14}{'pico KiB':>12}{'retenido KiB':>14}{'bloques':>9}")
+    for size_name, functions in results.items():
+        for name, r in functions.items():
+            print(
+                f"{size_name:<8}{name:<32}{r['ops_per_sec']:>12.1f}{r['us_per_call']:>14.1f}"
+                f"{r['peak_kib']:>12.1f}{r['retained_kib']:>14.1f}{r['retained_blocks']:>9}"
+            )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"sizes": {s: SIZES[s] for s in sizes}, "results": results}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
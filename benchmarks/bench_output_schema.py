@@ -0,0 +1,160 @@
+"""
+Benchmark de los esquemas de salida del LLM (app/output_schema.py).
+
+Compara el esquema "full" (la plantilla original, claves largas) con el
+"compact" (claves de una letra, síntomas posicionales) sobre las mismas
+conversaciones sintéticas de benchmarks/load_test.py:
+
+- Modo offline (por defecto): el contenido de cada respuesta lo genera el
+  LLM de pruebas (build_clinical_json) y se escribe en cada esquema con
+  encode_output. Se cuentan con app/tokens.py los tokens de salida y los
+  del prompt, se comprueba que _parse_llm_response devuelve el mismo
+  ClinicalSummary con ambos esquemas y se estima el tiempo de generación
+  a --tokens-per-second
+- Modo --live: llama de verdad al backend configurado (LLM_BACKEND) con
+  cada esquema y mide latencia (p50/p95/p99) y completion_tokens del
+  proveedor. Con el stub, arráncalo con tiempo por token para que la
+  diferencia de salida se note en la latencia:
+
+    python -m app.stub_llm_server --tokens-per-second 50 --latency-median-ms 300
+    LLM_BACKEND=stub python -m benchmarks.bench_output_schema --live --jobs 20
+
+El agente del modo offline se crea con ClinicalAgent.__new__ (sin
+Whisper ni cliente del LLM), como en bench_hotpaths.
+
+Uso:
+    python -m benchmarks.bench_output_schema --sizes short,medium,long --json resultados.json
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Any, Dict, List
+
+from app.agent import ClinicalAgent
+from app.config import settings
+from app.output_schema import OUTPUT_SCHEMAS, encode_output, schema_id
+from app.stub_llm_server import build_clinical_json
+from app.tokens import count_tokens
+from benchmarks.load_test import SIZE_CLASSES, build_conversation, percentiles
+
+
+def _mean(values: List[float]) -> float:
+    return round(sum(values) / len(values), 1) if values else 0.0
+
+
+def run_offline(conversations: List[str], tokens_per_second: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Tokens de salida y de prompt por esquema, sin llamar al LLM.
+    """
+    agent = ClinicalAgent.__new__(ClinicalAgent)
+    expected = [agent._parse_llm_response(text, encode_output(build_clinical_json(text), "full")) for text in conversations]
+    original_schema = settings.llm_output_schema
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for name in OUTPUT_SCHEMAS:
+            settings.llm_output_schema = name
+            output_tokens: List[float] = []
+            prompt_tokens: List[float] = []
+            mismatches = 0
+            for text, summary in zip(conversations, expected):
+                response = encode_output(build_clinical_json(text), name)
+                output_tokens.append(count_tokens(response))
+                prompt_tokens.append(count_tokens(agent._build_clinical_prompt(text)))
+                decoded = agent._parse_llm_response(text, response)
+                if decoded.model_dump(exclude={"created_at"}) != summary.model_dump(exclude={"created_at"}):
+                    mismatches += 1
+            results[name] = {
+                "schema": schema_id(name),
+                "output_tokens_mean": _mean(output_tokens),
+                "prompt_tokens_mean": _mean(prompt_tokens),
+                "decode_mismatches": mismatches,
+                "est_generation_ms": round(_mean(output_tokens) / tokens_per_second * 1000, 1)
+            }
+    finally:
+        settings.llm_output_schema = original_schema
+    return results
+
+
+def run_live(conversations: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Latencia y tokens reales de cada esquema contra el backend configurado.
+
+    Se llama a _call_llm directamente (sin caché de resultados) y los
+    esquemas se alternan por conversación para que una deriva del servidor
+    afecte a los dos por igual.
+    """
+    agent = ClinicalAgent(load_whisper=False)
+    original_schema = settings.llm_output_schema
+    latencies: Dict[str, List[float]] = {name: [] for name in OUTPUT_SCHEMAS}
+    usages: Dict[str, Dict[str, int]] = {name: {} for name in OUTPUT_SCHEMAS}
+    try:
+        for text in conversations:
+            for name in OUTPUT_SCHEMAS:
+                settings.llm_output_schema = name
+                messages = agent._build_messages(text)
+                start = time.perf_counter()
+                agent._call_llm(messages, usage=usages[name])
+                latencies[name].append(time.perf_counter() - start)
+    finally:
+        settings.llm_output_schema = original_schema
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in OUTPUT_SCHEMAS:
+        calls = usages[name].get("llm_calls", 0) or 1
+        results[name] = {
+            "schema": schema_id(name),
+            "latency_ms": percentiles(latencies[name]),
+            "completion_tokens_mean": round(usages[name].get("llm_completion_tokens", 0) / calls, 1),
+            "prompt_tokens_mean": round(usages[name].get("llm_prompt_tokens", 0) / calls, 1)
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens de salida y latencia por esquema de salida del LLM")
+    parser.add_argument("--sizes", default="short,medium,long", help=f"Clases de tamaño ({', '.join(SIZE_CLASSES)})")
+    parser.add_argument("--jobs", type=int, default=50, help="Conversaciones por clase de tamaño")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Velocidad de generación para estimar la latencia (offline)")
+    parser.add_argument("--live", action="store_true", help="Llamar al backend configurado (LLM_BACKEND) y medir latencia real")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path", help="Guardar resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    for size_name in sizes:
+        if size_name not in SIZE_CLASSES:
+            parser.error(f"Tamaño desconocido: {size_name}")
+
+    rng = random.Random(args.seed)
+    results: Dict[str, Dict[str, Any]] = {}
+    for size_name in sizes:
+        conversations = [build_conversation(SIZE_CLASSES[size_name], rng) for _ in range(args.jobs)]
+        results[size_name] = {"offline": run_offline(conversations, args.tokens_per_second)}
+        if args.live:
+            results[size_name]["live"] = run_live(conversations)
+
+    print(f"{'tamaño':<8}{'esquema':<12}{'salida tok':>12}{'prompt tok':>12}{'gen. est. ms':>14}{'distintos':>11}")
+    for size_name, modes in results.items():
+        full_tokens = modes["offline"]["full"]["output_tokens_mean"]
+        for name, r in modes["offline"].items():
+            saving = f"  ({100 * (1 - r['output_tokens_mean'] / full_tokens):.0f}% menos)" if name != "full" and full_tokens else ""
+            print(
+                f"{size_name:<8}{r['schema']:<12}{r['output_tokens_mean']:>12.1f}{r['prompt_tokens_mean']:>12.1f}"
+                f"{r['est_generation_ms']:>14.1f}{r['decode_mismatches']:>11}{saving}"
+            )
+        for name, r in modes.get("live", {}).items():
+            latency = r["latency_ms"]
+            print(
+                f"{size_name:<8}{r['schema']:<12}completion {r['completion_tokens_mean']:.1f} tok, "
+                f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms"
+            )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"jobs": args.jobs, "results": results}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Micro-benchmark de las transiciones de estado en app.queue.
+
+Compara operaciones por segundo de:
+- "antes": la versión original, con un comando Redis por paso
+  (hset + expire + enqueue de RQ, exists + hgetall + get, hasta 5 hset/setex)
+- "después": las funciones actuales de app.queue, una ida y vuelta MULTI/EXEC
+
+Necesita un Redis real (el de settings). Para no mezclar trabajos con los
+workers reales, usa una cola RQ propia y borra sus claves al terminar.
+
+Uso:
+    python -m benchmarks.bench_queue --iterations 2000
+"""
+
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from rq import Queue
+
+import app.queue as queue_module
+from app.queue import redis_client, enqueue_job, get_job_status, update_job_status
+
+BENCH_QUEUE = "bench_clinical_jobs"
+
+SAMPLE_RESULT = {
+    "patient_age": 45,
+    "patient_gender": "masculino",
+    "symptoms": [{"name": "dolor de cabeza", "duration": "3 días", "severity": "moderado", "description": None}],
+    "risk_factors": ["historial de migrañas"],
+    "relevant_conditions": ["migraña"],
+    "narrative_summary": "Paciente masculino de 45 años con cefalea de 3 días."
+}
+
+
+# --- Implementación original (una llamada por paso) ---
+
+def legacy_enqueue_job(job_queue: Queue, job_data: dict) -> str:
+    job_id = str(uuid.uuid4())
+    job_key = f"job:{job_id}"
+    redis_client.hset(job_key, mapping={
+        "job_id": job_id,
+        "status": "pending",
+        "created_at": datetime.now().isoformat(),
+        "text": job_data.get("text") or "",
+        "audio_filename": "",
+        "audio_url": ""
+    })
+    redis_client.expire(job_key, timedelta(hours=24))
+    job_queue.enqueue('app.worker.process_clinical_job', job_id, job_timeout=300)
+    return job_id
+
+
+def legacy_get_job_status(job_id: str):
+    job_key = f"job:{job_id}"
+    if not redis_client.exists(job_key):
+        return None
+    job_data = redis_client.hgetall(job_key)
+    if job_data.get("status") == "completed":
+        result_data = redis_client.get(f"result:{job_id}")
+        if result_data:
+            job_data["clinical_summary"] = json.loads(result_data)
+    return job_data
+
+
+def legacy_update_job_status(job_id: str, status: str, result=None, error=None):
+    job_key = f"job:{job_id}"
+    redis_client.hset(job_key, "status", status)
+    if result:
+        redis_client.setex(f"result:{job_id}", timedelta(hours=24), json.dumps(result))
+        redis_client.hset(job_key, "completed_at", datetime.now().isoformat())
+    if error:
+        redis_client.hset(job_key, "error", error)
+        redis_client.hset(job_key, "completed_at", datetime.now().isoformat())
+
+
+# --- Medición ---
+
+def ops_per_sec(func, args_list) -> float:
+    """
+    Ejecuta func una vez por cada tupla de argumentos y devuelve ops/seg.
+    """
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    elapsed = time.perf_counter() - start
+    return len(args_list) / elapsed if elapsed > 0 else float("inf")
+
+
+def run(iterations: int) -> dict:
+    """
+    Mide enqueue, update (processing y completed) y get_status en ambas versiones.
+    """
+    bench_queue = Queue(BENCH_QUEUE, connection=redis_client)
+    original_queue = queue_module.extraction_queue
+    queue_module.extraction_queue = bench_queue
+    job_data = {"text": "Paciente de 45 años con dolor de cabeza desde hace 3 días."}
+    results = {}
+
+    try:
+        for label, enqueue, update, get in (
+            ("antes", lambda d: legacy_enqueue_job(bench_queue, d), legacy_update_job_status, legacy_get_job_status),
+            ("después", enqueue_job, update_job_status, get_job_status),
+        ):
+            job_ids = []
+            enqueue_ops = ops_per_sec(lambda d: job_ids.append(enqueue(d)), [(job_data,)] * iterations)
+            processing_ops = ops_per_sec(update, [(job_id, "processing") for job_id in job_ids])
+            completed_ops = ops_per_sec(
+                lambda job_id: update(job_id, "completed", result=SAMPLE_RESULT),
+                [(job_id,) for job_id in job_ids]
+            )
+            get_ops = ops_per_sec(get, [(job_id,) for job_id in job_ids])
+            results[label] = {
+                "enqueue_job": round(enqueue_ops, 1),
+                "update_job_status(processing)": round(processing_ops, 1),
+                "update_job_status(completed)": round(completed_ops, 1),
+                "get_job_status": round(get_ops, 1),
+            }
+            cleanup(job_ids)
+    finally:
+        queue_module.extraction_queue = original_queue
+        bench_queue.delete(delete_jobs=True)
+
+    return results
+
+
+def cleanup(job_ids):
+    """
+    Borra las claves creadas por el benchmark.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.delete(f"job:{job_id}", f"result:{job_id}", f"rq:job:{job_id}")
+    pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de app.queue (ops/seg)")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--json", action="store_true", help="Imprimir resultados en JSON")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+
+    if args.json:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+        return
+
+    print(f"{'operación':<32}{'antes':>12}{'después':>12}{'mejora':>10}")
+    for operation in results["antes"]:
+        before = results["antes"][operation]
+        after = results["después"][operation]
+        print(f"{operation:<32}{before:>12.1f}{after:>12.1f}{after / before:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark de transcripción segmentada: tiempo total vs. número de procesos.
+
+Transcribe el mismo audio:
+- de forma secuencial (model.transcribe sobre el audio completo)
+- con transcribe_segmented y 1, 2, 4, ... procesos
+
+y reporta el tiempo de pared y la aceleración respecto a la versión secuencial.
+El modelo se carga una sola vez; los procesos del pool lo heredan con fork.
+La versión secuencial se mide al final: ejecuta el modelo en este proceso,
+y un fork posterior heredaría los hilos de torch/OpenMP ya arrancados.
+
+Uso:
+    python -m benchmarks.bench_transcription consulta.wav --workers 1,2,4,8
+"""
+
+import argparse
+import json
+import time
+
+import whisper
+
+from app.config import settings
+from app.transcription import transcribe_segmented, SAMPLE_RATE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de transcripción segmentada")
+    parser.add_argument("audio", help="Archivo de audio a transcribir")
+    parser.add_argument("--workers", default="1,2,4", help="Lista de procesos, separada por comas")
+    parser.add_argument("--model", default=settings.whisper_model, help="Modelo Whisper")
+    parser.add_argument("--language", default=settings.whisper_language)
+    parser.add_argument("--window", type=float, default=settings.transcription_window_seconds)
+    parser.add_argument("--overlap", type=float, default=settings.transcription_overlap_seconds)
+    parser.add_argument("--search", type=float, default=settings.transcription_split_search_seconds)
+    parser.add_argument("--skip-sequential", action="store_true", help="No medir la versión secuencial")
+    parser.add_argument("--json", dest="json_path", help="Guardar resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    model = whisper.load_model(args.model)
+    audio = whisper.load_audio(args.audio)
+    options = {"language": args.language} if args.language else {}
+    duration = len(audio) / SAMPLE_RATE
+    print(f"Audio: {args.audio} ({duration:.1f} s), modelo '{args.model}'")
+
+    runs = []
+    for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+        start = time.perf_counter()
+        result = transcribe_segmented(
+            model,
+            audio,
+            options,
+            workers=workers,
+            window_seconds=args.window,
+            overlap_seconds=args.overlap,
+            search_seconds=args.search
+        )
+        runs.append({
+            "mode": "segmentado",
+            "workers": workers,
+            "wall_seconds": time.perf_counter() - start,
+            "characters": len(result["text"])
+        })
+
+    # Después de todos los forks (ver la docstring del módulo)
+    if not args.skip_sequential:
+        start = time.perf_counter()
+        result = model.transcribe(audio, **options)
+        runs.insert(0, {
+            "mode": "secuencial",
+            "workers": 1,
+            "wall_seconds": time.perf_counter() - start,
+            "characters": len(result["text"])
+        })
+
+    baseline = runs[0]["wall_seconds"]
+    print(f"{'modo':<12}{'procesos':>9}{'segundos':>11}{'x tiempo real':>15}{'aceleración':>13}")
+    for run in runs:
+        run["realtime_factor"] = duration / run["wall_seconds"]
+        run["speedup"] = baseline / run["wall_seconds"]
+        print(
+            f"{run['mode']:<12}{run['workers']:>9}{run['wall_seconds']:>11.1f}"
+            f"{run['realtime_factor']:>15.2f}{run['speedup']:>12.2f}x"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"audio": args.audio, "duration_seconds": duration, "model": args.model, "runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
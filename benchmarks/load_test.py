@@ -0,0 +1,354 @@
+"""
+Prueba de carga de extremo a extremo: /submit -> cola -> worker -> /result.
+
+Levanta (como subprocesos) la app FastAPI real, el LLM de pruebas
+(app/stub_llm_server.py) y N workers con LLM_BACKEND=stub, y envía
+trabajos de texto con llegadas de Poisson a una tasa fija y una mezcla
+configurable de tamaños de conversación. Cada trabajo se sigue con
+long-poll (/result?wait=) hasta que termina.
+
+Reporta p50/p95/p99 de:
+- submit: latencia de POST /submit vista por el cliente
+- queue_wait: created_at -> started_at (espera en cola)
+- processing: started_at -> completed_at (trabajo del worker)
+- end_to_end: desde el envío hasta que el cliente recibe el resultado
+
+además de trabajos/seg completados y operaciones/seg de Redis
+(INFO stats). Los resultados se guardan en JSON para comparar ejecuciones.
+
+Necesita un Redis real (el de settings). Los workers no cargan Whisper:
+sólo escuchan extraction_jobs.
+
+Uso:
+    python -m benchmarks.load_test --rate 20 --duration 60 --workers 2 \\
+        --mix short:0.6,medium:0.3,long:0.1 --output resultados.json
+    python -m benchmarks.load_test --api-url http://localhost:8000 --no-workers --no-stub
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.queue import redis_client
+
+# Longitud aproximada (caracteres) de cada clase de conversación
+SIZE_CLASSES = {"short": 400, "medium": 2500, "long": 12000}
+
+SENTENCES = [
+    "Paciente de {age} años que acude por dolor de cabeza desde hace {days} días.",
+    "Refiere fiebre de hasta 38.{decimal} grados y tos seca por las noches.",
+    "Niega náuseas o vómitos. Comenta cansancio al final del día.",
+    "Es fumador de {cigs} cigarrillos al día desde la juventud.",
+    "Tiene antecedentes familiares de hipertensión y diabetes.",
+    "El dolor empeora con la luz y mejora con reposo en habitación oscura.",
+    "Toma paracetamol ocasionalmente con alivio parcial de los síntomas.",
+    "No ha viajado recientemente ni tiene contactos enfermos conocidos.",
+    "Describe dificultad para respirar al subir escaleras en la última semana.",
+    "Doctor: ¿Ha notado cambios en el apetito o en el peso? Paciente: Un poco menos de hambre.",
+]
+
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """
+    "short:0.6,medium:0.3,long:0.1" -> {"short": 0.6, "medium": 0.3, "long": 0.1}
+    """
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        name = name.strip()
+        if name not in SIZE_CLASSES:
+            raise ValueError(f"Clase de tamaño desconocida: {name} (opciones: {', '.join(SIZE_CLASSES)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def build_conversation(target_chars: int, rng: random.Random) -> str:
+    """
+    Conversación sintética de ~target_chars caracteres.
+
+    Los valores aleatorios hacen cada texto único, así la caché de
+    resultados no convierte la prueba en una prueba de la caché.
+    """
+    parts: List[str] = []
+    length = 0
+    while length < target_chars:
+        sentence = rng.choice(SENTENCES).format(
+            age=rng.randint(18, 90),
+            days=rng.randint(1, 14),
+            decimal=rng.randint(0, 9),
+            cigs=rng.randint(1, 30)
+        )
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(parts)
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    p50/p95/p99 (método del rango más cercano), media y máximo, en milisegundos.
+    """
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    ordered = sorted(values)
+    result = {}
+    for p in PERCENTILES:
+        index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        result[f"p{p}"] = round(ordered[index] * 1000, 1)
+    result["mean"] = round(sum(ordered) / len(ordered) * 1000, 1)
+    result["max"] = round(ordered[-1] * 1000, 1)
+    return result
+
+
+def _seconds_between(start: Optional[str], end: Optional[str]) -> Optional[float]:
+    if not start or not end:
+        return None
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+
+class Cluster:
+    """
+    Subprocesos del sistema bajo prueba: stub LLM, API y workers.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.processes: List[subprocess.Popen] = []
+        self.env = dict(os.environ)
+        self.env.update({
+            "LLM_BACKEND": "stub",
+            "STUB_LLM_HOST": "127.0.0.1",
+            "STUB_LLM_PORT": str(args.stub_port),
+            "LLM_CACHE_ENABLED": "false",
+            "LLM_STREAMING": "true" if args.streaming else "false",
+            "PYTHONUNBUFFERED": "1",
+        })
+
+    def _spawn(self, command: List[str], name: str):
+        log = open(os.path.join(self.args.log_dir, f"{name}.log"), "w") if self.args.log_dir else subprocess.DEVNULL
+        self.processes.append(subprocess.Popen(command, env=self.env, stdout=log, stderr=subprocess.STDOUT))
+
+    def start(self):
+        python = sys.executable
+        if self.args.log_dir:
+            os.makedirs(self.args.log_dir, exist_ok=True)
+        if not self.args.no_stub:
+            self._spawn([
+                python, "-m", "app.stub_llm_server",
+                "--port", str(self.args.stub_port),
+                "--latency-distribution", self.args.latency_distribution,
+                "--latency-median-ms", str(self.args.latency_median_ms),
+                "--rate-limit-rate", str(self.args.rate_limit_rate),
+                "--error-rate", str(self.args.error_rate),
+            ], "stub_llm")
+            _wait_http(f"http://127.0.0.1:{self.args.stub_port}/v1/models")
+        if not self.args.api_url:
+            self._spawn([
+                python, "-m", "uvicorn", "app.main:app",
+                "--port", str(self.args.api_port), "--log-level", "warning"
+            ], "api")
+        if not self.args.no_workers:
+            for index in range(self.args.workers):
+                if self.args.worker_type == "async":
+                    command = [python, "-m", "app.async_worker", "extraction_jobs"]
+                else:
+                    executor = "simple" if self.args.worker_type == "rq-simple" else "fork"
+                    command = [python, "-m", "app.worker", "extraction_jobs", "--executor", executor]
+                self._spawn(command, f"worker_{index}")
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + 10
+        for process in self.processes:
+            try:
+                process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def _redis_commands_processed() -> Optional[int]:
+    """
+    Contador de comandos de Redis (INFO stats), o None si INFO no está disponible.
+    """
+    try:
+        return int(redis_client.info("stats")["total_commands_processed"])
+    except Exception:
+        return None
+
+
+def _wait_http(url: str, timeout: float = 30):
+    """
+    Espera a que un servicio recién lanzado responda.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} no respondió en {timeout} s")
+
+
+async def _run_job(client: httpx.AsyncClient, text: str, size_class: str, args) -> Dict[str, Any]:
+    """
+    Envía un trabajo y espera (long-poll) a que termine.
+    """
+    record: Dict[str, Any] = {"size_class": size_class, "chars": len(text)}
+    start = time.perf_counter()
+    try:
+        response = await client.post("/submit", data={"text": text})
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        record["error"] = f"submit: {str(e)}"
+        return record
+    record["submit"] = time.perf_counter() - start
+    job_id = response.json()["job_id"]
+
+    deadline = start + args.job_timeout
+    data: Dict[str, Any] = {}
+    while time.perf_counter() < deadline:
+        try:
+            result = await client.get(f"/result/{job_id}", params={"wait": args.poll_wait})
+            result.raise_for_status()
+            data = result.json()
+        except httpx.HTTPError as e:
+            record["error"] = f"result: {str(e)}"
+            return record
+        if data["status"] in ("completed", "failed"):
+            break
+    record["end_to_end"] = time.perf_counter() - start
+    record["completed_at_monotonic"] = time.perf_counter()
+    record["status"] = data["status"] if data.get("status") in ("completed", "failed") else "timeout"
+    record["queue_wait"] = _seconds_between(data.get("created_at"), data.get("started_at"))
+    record["processing"] = _seconds_between(data.get("started_at"), data.get("completed_at"))
+    return record
+
+
+async def drive_load(args, api_url: str) -> Dict[str, Any]:
+    """
+    Genera llegadas de Poisson durante args.duration segundos y recoge los tiempos.
+    """
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    classes, weights = list(mix), list(mix.values())
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    timeout = httpx.Timeout(args.poll_wait + 30)
+
+    commands_before = _redis_commands_processed()
+    tasks = []
+    async with httpx.AsyncClient(base_url=api_url, limits=limits, timeout=timeout) as client:
+        start = time.perf_counter()
+        next_arrival = start
+        while next_arrival - start < args.duration:
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+            size_class = rng.choices(classes, weights)[0]
+            text = build_conversation(SIZE_CLASSES[size_class], rng)
+            tasks.append(asyncio.create_task(_run_job(client, text, size_class, args)))
+            next_arrival += rng.expovariate(args.rate)
+        submitted_in = time.perf_counter() - start
+        records = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    commands_after = _redis_commands_processed()
+
+    completed = [r for r in records if r.get("status") == "completed"]
+    last_completion = max((r["completed_at_monotonic"] for r in completed), default=start + elapsed)
+    metrics = {
+        name: percentiles([r[name] for r in completed if r.get(name) is not None])
+        for name in ("submit", "queue_wait", "processing", "end_to_end")
+    }
+    by_class = {
+        size_class: percentiles([r["end_to_end"] for r in completed if r["size_class"] == size_class])
+        for size_class in classes
+    }
+    return {
+        "jobs_submitted": len(records),
+        "jobs_completed": len(completed),
+        "jobs_failed": sum(1 for r in records if r.get("status") == "failed"),
+        "jobs_timed_out": sum(1 for r in records if r.get("status") == "timeout"),
+        "client_errors": sum(1 for r in records if "error" in r),
+        "offered_rate": round(len(records) / submitted_in, 2) if submitted_in else None,
+        "jobs_per_second": round(len(completed) / (last_completion - start), 2) if completed else 0.0,
+        "redis_ops_per_second": (
+            round((commands_after - commands_before) / elapsed, 1)
+            if commands_before is not None and commands_after is not None else None
+        ),
+        "elapsed_seconds": round(elapsed, 2),
+        "latency_ms": metrics,
+        "end_to_end_ms_by_size": by_class,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de extremo a extremo")
+    parser.add_argument("--rate", type=float, default=10.0, help="Trabajos por segundo (llegadas de Poisson)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Segundos enviando trabajos")
+    parser.add_argument("--mix", default="short:0.6,medium:0.3,long:0.1", help="Mezcla de tamaños")
+    parser.add_argument("--workers", type=int, default=2, help="Procesos worker a lanzar")
+    parser.add_argument("--worker-type", choices=["async", "rq-simple", "rq-fork"], default="async")
+    parser.add_argument("--streaming", action="store_true", help="LLM en modo streaming (resultados parciales)")
+    parser.add_argument("--latency-distribution", default="lognormal", choices=["fixed", "uniform", "lognormal", "exponential"])
+    parser.add_argument("--latency-median-ms", type=float, default=800.0, help="Latencia típica del stub LLM")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fracción de 429 del stub")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de 500 del stub")
+    parser.add_argument("--api-url", help="Usar una API ya en marcha en lugar de lanzarla")
+    parser.add_argument("--api-port", type=int, default=8765)
+    parser.add_argument("--stub-port", type=int, default=8766)
+    parser.add_argument("--no-workers", action="store_true", help="No lanzar workers (usar los que ya hay)")
+    parser.add_argument("--no-stub", action="store_true", help="No lanzar el stub LLM")
+    parser.add_argument("--job-timeout", type=float, default=300.0, help="Segundos máximos por trabajo")
+    parser.add_argument("--poll-wait", type=int, default=30, help="?wait= de cada long-poll")
+    parser.add_argument("--max-connections", type=int, default=500, help="Conexiones HTTP del cliente")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-dir", help="Guardar la salida de los subprocesos en este directorio")
+    parser.add_argument("--output", help="Guardar resultados en este archivo JSON")
+    args = parser.parse_args()
+
+    cluster = Cluster(args)
+    api_url = args.api_url or f"http://127.0.0.1:{args.api_port}"
+    try:
+        cluster.start()
+        _wait_http(f"{api_url}/health")
+        if not args.no_workers:
+            time.sleep(2)  # Dar tiempo a los workers para empezar a escuchar
+        results = asyncio.run(drive_load(args, api_url))
+    finally:
+        cluster.stop()
+
+    report = {
+        "started_at": datetime.now().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+
+    print(f"Trabajos: {results['jobs_completed']}/{results['jobs_submitted']} completados, "
+          f"{results['jobs_failed']} fallidos, {results['jobs_timed_out']} sin terminar")
+    print(f"Tasa ofrecida {results['offered_rate']} trab/s, "
+          f"completados {results['jobs_per_second']} trab/s, Redis {results['redis_ops_per_second']} ops/s")
+    print(f"{'métrica (ms)':<14}{'p50':>10}{'p95':>10}{'p99':>10}{'máx':>10}")
+    for name, values in results["latency_ms"].items():
+        row = "".join(f"{values.get(k) if values.get(k) is not None else '-':>10}" for k in ("p50", "p95", "p99", "max"))
+        print(f"{name:<14}{row}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -41,14 +41,23 @@ def submit_text_job(text: str) -> str:
     return job_id
 
 
-def check_job_status(job_id: str) -> dict:
+def check_job_status(job_id: str, wait: int = 0) -> dict:
     """
     Consulta el estado de un trabajo.
     
+    Args:
+        job_id: ID del trabajo
+        wait: Segundos que el servidor puede esperar a que el trabajo termine
+              antes de responder (long-poll). 0 responde de inmediato.
+    
     Returns:
         Diccionario con el estado y resultado (si está disponible)
     """
-    response = requests.get(f"{API_BASE_URL}/result/{job_id}")
+    response = requests.get(
+        f"{API_BASE_URL}/result/{job_id}",
+        params={"wait": wait},
+        timeout=wait + 10
+    )
     
     if response.status_code != 200:
         print(f"❌ Error: {response.status_code} - {response.text}")
@@ -57,14 +66,18 @@ def check_job_status(job_id: str) -> dict:
     return response.json()
 
 
-def wait_for_completion(job_id: str, max_wait: int = 300, poll_interval: int = 2):
+def wait_for_completion(job_id: str, max_wait: int = 300, long_poll: int = 30):
     """
-    Espera a que un trabajo se complete haciendo polling.
+    Espera a que un trabajo se complete usando long-polling.
+    
+    En lugar de consultar cada pocos segundos, cada petición queda
+    abierta en el servidor hasta `long_poll` segundos y responde en
+    cuanto el trabajo termina.
     
     Args:
         job_id: ID del trabajo
         max_wait: Tiempo máximo de espera en segundos
-        poll_interval: Intervalo entre consultas en segundos
+        long_poll: Segundos que espera el servidor en cada petición
     
     Returns:
         Resultado del trabajo o None si falla o timeout
@@ -73,7 +86,8 @@ def wait_for_completion(job_id: str, max_wait: int = 300, poll_interval: int = 2
     start_time = time.time()
     
     while time.time() - start_time < max_wait:
-        result = check_job_status(job_id)
+        remaining = max_wait - (time.time() - start_time)
+        result = check_job_status(job_id, wait=max(1, min(long_poll, int(remaining))))
         
         if not result:
             print("❌ No se pudo obtener el estado del trabajo")
@@ -88,9 +102,6 @@ def wait_for_completion(job_id: str, max_wait: int = 300, poll_interval: int = 2
         elif status == "failed":
             print(f"❌ Trabajo falló: {result.get('error', 'Error desconocido')}")
             return result
-        
-        # Esperar antes de la siguiente consulta
-        time.sleep(poll_interval)
     
     print(f"⏱️  Timeout después de {max_wait} segundos")
     return None
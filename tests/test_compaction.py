@@ -0,0 +1,27 @@
+"""
+Tests de la compactación de transcripciones (app/compaction.py).
+"""
+
+from app.compaction import compact_transcript
+
+
+def test_eco_de_otro_hablante_se_conserva():
+    """
+    Un paciente que responde repitiendo la pregunta del médico no es una
+    repetición: es otro turno y debe conservarse entero.
+    """
+    text = "Doctor: ¿Dolor de cabeza?\nPaciente: Dolor de cabeza."
+    assert compact_transcript(text) == text
+
+
+def test_bucle_de_whisper_dentro_de_un_turno():
+    """
+    La misma frase repetida seguida dentro de un turno (bucle típico de
+    Whisper) se queda una sola vez, también entre líneas del mismo turno.
+    """
+    text = (
+        "Paciente: Me duele el pecho desde ayer. Me duele el pecho desde ayer. Me duele el pecho desde ayer.\n"
+        "Me duele el pecho desde ayer.\n"
+        "Doctor: ¿Desde cuándo?"
+    )
+    assert compact_transcript(text) == "Paciente: Me duele el pecho desde ayer.\nDoctor: ¿Desde cuándo?"